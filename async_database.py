@@ -0,0 +1,64 @@
+from storage import run_db, shutdown_db_executor, create_storage
+
+# Обработчики обращаются к данным только через эти функции. Реализация
+# выбирается настройкой STORAGE_BACKEND, см. storage.py
+STORAGE = create_storage()
+
+create_user = STORAGE.create_user
+update_user_activity = STORAGE.update_user_activity
+flush_user_activity = STORAGE.flush_user_activity
+get_user_lists = STORAGE.get_user_lists
+create_list = STORAGE.create_list
+delete_list = STORAGE.delete_list
+get_list_details = STORAGE.get_list_details
+get_list_items = STORAGE.get_list_items
+get_list_version = STORAGE.get_list_version
+get_list_items_page = STORAGE.get_list_items_page
+get_list_item_count = STORAGE.get_list_item_count
+add_item_to_list = STORAGE.add_item_to_list
+add_items_to_list = STORAGE.add_items_to_list
+delete_item = STORAGE.delete_item
+clear_list_items = STORAGE.clear_list_items
+invite_user_to_list = STORAGE.invite_user_to_list
+get_list_owner = STORAGE.get_list_owner
+save_invite_token = STORAGE.save_invite_token
+get_or_create_invite_token = STORAGE.get_or_create_invite_token
+purge_invites = STORAGE.purge_invites
+purge_deleted_items = STORAGE.purge_deleted_items
+reclaim_free_pages = STORAGE.reclaim_free_pages
+suggest_items = STORAGE.suggest_items
+get_invite_by_token = STORAGE.get_invite_by_token
+mark_invite_used = STORAGE.mark_invite_used
+invite_user_to_list_as_admin = STORAGE.invite_user_to_list_as_admin
+
+__all__ = [
+    "run_db",
+    "shutdown_db_executor",
+    "STORAGE",
+    "create_user",
+    "update_user_activity",
+    "flush_user_activity",
+    "get_user_lists",
+    "create_list",
+    "delete_list",
+    "get_list_details",
+    "get_list_items",
+    "get_list_version",
+    "get_list_items_page",
+    "get_list_item_count",
+    "add_item_to_list",
+    "add_items_to_list",
+    "delete_item",
+    "clear_list_items",
+    "invite_user_to_list",
+    "get_list_owner",
+    "save_invite_token",
+    "get_invite_by_token",
+    "get_or_create_invite_token",
+    "purge_invites",
+    "purge_deleted_items",
+    "reclaim_free_pages",
+    "suggest_items",
+    "mark_invite_used",
+    "invite_user_to_list_as_admin",
+]
@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Набор микробенчмарков для горячих путей database.py, storage.py, utils.py
+# и router.py. Запускается на временной базе, заполненной данными заданного
+# объема:
+#
+#   python benchmark.py --save-baseline baseline.json
+#   python benchmark.py --baseline baseline.json --threshold 0.2
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота списков покупок")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--lists", type=int, default=10000)
+    parser.add_argument("--items", type=int, default=1000000)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--baseline", metavar="PATH")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="допустимое замедление относительно базовой линии (0.2 = 20%%)",
+    )
+    parser.add_argument("--only", nargs="*", help="запустить только эти бенчмарки")
+    return parser.parse_args()
+
+
+def seed_database(database, users, lists, items):
+    from utils import normalize_item_name
+
+    with database.get_db_connection() as conn:
+        conn.executemany(
+            "INSERT INTO users (telegram_id) VALUES (?)",
+            [(1000000 + n,) for n in range(users)],
+        )
+        conn.executemany(
+            "INSERT INTO shopping_lists (name, owner_id) VALUES (?, ?)",
+            [(f"Список {n}", n % users + 1) for n in range(lists)],
+        )
+        conn.executemany(
+            "INSERT INTO list_access (user_id, list_id, role) VALUES (?, ?, ?)",
+            [(n % users + 1, n + 1, "owner") for n in range(lists)],
+        )
+        # Каждый десятый список доступен еще одному пользователю
+        conn.executemany(
+            "INSERT OR IGNORE INTO list_access (user_id, list_id, role) "
+            "VALUES (?, ?, ?)",
+            [((n + 1) % users + 1, n + 1, "editor") for n in range(0, lists, 10)],
+        )
+
+        per_list = max(items // lists, 1)
+        batch = []
+        for n in range(items):
+            list_id = n // per_list % lists + 1
+            name = f"товар {n}"
+            batch.append(
+                (
+                    list_id,
+                    name,
+                    normalize_item_name(name),
+                    n % 5 + 1,
+                    (list_id - 1) % users + 1,
+                )
+            )
+            if len(batch) == 10000:
+                conn.executemany(
+                    "INSERT INTO items (list_id, name, name_key, quantity, added_by) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    batch,
+                )
+                batch = []
+        if batch:
+            conn.executemany(
+                "INSERT INTO items (list_id, name, name_key, quantity, added_by) "
+                "VALUES (?, ?, ?, ?, ?)",
+                batch,
+            )
+        conn.commit()
+
+
+def measure(func, make_args, iterations):
+    latencies = []
+    for _ in range(iterations):
+        args = make_args()
+        started = time.perf_counter_ns()
+        func(*args)
+        latencies.append(time.perf_counter_ns() - started)
+
+    latencies.sort()
+    total = sum(latencies) / 1e9
+
+    def percentile(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] / 1e6
+
+    return {
+        "ops_per_sec": iterations / total if total else 0.0,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+    }
+
+
+def build_callback_router(router):
+    # Таблица с теми же формами аргументов, что и в handlers.py, но с
+    # пустыми обработчиками: измеряется только разбор и диспетчеризация
+    callbacks = router.CallbackRouter()
+    routes = [
+        ("create_list", "c", ()),
+        ("select_list", "s", (int,)),
+        ("view_list", "v", (int, int)),
+        ("add_items", "a", (int,)),
+        ("exit_adding", "x", (int,)),
+        ("delete_single_item", "di", (int,)),
+        ("delete_all", "da", (int,)),
+        ("clear_list", "cl", (int,)),
+        ("invite_user", "i", (int,)),
+        ("back_to_items", "b", (int,)),
+        ("change_list", "ch", ()),
+        ("close", "q", ()),
+    ]
+    for name, code, arg_types in routes:
+        callbacks.register(name, code, lambda *args: None, arg_types)
+    callbacks.register(
+        "delete_items",
+        "d",
+        lambda *args: None,
+        (int, int, str, int, int),
+        required=2,
+    )
+    return callbacks
+
+
+async def storage_session(storage, telegram_id, items):
+    # Сценарий одного пользователя из loadtest.py на уровне хранилища
+    user_id = await storage.create_user(telegram_id)
+    await storage.update_user_activity(telegram_id)
+    await storage.get_user_lists(user_id)
+    list_id = await storage.create_list(f"Список {telegram_id}", user_id)
+    for start in range(0, len(items), 10):
+        await storage.add_items_to_list(list_id, items[start : start + 10], user_id)
+    await storage.get_list_details(list_id, user_id)
+    await storage.get_list_items(list_id)
+
+    cursor = None
+    for _ in range(3):
+        rows, has_more = await storage.get_list_items_page(list_id, cursor)
+        await storage.get_list_item_count(list_id)
+        if not has_more:
+            break
+        cursor = (rows[-1]["created_ts"], rows[-1]["id"])
+    await storage.delete_item(rows[0]["id"])
+
+    token = await storage.get_or_create_invite_token(
+        list_id, user_id, f"token{telegram_id}"
+    )
+    await storage.get_invite_by_token(token)
+    await storage.invite_user_to_list_as_admin(list_id, telegram_id + 1, user_id)
+
+
+def build_benchmarks(database, utils, router, storage, args, rng):
+    counter = iter(range(10**9))
+    item_rows = [{"name": f"товар {n}", "quantity": n % 5 + 1} for n in range(100)]
+    paste = "\n".join(f"товар {n} x{n % 7 + 1}" for n in range(50))
+    huge_paste = "\n".join(f"товар {n} x{n % 7 + 1}" for n in range(10000))
+
+    loop = asyncio.new_event_loop()
+    session_items = [(f"товар {n}", n % 3 + 1) for n in range(30)]
+    engines = {
+        "sqlite": storage.SQLiteStorage(),
+        "memory": storage.MemoryStorage(),
+    }
+
+    def run_session(engine):
+        loop.run_until_complete(
+            storage_session(engines[engine], 2000000 + next(counter), session_items)
+        )
+
+    callbacks = build_callback_router(router)
+    payloads = [
+        callbacks.encode("select_list", 123456),
+        callbacks.encode("view_list", 123456, 3),
+        callbacks.encode("delete_items", 123456, 7, "n", 1792843953, 98765432),
+        callbacks.encode("close"),
+    ]
+    stale = ["delete_items_123456_page_7", "zz:1", "v:1", "s:не число"]
+
+    def random_user():
+        return rng.randrange(args.users) + 1
+
+    def random_list():
+        return rng.randrange(args.lists) + 1
+
+    return {
+        "create_user": (
+            database.create_user,
+            lambda: (1000000 + rng.randrange(args.users),),
+        ),
+        "create_user_uncached": (
+            database.register_user,
+            lambda: (1000000 + rng.randrange(args.users),),
+        ),
+        "get_user_lists": (database.get_user_lists, lambda: (random_user(),)),
+        "get_list_items": (database.get_list_items, lambda: (random_list(),)),
+        "get_list_items_page": (
+            database.get_list_items_page,
+            lambda: (random_list(),),
+        ),
+        "add_item_to_list": (
+            database.add_item_to_list,
+            lambda: (random_list(), f"новый {next(counter)}", 1, random_user()),
+        ),
+        "add_items_to_list_20": (
+            database.add_items_to_list,
+            lambda: (
+                random_list(),
+                [(f"пачка {next(counter)}", 2) for _ in range(20)],
+                random_user(),
+            ),
+        ),
+        "parse_items_50": (utils.parse_items, lambda: (paste,)),
+        "iter_items_10k": (
+            lambda text: list(utils.iter_items(text)),
+            lambda: (huge_paste,),
+        ),
+        "format_items_list_100": (utils.format_items_list, lambda: (item_rows,)),
+        "callback_dispatch": (
+            callbacks.dispatch,
+            lambda: (rng.choice(payloads), None, 0),
+        ),
+        "callback_reject": (callbacks.dispatch, lambda: (rng.choice(stale),)),
+        "storage_session_sqlite": (run_session, lambda: ("sqlite",)),
+        "storage_session_memory": (run_session, lambda: ("memory",)),
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base or not base["ops_per_sec"]:
+            continue
+        ratio = result["ops_per_sec"] / base["ops_per_sec"]
+        if ratio < 1 - threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix="shopping-bench-")
+    os.environ["DATABASE_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ.setdefault("BOT_TOKEN", "benchmark")
+
+    import database
+    import router
+    import storage
+    import utils
+
+    database.init_db()
+    started = time.perf_counter()
+    seed_database(database, args.users, args.lists, args.items)
+    print(
+        f"База заполнена за {time.perf_counter() - started:.1f} с: "
+        f"{args.users} пользователей, {args.lists} списков, {args.items} элементов"
+    )
+    database.warm_user_cache()
+
+    benchmarks = build_benchmarks(database, utils, router, storage, args, rng)
+    if args.only:
+        benchmarks = {name: benchmarks[name] for name in args.only}
+
+    results = {}
+    print(f"{'бенчмарк':<24}{'оп/с':>12}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for name, (func, make_args) in benchmarks.items():
+        result = measure(func, make_args, args.iterations)
+        results[name] = result
+        print(
+            f"{name:<24}{result['ops_per_sec']:>12.1f}{result['p50_ms']:>10.3f}"
+            f"{result['p95_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+        )
+
+    database.close_db_connections()
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Базовая линия сохранена в {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, ratio in regressions:
+            print(f"Регрессия: {name} - {ratio:.0%} от базовой линии")
+        if regressions:
+            sys.exit(1)
+        print("Регрессий не обнаружено")
+
+
+if __name__ == "__main__":
+    main()
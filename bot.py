@@ -3,11 +3,40 @@ from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
-from config import BOT_TOKEN
-from database import init_db
+from config import (
+    BOT_TOKEN,
+    ACTIVITY_FLUSH_INTERVAL,
+    STATE_PURGE_INTERVAL,
+    INVITE_PURGE_INTERVAL,
+    ITEM_PURGE_INTERVAL,
+    VACUUM_INTERVAL,
+    CONCURRENT_UPDATES,
+    RATE_LIMIT_GLOBAL,
+    RATE_LIMIT_PER_CHAT,
+    RATE_LIMIT_CHAT_BURST,
+    RATE_LIMIT_MAX_RETRIES,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_MAX_CONNECTIONS,
+    RECORD_UPDATES_PATH,
+    RECORD_SALT,
+    RECORD_FLUSH_INTERVAL,
+)
+from async_database import STORAGE, shutdown_db_executor, flush_user_activity
+import metrics
+from metrics import instrument_handler
+from outbox import TokenBucketRateLimiter
+from recorder import UpdateRecorder
+from scheduling import KeyedUpdateProcessor, UPDATE_LOCKS
 from handlers import *
 
 logging.basicConfig(
@@ -15,25 +44,186 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+RECORDER = (
+    UpdateRecorder(RECORD_UPDATES_PATH, RECORD_SALT, RECORD_FLUSH_INTERVAL)
+    if RECORD_UPDATES_PATH
+    else None
+)
+
 
-def main():
-    init_db()
+async def flush_recording_job(context):
+    RECORDER.flush()
+
+
+def register_gauges(rate_limiter=None):
+    gauges = [
+        (
+            "bot_user_cache_size",
+            "Размер кэша пользователей",
+            lambda: STORAGE.user_cache_stats()["size"],
+        ),
+        (
+            "bot_user_cache_hits",
+            "Попадания в кэш пользователей",
+            lambda: STORAGE.user_cache_stats()["hits"],
+        ),
+        (
+            "bot_user_cache_misses",
+            "Промахи кэша пользователей",
+            lambda: STORAGE.user_cache_stats()["misses"],
+        ),
+        ("bot_render_cache_size", "Списки в кэше отрисовки", LIST_VIEW_CACHE.__len__),
+        (
+            "bot_render_cache_bytes",
+            "Объем кэша отрисовки",
+            lambda: LIST_VIEW_CACHE.weight,
+        ),
+        (
+            "bot_render_cache_hits",
+            "Попадания в кэш отрисовки",
+            lambda: LIST_VIEW_CACHE.hits,
+        ),
+        (
+            "bot_render_cache_misses",
+            "Промахи кэша отрисовки",
+            lambda: LIST_VIEW_CACHE.misses,
+        ),
+        ("bot_state_store_size", "Состояния в памяти", STATE_STORE.__len__),
+        (
+            "bot_pending_activity",
+            "Несохраненная активность",
+            STORAGE.pending_activity_count,
+        ),
+        ("bot_pending_replies", "Отложенные подтверждения", REPLY_COALESCER.__len__),
+        ("bot_update_locks", "Активные блокировки", UPDATE_LOCKS.__len__),
+    ]
+    if rate_limiter is not None:
+        gauges += [
+            (
+                "bot_api_queue_depth",
+                "Запросы к Bot API в очереди",
+                lambda: rate_limiter.queue_depth,
+            ),
+            (
+                "bot_api_avg_latency_seconds",
+                "Средняя задержка запросов к Bot API",
+                lambda: rate_limiter.stats()["avg_latency"],
+            ),
+        ]
+    for name, documentation, func in gauges:
+        metrics.Gauge(name, documentation, func)
+
+
+async def on_init(application):
+    await metrics.start_server()
+
+
+async def on_stop(application):
+    await REPLY_COALESCER.drain()
+
+
+async def on_shutdown(application):
+    await metrics.stop_server()
+    await flush_user_activity()
+    shutdown_db_executor()
+    STORAGE.close()
+    if RECORDER:
+        RECORDER.close()
+
+
+def build_application(token=BOT_TOKEN, base_url=None, rate_limit=True):
+    # base_url позволяет направить запросы к Bot API на другой сервер,
+    # например на поддельный API нагрузочного теста (loadtest.py)
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(KeyedUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(on_init)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if base_url:
+        builder.base_url(base_url)
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    rate_limiter = None
+    if rate_limit:
+        rate_limiter = TokenBucketRateLimiter(
+            RATE_LIMIT_GLOBAL,
+            RATE_LIMIT_PER_CHAT,
+            RATE_LIMIT_CHAT_BURST,
+            RATE_LIMIT_MAX_RETRIES,
+        )
+        builder.rate_limiter(rate_limiter)
+    if metrics.ENABLED:
+        register_gauges(rate_limiter)
 
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("lists", lists_command))
-    application.add_handler(CommandHandler("items", items_command))
+    application = builder.build()
 
-    application.add_handler(CallbackQueryHandler(button_handler))
+    application.job_queue.run_repeating(
+        flush_activity_job,
+        interval=ACTIVITY_FLUSH_INTERVAL,
+        first=ACTIVITY_FLUSH_INTERVAL,
+    )
+    application.job_queue.run_repeating(
+        purge_states_job, interval=STATE_PURGE_INTERVAL
+    )
+    application.job_queue.run_repeating(
+        purge_invites_job, interval=INVITE_PURGE_INTERVAL
+    )
+    application.job_queue.run_repeating(
+        purge_deleted_items_job, interval=ITEM_PURGE_INTERVAL
+    )
+    application.job_queue.run_repeating(vacuum_job, interval=VACUUM_INTERVAL)
 
+    if RECORDER:
+        # Группа -1 обрабатывается раньше основных обработчиков и не
+        # мешает им получить то же обновление
+        application.add_handler(TypeHandler(Update, RECORDER.record), group=-1)
+        # Запись сбрасывается и тогда, когда новых обновлений нет
+        application.job_queue.run_repeating(
+            flush_recording_job, interval=RECORD_FLUSH_INTERVAL
+        )
+
+    application.add_handler(CommandHandler("start", instrument_handler(start_command)))
+    application.add_handler(CommandHandler("help", instrument_handler(help_command)))
+    application.add_handler(CommandHandler("lists", instrument_handler(lists_command)))
+    application.add_handler(CommandHandler("items", instrument_handler(items_command)))
+
+    application.add_handler(CommandHandler("slowlog", slowlog_command))
+
+    application.add_handler(CallbackQueryHandler(instrument_handler(button_handler)))
     application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
+        InlineQueryHandler(instrument_handler(inline_query_handler))
     )
 
-    logger.info("Бот запущен...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application.add_handler(
+        MessageHandler(
+            filters.TEXT & ~filters.COMMAND, instrument_handler(message_handler)
+        )
+    )
+
+    return application
+
+
+def main():
+    logger.info("Загружено пользователей в кэш: %d", STORAGE.initialize())
+
+    application = build_application()
+
+    if BOT_MODE == "webhook":
+        logger.info("Бот запущен в режиме webhook на порту %d...", WEBHOOK_PORT)
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        logger.info("Бот запущен...")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    # max_weight ограничивает суммарный вес записей (например, объем памяти),
+    # вес каждой записи передается в put
+    def __init__(self, maxsize, max_weight=None):
+        self.maxsize = maxsize
+        self.max_weight = max_weight
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._weights = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, weight=0):
+        with self._lock:
+            self.weight += weight - self._weights.get(key, 0)
+            self._weights[key] = weight
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize or (
+                self.max_weight is not None
+                and self.weight > self.max_weight
+                and len(self._data) > 1
+            ):
+                evicted, _ = self._data.popitem(last=False)
+                self.weight -= self._weights.pop(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self.weight -= self._weights.pop(key, 0)
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weights.clear()
+            self.weight = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "weight": self.weight,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class TTLCache(LRUCache):
+    # LRU-кэш, в котором каждая запись живет не дольше заданного времени
+    def get(self, key, default=None):
+        entry = super().get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        value, deadline = entry
+        if time.monotonic() >= deadline:
+            self.pop(key)
+            return default
+        return value
+
+    def put(self, key, value, ttl, weight=0):
+        if ttl <= 0:
+            self.pop(key)
+            return
+        super().put(key, (value, time.monotonic() + ttl), weight)
@@ -17,6 +17,9 @@ BOT_USERNAME = os.getenv("BOT_USERNAME", "grocery_list_rotor_bot")
 # Максимальная длина названия списка/элемента
 MAX_NAME_LENGTH = 100
 
+# Максимальное число элементов, добавляемых одним сообщением
+MAX_ITEMS_PER_MESSAGE = int(os.getenv("MAX_ITEMS_PER_MESSAGE", "500"))
+
 # Роли пользователей
 ROLE_OWNER = "owner"
 ROLE_EDITOR = "editor"
@@ -29,3 +32,123 @@ COMMAND_HELP = "/help"
 
 
 ITEMS_PER_PAGE = 10
+
+# Количество потоков для выполнения запросов к базе данных
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+
+# Настройки соединений с SQLite
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+
+# Размер кэша соответствия telegram_id -> id пользователя
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "100000"))
+
+# Интервал записи времени активности пользователей в базу (в секундах)
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "30"))
+
+# Кэш отрисованных списков: число записей и суммарный объем в байтах
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "1000"))
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Настройки webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError(f"Неизвестный режим работы бота: {BOT_MODE}")
+if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+    raise ValueError("Для режима webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+
+# Хранилище данных: sqlite или memory (все в памяти, для тестов и нагрузки)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+
+# Хранилище состояний диалогов: memory или sqlite
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+# Время жизни неактивного состояния (в секундах) и размер кэша состояний
+STATE_TTL = int(os.getenv("STATE_TTL", str(24 * 60 * 60)))
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "100000"))
+# Интервал удаления устаревших состояний (в секундах)
+STATE_PURGE_INTERVAL = int(os.getenv("STATE_PURGE_INTERVAL", "3600"))
+# Как часто (в секундах) обращение к состоянию продлевает его updated_at
+STATE_TOUCH_INTERVAL = int(os.getenv("STATE_TOUCH_INTERVAL", "300"))
+
+# Максимальное число одновременно обрабатываемых обновлений
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+
+# Окно объединения подтверждений в режиме добавления (в секундах, 0 - отключено)
+REPLY_COALESCE_WINDOW = float(os.getenv("REPLY_COALESCE_WINDOW", "1.0"))
+# Ограничения частоты запросов к Bot API (в запросах в секунду)
+RATE_LIMIT_GLOBAL = float(os.getenv("RATE_LIMIT_GLOBAL", "30"))
+RATE_LIMIT_PER_CHAT = float(os.getenv("RATE_LIMIT_PER_CHAT", "1"))
+RATE_LIMIT_CHAT_BURST = int(os.getenv("RATE_LIMIT_CHAT_BURST", "5"))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "3"))
+
+# Максимальная длина списка элементов на одной странице сообщения
+# (ограничение Telegram - 4096 символов вместе с заголовком и разметкой)
+MESSAGE_ITEMS_CHAR_LIMIT = int(os.getenv("MESSAGE_ITEMS_CHAR_LIMIT", "3500"))
+# Сколько элементов выбирается за раз при построении страницы списка
+LIST_VIEW_FETCH_SIZE = int(os.getenv("LIST_VIEW_FETCH_SIZE", "200"))
+# Размер кэша отформатированных строк элементов
+ITEM_LINE_CACHE_SIZE = int(os.getenv("ITEM_LINE_CACHE_SIZE", "100000"))
+
+# Порт HTTP-сервера метрик Prometheus (0 - метрики отключены)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Сбор метрик без HTTP-сервера (используется replay.py)
+METRICS_COLLECT = os.getenv("METRICS_COLLECT", "0") == "1"
+
+# Порог медленного запроса к базе в миллисекундах (0 - замеры отключены)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0"))
+
+# Telegram ID администраторов через запятую
+ADMIN_IDS = {
+    int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id
+}
+
+# Приглашения: размер и время жизни кэша (в секундах), минимальный
+# оставшийся срок действия для повторного использования ссылки
+INVITE_CACHE_SIZE = int(os.getenv("INVITE_CACHE_SIZE", "10000"))
+INVITE_CACHE_TTL = int(os.getenv("INVITE_CACHE_TTL", "600"))
+INVITE_REUSE_MIN_TTL = int(os.getenv("INVITE_REUSE_MIN_TTL", str(24 * 60 * 60)))
+# Очистка устаревших приглашений: интервал (в секундах) и размер пачек
+INVITE_PURGE_INTERVAL = int(os.getenv("INVITE_PURGE_INTERVAL", "3600"))
+INVITE_PURGE_BATCH = int(os.getenv("INVITE_PURGE_BATCH", "500"))
+INVITE_PURGE_MAX_BATCHES = int(os.getenv("INVITE_PURGE_MAX_BATCHES", "20"))
+
+# Запись входящих обновлений для replay.py (пустой путь - запись отключена).
+# Соль нужна для обезличивания id и токенов, та же соль передается replay.py
+RECORD_UPDATES_PATH = os.getenv("RECORD_UPDATES_PATH", "")
+RECORD_SALT = os.getenv("RECORD_SALT", "")
+if RECORD_UPDATES_PATH and not RECORD_SALT:
+    raise ValueError("Для записи обновлений нужна RECORD_SALT")
+# Как часто (в секундах) запись сбрасывается на диск
+RECORD_FLUSH_INTERVAL = int(os.getenv("RECORD_FLUSH_INTERVAL", "10"))
+
+# Очистка списков: начиная с этого числа элементов они только помечаются
+# удаленными, а строки удаляются фоновой задачей пачками
+CLEAR_SOFT_DELETE_MIN = int(os.getenv("CLEAR_SOFT_DELETE_MIN", "200"))
+ITEM_PURGE_INTERVAL = int(os.getenv("ITEM_PURGE_INTERVAL", "60"))
+ITEM_PURGE_BATCH = int(os.getenv("ITEM_PURGE_BATCH", "1000"))
+ITEM_PURGE_MAX_BATCHES = int(os.getenv("ITEM_PURGE_MAX_BATCHES", "20"))
+# Возврат свободных страниц файлу базы: интервал (в секундах), число
+# страниц за один шаг и максимум шагов за запуск
+VACUUM_INTERVAL = int(os.getenv("VACUUM_INTERVAL", "600"))
+VACUUM_PAGES_PER_STEP = int(os.getenv("VACUUM_PAGES_PER_STEP", "256"))
+VACUUM_MAX_STEPS = int(os.getenv("VACUUM_MAX_STEPS", "40"))
+
+# Подсказки названий в inline-режиме: число вариантов, размер кэша
+# популярных префиксов и время жизни записи (в секундах). То же время
+# передается Telegram как cache_time ответа
+SUGGEST_LIMIT = int(os.getenv("SUGGEST_LIMIT", "10"))
+SUGGEST_CACHE_SIZE = int(os.getenv("SUGGEST_CACHE_SIZE", "10000"))
+SUGGEST_CACHE_TTL = int(os.getenv("SUGGEST_CACHE_TTL", "30"))
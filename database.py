@@ -1,29 +1,264 @@
+import logging
+import queue
 import sqlite3
+import threading
+import time
 from contextlib import contextmanager
 from datetime import datetime
-from config import DATABASE_PATH
+from cache import LRUCache, TTLCache
+from migrations import apply_migrations, find_unindexed_plans
+from query_trace import SlowQueryLog, tracing_connection_factory
+from utils import normalize_item_name, suggest_key
+from config import (
+    DATABASE_PATH,
+    DB_JOURNAL_MODE,
+    DB_SYNCHRONOUS,
+    DB_CACHE_SIZE_KB,
+    DB_BUSY_TIMEOUT_MS,
+    DB_READ_POOL_SIZE,
+    USER_CACHE_SIZE,
+    ITEMS_PER_PAGE,
+    SLOW_QUERY_MS,
+    INVITE_CACHE_SIZE,
+    INVITE_CACHE_TTL,
+    INVITE_REUSE_MIN_TTL,
+    CLEAR_SOFT_DELETE_MIN,
+    SUGGEST_CACHE_SIZE,
+    SUGGEST_CACHE_TTL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Журнал медленных запросов, SLOW_QUERY_MS = 0 отключает замеры
+SLOW_QUERY_LOG = SlowQueryLog(SLOW_QUERY_MS) if SLOW_QUERY_MS > 0 else None
+_connection_factory = (
+    tracing_connection_factory(SLOW_QUERY_LOG) if SLOW_QUERY_LOG else sqlite3.Connection
+)
+
+
+def _open_connection():
+    conn = sqlite3.connect(
+        DATABASE_PATH,
+        check_same_thread=False,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        factory=_connection_factory,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+class ConnectionPool:
+    # Одно соединение для записи и несколько для чтения:
+    # в режиме WAL читатели не ждут завершения транзакций писателя
+    def __init__(self, read_pool_size):
+        self._lock = threading.Lock()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._readers = queue.LifoQueue()
+        self._read_pool_size = read_pool_size
+        self._opened_readers = 0
+        self._all = []
+
+    def _track(self, conn):
+        self._all.append(conn)
+        return conn
+
+    @contextmanager
+    def writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                with self._lock:
+                    self._writer = self._track(_open_connection())
+            conn = self._writer
+            try:
+                yield conn
+            finally:
+                # Незакоммиченные изменения отменяются, как и при закрытии
+                # соединения раньше
+                if conn.in_transaction:
+                    conn.rollback()
+
+    @contextmanager
+    def reader(self):
+        conn = None
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._opened_readers < self._read_pool_size:
+                    self._opened_readers += 1
+                    conn = self._track(_open_connection())
+        if conn is None:
+            conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+            self._writer = None
+            self._readers = queue.LifoQueue()
+            self._opened_readers = 0
+
+
+_pool = ConnectionPool(DB_READ_POOL_SIZE)
+
+# Пользователи не удаляются, поэтому соответствие telegram_id -> id
+# можно кэшировать без инвалидации
+USER_ID_CACHE = LRUCache(USER_CACHE_SIZE)
+
+# Недавно выданные и использованные приглашения: ссылка, разосланная
+# в большую группу, не должна каждый раз обращаться к базе
+INVITE_CACHE = TTLCache(INVITE_CACHE_SIZE)
+
+# Подсказки по популярным префиксам. Новые названия появляются в них
+# не позже чем через SUGGEST_CACHE_TTL секунд
+SUGGEST_CACHE = TTLCache(SUGGEST_CACHE_SIZE)
+
+# Версия списка увеличивается при каждом изменении его элементов
+# и служит ключом кэша отрисованных списков
+_list_versions = {}
+_versions_lock = threading.Lock()
+
+
+def get_list_version(list_id):
+    return _list_versions.get(list_id, 0)
+
+
+def bump_list_version(list_id):
+    with _versions_lock:
+        _list_versions[list_id] = _list_versions.get(list_id, 0) + 1
 
 
 @contextmanager
-def get_db_connection():
-    conn = None
-    try:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
+def get_db_connection(readonly=False):
+    context = _pool.reader() if readonly else _pool.writer()
+    with context as conn:
         yield conn
-    except Exception as e:
-        if conn:
-            conn.rollback()
-        raise e
-    finally:
-        if conn:
-            conn.close()
+
+
+def close_db_connections():
+    _pool.close()
+
+
+# Запросы, выполняемые на каждое обновление. Их планы проверяются
+# при запуске, см. _hot_queries
+USER_LISTS_SQL = """
+    SELECT sl.id, sl.name, sl.owner_id,
+           CASE WHEN sl.owner_id = ? THEN 'owner' ELSE la.role END as user_role
+    FROM shopping_lists sl
+    LEFT JOIN list_access la ON sl.id = la.list_id AND la.user_id = ?
+    WHERE sl.id IN (
+        SELECT id FROM shopping_lists WHERE owner_id = ?
+        UNION
+        SELECT list_id FROM list_access WHERE user_id = ?
+    )
+    ORDER BY sl.created_at DESC
+"""
+
+LIST_DETAILS_SQL = """
+    SELECT sl.id, sl.name, sl.owner_id, u.telegram_id as owner_telegram_id
+    FROM shopping_lists sl
+    JOIN users u ON sl.owner_id = u.id
+    LEFT JOIN list_access la ON sl.id = la.list_id AND la.user_id = ?
+    WHERE sl.id = ? AND (sl.owner_id = ? OR la.user_id IS NOT NULL)
+"""
+
+LIST_ITEMS_SQL = """
+    SELECT id, name, quantity
+    FROM items
+    WHERE list_id = ? AND deleted = 0
+    ORDER BY created_at, id
+"""
+
+LIST_ITEMS_AFTER_SQL = """
+    SELECT id, name, quantity, CAST(strftime('%s', created_at) AS INTEGER) as created_ts
+    FROM items
+    WHERE list_id = ? AND deleted = 0
+          AND (created_at, id) > (datetime(?, 'unixepoch'), ?)
+    ORDER BY created_at, id
+    LIMIT ?
+"""
+
+LIST_ITEMS_BEFORE_SQL = """
+    SELECT id, name, quantity, CAST(strftime('%s', created_at) AS INTEGER) as created_ts
+    FROM items
+    WHERE list_id = ? AND deleted = 0
+          AND (created_at, id) < (datetime(?, 'unixepoch'), ?)
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?
+"""
+
+INVITE_BY_TOKEN_SQL = """
+    SELECT list_id, owner_id, CAST(strftime('%s', expires_at) AS INTEGER) as expires_ts
+    FROM invites
+    WHERE token = ? AND used = 0 AND expires_at > datetime('now')
+"""
+
+REUSABLE_INVITE_SQL = """
+    SELECT token, CAST(strftime('%s', expires_at) AS INTEGER) as expires_ts
+    FROM invites
+    WHERE list_id = ? AND owner_id = ? AND used = 0
+          AND expires_at > datetime('now', ?)
+    ORDER BY expires_at DESC
+    LIMIT 1
+"""
+
+SUGGEST_ITEMS_SQL = """
+    SELECT item_history.name
+    FROM item_history_fts
+    JOIN item_history ON item_history.id = item_history_fts.rowid
+    WHERE item_history_fts MATCH ?
+    ORDER BY item_history.uses DESC, item_history.last_used DESC
+    LIMIT ?
+"""
+
+RECENT_ITEMS_SQL = """
+    SELECT name FROM item_history
+    WHERE user_id = ?
+    ORDER BY uses DESC, last_used DESC
+    LIMIT ?
+"""
+
+
+def _hot_queries():
+    return {
+        "get_user_lists": (USER_LISTS_SQL, (0, 0, 0, 0)),
+        "get_list_details": (LIST_DETAILS_SQL, (0, 0, 0)),
+        "get_list_items": (LIST_ITEMS_SQL, (0,)),
+        "get_list_items_page": (LIST_ITEMS_AFTER_SQL, (0, 0, 0, 1)),
+        "get_list_items_page_back": (LIST_ITEMS_BEFORE_SQL, (0, 0, 0, 1)),
+        "get_invite_by_token": (INVITE_BY_TOKEN_SQL, ("",)),
+        "get_or_create_invite_token": (REUSABLE_INVITE_SQL, (0, 0, "+0 seconds")),
+        "suggest_items": (SUGGEST_ITEMS_SQL, ('owner:u0 AND name:"a"*', 1)),
+        "suggest_items_recent": (RECENT_ITEMS_SQL, (0, 1)),
+    }
 
 
 def init_db():
     with get_db_connection() as conn:
         cursor = conn.cursor()
 
+        # После переключения journal_mode файл уже не пустой, поэтому
+        # auto_vacuum вступает в силу только после VACUUM. Для существующей
+        # базы это разовая перестройка файла целиком
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logger.info("Перестройка базы для auto_vacuum = INCREMENTAL")
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+
         cursor.execute(
             """
             CREATE TABLE IF NOT EXISTS users (
@@ -95,8 +330,20 @@ def init_db():
 
         conn.commit()
 
+        apply_migrations(conn)
+
+        for name, scans in find_unindexed_plans(conn, _hot_queries()).items():
+            logger.warning("Запрос %s не использует индекс: %s", name, scans)
+
 
 def create_user(telegram_id):
+    user_id = USER_ID_CACHE.get(telegram_id)
+    if user_id is not None:
+        return user_id
+    return register_user(telegram_id)
+
+
+def register_user(telegram_id):
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
@@ -109,35 +356,93 @@ def create_user(telegram_id):
 
         cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
         result = cursor.fetchone()
-        return result["id"] if result else None
+        if not result:
+            return None
 
+        USER_ID_CACHE.put(telegram_id, result["id"])
+        return result["id"]
 
-def update_user_activity(telegram_id):
-    with get_db_connection() as conn:
+
+def warm_user_cache():
+    with get_db_connection(readonly=True) as conn:
         cursor = conn.cursor()
         cursor.execute(
             """
-            UPDATE users SET last_active = ? WHERE telegram_id = ?
+            SELECT id, telegram_id FROM users
+            ORDER BY last_active DESC
+            LIMIT ?
         """,
-            (datetime.now(), telegram_id),
+            (USER_ID_CACHE.maxsize,),
         )
-        conn.commit()
+        rows = cursor.fetchall()
+
+    # Самые активные пользователи добавляются последними и вытесняются позже всех
+    for row in reversed(rows):
+        USER_ID_CACHE.put(row["telegram_id"], row["id"])
+    return len(rows)
+
+
+class ActivityBuffer:
+    # Время последней активности копится в памяти и записывается пачкой,
+    # несколько обновлений одного пользователя схлопываются в одно
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def touch(self, telegram_id, when):
+        with self._lock:
+            self._pending[telegram_id] = when
+
+    def drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, pending):
+        with self._lock:
+            for telegram_id, when in pending.items():
+                self._pending.setdefault(telegram_id, when)
+
+    def __len__(self):
+        return len(self._pending)
+
+
+_activity = ActivityBuffer()
+
+
+def update_user_activity(telegram_id):
+    _activity.touch(telegram_id, datetime.now())
+
+
+def flush_user_activity():
+    pending = _activity.drain()
+    if not pending:
+        return 0
+
+    try:
+        with get_db_connection() as conn:
+            conn.executemany(
+                """
+                UPDATE users SET last_active = ? WHERE telegram_id = ?
+            """,
+                [(when, telegram_id) for telegram_id, when in pending.items()],
+            )
+            conn.commit()
+    except Exception:
+        _activity.restore(pending)
+        raise
+
+    return len(pending)
+
+
+def pending_activity_count():
+    return len(_activity)
 
 
 def get_user_lists(user_id):
-    with get_db_connection() as conn:
+    with get_db_connection(readonly=True) as conn:
         cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT sl.id, sl.name, sl.owner_id, 
-                   CASE WHEN sl.owner_id = ? THEN 'owner' ELSE la.role END as user_role
-            FROM shopping_lists sl
-            LEFT JOIN list_access la ON sl.id = la.list_id AND la.user_id = ?
-            WHERE sl.owner_id = ? OR la.user_id = ?
-            ORDER BY sl.created_at DESC
-        """,
-            (user_id, user_id, user_id, user_id),
-        )
+        cursor.execute(USER_LISTS_SQL, (user_id, user_id, user_id, user_id))
         return cursor.fetchall()
 
 
@@ -164,101 +469,206 @@ def create_list(name, owner_id):
 
 
 def delete_list(list_id, user_id):
+    # Элементы, доступы и приглашения удаляются каскадно
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
-            """
-            SELECT owner_id FROM shopping_lists WHERE id = ?
-        """,
-            (list_id,),
+            "DELETE FROM shopping_lists WHERE id = ? AND owner_id = ?",
+            (list_id, user_id),
         )
-        result = cursor.fetchone()
+        conn.commit()
 
-        if result and result["owner_id"] == user_id:
-            cursor.execute("DELETE FROM items WHERE list_id = ?", (list_id,))
-            cursor.execute("DELETE FROM list_access WHERE list_id = ?", (list_id,))
-            cursor.execute("DELETE FROM shopping_lists WHERE id = ?", (list_id,))
-            conn.commit()
-            return True
+    if not cursor.rowcount:
         return False
+    bump_list_version(list_id)
+    INVITE_CACHE.clear()
+    return True
 
 
 def get_list_details(list_id, user_id):
-    with get_db_connection() as conn:
+    with get_db_connection(readonly=True) as conn:
         cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT sl.id, sl.name, sl.owner_id, u.telegram_id as owner_telegram_id
-            FROM shopping_lists sl
-            JOIN users u ON sl.owner_id = u.id
-            LEFT JOIN list_access la ON sl.id = la.list_id AND la.user_id = ?
-            WHERE sl.id = ? AND (sl.owner_id = ? OR la.user_id IS NOT NULL)
-        """,
-            (user_id, list_id, user_id),
-        )
+        cursor.execute(LIST_DETAILS_SQL, (user_id, list_id, user_id))
         return cursor.fetchone()
 
 
 def get_list_items(list_id):
-    with get_db_connection() as conn:
+    with get_db_connection(readonly=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(LIST_ITEMS_SQL, (list_id,))
+        return cursor.fetchall()
+
+
+def get_list_items_page(list_id, cursor=None, backward=False, limit=ITEMS_PER_PAGE):
+    # Постраничная выборка по ключу (created_at, id). cursor - пара
+    # (created_ts, id) крайнего элемента соседней страницы. Возвращает
+    # элементы страницы и признак наличия элементов дальше в том же направлении
+    created_ts, item_id = cursor if cursor else (0, 0)
+    sql = LIST_ITEMS_BEFORE_SQL if backward else LIST_ITEMS_AFTER_SQL
+
+    with get_db_connection(readonly=True) as conn:
+        rows = conn.execute(sql, (list_id, created_ts, item_id, limit + 1)).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+
+def get_list_item_count(list_id):
+    with get_db_connection(readonly=True) as conn:
         cursor = conn.cursor()
         cursor.execute(
-            """
-            SELECT id, name, quantity 
-            FROM items 
-            WHERE list_id = ? 
-            ORDER BY created_at
-        """,
-            (list_id,),
+            "SELECT item_count FROM shopping_lists WHERE id = ?", (list_id,)
         )
-        return cursor.fetchall()
+        result = cursor.fetchone()
+        return result["item_count"] if result else 0
 
 
 def add_item_to_list(list_id, item_name, quantity, user_id):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
+    add_items_to_list(list_id, [(item_name, quantity)], user_id)
 
-        cursor.execute(
+
+def add_items_to_list(list_id, items, user_id):
+    # Одинаковые по normalize_item_name названия объединяются, остается
+    # написание, добавленное первым
+    merged = {}
+    for item_name, quantity in items:
+        name_key = normalize_item_name(item_name)
+        if name_key in merged:
+            item_name, total = merged[name_key]
+            quantity += total
+        merged[name_key] = (item_name, quantity)
+
+    if not merged:
+        return 0
+
+    with get_db_connection() as conn:
+        conn.executemany(
             """
-            SELECT id, quantity FROM items 
-            WHERE list_id = ? AND name = ?
+            INSERT INTO items (list_id, name, name_key, quantity, added_by)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (list_id, name_key) WHERE deleted = 0
+            DO UPDATE SET quantity = quantity + excluded.quantity
         """,
-            (list_id, item_name),
+            [
+                (list_id, item_name, name_key, quantity, user_id)
+                for name_key, (item_name, quantity) in merged.items()
+            ],
+        )
+        # Использование засчитывается и тогда, когда элемент уже был в списке
+        conn.executemany(
+            """
+            INSERT INTO item_history (user_id, name, name_key)
+            VALUES (?, ?, ?)
+            ON CONFLICT (user_id, name_key)
+            DO UPDATE SET uses = uses + 1, last_used = CURRENT_TIMESTAMP
+        """,
+            [
+                (user_id, item_name, name_key)
+                for name_key, (item_name, _) in merged.items()
+            ],
         )
-        existing_item = cursor.fetchone()
-
-        if existing_item:
-            new_quantity = existing_item["quantity"] + quantity
-            cursor.execute(
-                """
-                UPDATE items SET quantity = ? WHERE id = ?
-            """,
-                (new_quantity, existing_item["id"]),
-            )
-        else:
-            cursor.execute(
-                """
-                INSERT INTO items (list_id, name, quantity, added_by) 
-                VALUES (?, ?, ?, ?)
-            """,
-                (list_id, item_name, quantity, user_id),
-            )
-
         conn.commit()
+    bump_list_version(list_id)
+
+    return len(merged)
 
 
 def delete_item(item_id):
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        cursor.execute("SELECT list_id FROM items WHERE id = ?", (item_id,))
+        result = cursor.fetchone()
         cursor.execute("DELETE FROM items WHERE id = ?", (item_id,))
         conn.commit()
 
+    if result:
+        bump_list_version(result["list_id"])
+
 
 def clear_list_items(list_id):
+    # Большие списки очищаются пометкой deleted = 1, сами строки удаляет
+    # purge_deleted_items в фоне небольшими пачками
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM items WHERE list_id = ?", (list_id,))
+        cursor.execute(
+            "SELECT item_count FROM shopping_lists WHERE id = ?", (list_id,)
+        )
+        result = cursor.fetchone()
+        if result and result["item_count"] >= CLEAR_SOFT_DELETE_MIN:
+            cursor.execute(
+                "UPDATE items SET deleted = 1 WHERE list_id = ? AND deleted = 0",
+                (list_id,),
+            )
+            cursor.execute(
+                "UPDATE shopping_lists SET item_count = 0 WHERE id = ?", (list_id,)
+            )
+        else:
+            cursor.execute(
+                "DELETE FROM items WHERE list_id = ? AND deleted = 0", (list_id,)
+            )
         conn.commit()
+    bump_list_version(list_id)
+
+
+def purge_deleted_items(batch_size, max_batches):
+    deleted = 0
+    for _ in range(max_batches):
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                DELETE FROM items WHERE id IN (
+                    SELECT id FROM items WHERE deleted = 1 LIMIT ?
+                )
+            """,
+                (batch_size,),
+            )
+            conn.commit()
+        deleted += cursor.rowcount
+        if cursor.rowcount < batch_size:
+            break
+    return deleted
+
+
+def reclaim_free_pages(pages_per_step, max_steps):
+    # Возврат свободных страниц файлу по частям, каждая часть - отдельная
+    # короткая запись (требует auto_vacuum = INCREMENTAL, см. init_db)
+    reclaimed = 0
+    for _ in range(max_steps):
+        with get_db_connection() as conn:
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free:
+                break
+            # execute() выполняет только первый шаг прагмы, то есть
+            # освобождает одну страницу, executescript - все
+            conn.executescript(f"PRAGMA incremental_vacuum({pages_per_step});")
+            reclaimed += free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return reclaimed
+
+
+def suggest_items(user_id, text, limit):
+    key = suggest_key(user_id, text)
+    names = SUGGEST_CACHE.get(key)
+    if names is not None:
+        return names[:limit]
+
+    _, prefix = key
+    with get_db_connection(readonly=True) as conn:
+        if prefix:
+            match = " AND ".join(
+                [f"owner:u{user_id}"]
+                + [f'name:"{word}"*' for word in prefix.split()]
+            )
+            rows = conn.execute(SUGGEST_ITEMS_SQL, (match, limit)).fetchall()
+        else:
+            rows = conn.execute(RECENT_ITEMS_SQL, (user_id, limit)).fetchall()
+
+    names = [row["name"] for row in rows]
+    SUGGEST_CACHE.put(key, names, SUGGEST_CACHE_TTL)
+    return names
 
 
 def invite_user_to_list(list_id, user_telegram_id, inviter_id):
@@ -309,7 +719,7 @@ def invite_user_to_list(list_id, user_telegram_id, inviter_id):
 
 
 def get_list_owner(list_id):
-    with get_db_connection() as conn:
+    with get_db_connection(readonly=True) as conn:
         cursor = conn.cursor()
         cursor.execute(
             """
@@ -323,6 +733,14 @@ def get_list_owner(list_id):
         return result["telegram_id"] if result else None
 
 
+def _cache_invite(token, list_id, owner_id, expires_ts):
+    INVITE_CACHE.put(
+        token,
+        {"list_id": list_id, "owner_id": owner_id},
+        min(INVITE_CACHE_TTL, expires_ts - time.time()),
+    )
+
+
 def save_invite_token(token, list_id, owner_id):
     with get_db_connection() as conn:
         cursor = conn.cursor()
@@ -335,17 +753,48 @@ def save_invite_token(token, list_id, owner_id):
         conn.commit()
 
 
-def get_invite_by_token(token):
+def get_or_create_invite_token(list_id, owner_id, new_token):
+    # Действующее приглашение переиспользуется, если до его истечения
+    # осталось не меньше INVITE_REUSE_MIN_TTL секунд
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        cursor.execute(
+            REUSABLE_INVITE_SQL,
+            (list_id, owner_id, f"+{INVITE_REUSE_MIN_TTL} seconds"),
+        )
+        result = cursor.fetchone()
+        if result:
+            _cache_invite(result["token"], list_id, owner_id, result["expires_ts"])
+            return result["token"]
+
         cursor.execute(
             """
-            SELECT list_id, owner_id FROM invites 
-            WHERE token = ? AND used = 0 AND expires_at > datetime('now')
+            INSERT INTO invites (token, list_id, owner_id) VALUES (?, ?, ?)
+            RETURNING CAST(strftime('%s', expires_at) AS INTEGER) as expires_ts
         """,
-            (token,),
+            (new_token, list_id, owner_id),
         )
-        return cursor.fetchone()
+        expires_ts = cursor.fetchone()["expires_ts"]
+        conn.commit()
+
+    _cache_invite(new_token, list_id, owner_id, expires_ts)
+    return new_token
+
+
+def get_invite_by_token(token):
+    invite = INVITE_CACHE.get(token)
+    if invite is not None:
+        return invite
+
+    with get_db_connection(readonly=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(INVITE_BY_TOKEN_SQL, (token,))
+        result = cursor.fetchone()
+
+    if not result:
+        return None
+    _cache_invite(token, result["list_id"], result["owner_id"], result["expires_ts"])
+    return result
 
 
 def mark_invite_used(token):
@@ -358,6 +807,30 @@ def mark_invite_used(token):
             (token,),
         )
         conn.commit()
+    INVITE_CACHE.pop(token)
+
+
+def purge_invites(batch_size, max_batches):
+    # Удаление использованных и истекших приглашений небольшими пачками,
+    # чтобы не держать блокировку записи долго
+    deleted = 0
+    for condition in ("expires_at <= datetime('now')", "used = 1"):
+        for _ in range(max_batches):
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    f"""
+                    DELETE FROM invites WHERE id IN (
+                        SELECT id FROM invites WHERE {condition} LIMIT ?
+                    )
+                """,
+                    (batch_size,),
+                )
+                conn.commit()
+            deleted += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                break
+    return deleted
 
 
 def invite_user_to_list_as_admin(list_id, user_telegram_id, inviter_id):
@@ -396,3 +869,60 @@ def invite_user_to_list_as_admin(list_id, user_telegram_id, inviter_id):
 
         conn.commit()
         return True, "Пользователь успешно приглашен как администратор"
+
+
+def load_user_state(user_id, max_age):
+    # Кроме состояния возвращается возраст updated_at в секундах
+    with get_db_connection(readonly=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT state, list_id,
+                   CAST(strftime('%s', 'now') - strftime('%s', updated_at)
+                        AS INTEGER) AS age
+            FROM user_states
+            WHERE user_id = ? AND updated_at > datetime('now', ?)
+        """,
+            (user_id, f"-{int(max_age)} seconds"),
+        )
+        result = cursor.fetchone()
+        return tuple(result) if result else None
+
+
+def touch_user_state(user_id):
+    with get_db_connection() as conn:
+        conn.execute(
+            "UPDATE user_states SET updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
+            (user_id,),
+        )
+        conn.commit()
+
+
+def save_user_state(user_id, state, list_id):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if state is None and list_id is None:
+            cursor.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+        else:
+            cursor.execute(
+                """
+                INSERT INTO user_states (user_id, state, list_id) VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    state = excluded.state,
+                    list_id = excluded.list_id,
+                    updated_at = CURRENT_TIMESTAMP
+            """,
+                (user_id, state, list_id),
+            )
+        conn.commit()
+
+
+def purge_user_states(max_age):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM user_states WHERE updated_at <= datetime('now', ?)",
+            (f"-{int(max_age)} seconds",),
+        )
+        conn.commit()
+        return cursor.rowcount
@@ -1,13 +1,34 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+)
 from telegram.ext import ContextTypes
+import sys
 import uuid
 import hashlib
-from database import *
-from utils import parse_items, format_items_list, format_lists_menu
+from async_database import *
+from cache import LRUCache
+from metrics import label_action
+from query_trace import format_report
+from outbox import ReplyCoalescer
+from router import CallbackRouter
+from scheduling import list_lock
+from state_store import create_state_store
+from telegram.helpers import escape_markdown
+from utils import (
+    parse_items,
+    format_item_line,
+    format_items_page,
+    format_list_title,
+    format_lists_menu,
+    page_char_limit,
+    paginate_lines,
+)
 from config import *
 
-USER_STATES = {}
-USER_CURRENT_LISTS = {}
 
 STATE_WAITING_FOR_LIST_NAME = "waiting_for_list_name"
 STATE_WAITING_FOR_ITEMS = "waiting_for_items"
@@ -15,6 +36,14 @@ STATE_WAITING_FOR_INVITE = "waiting_for_invite"
 STATE_SELECTING_LIST = "selecting_list"
 STATE_CONTINUOUS_ADDING = "continuous_adding"
 
+STATE_STORE = create_state_store(STORAGE)
+ROUTER = CallbackRouter()
+REPLY_COALESCER = ReplyCoalescer(REPLY_COALESCE_WINDOW)
+
+LIST_VIEW_CACHE = LRUCache(RENDER_CACHE_SIZE, max_weight=RENDER_CACHE_MAX_BYTES)
+# Примерный объем клавиатуры списка в памяти
+VIEW_MARKUP_WEIGHT = 2048
+
 
 def generate_invite_token(list_id, owner_id):
     data = f"{list_id}_{owner_id}_{uuid.uuid4()}"
@@ -22,24 +51,208 @@ def generate_invite_token(list_id, owner_id):
     return token
 
 
+async def flush_activity_job(context: ContextTypes.DEFAULT_TYPE):
+    await flush_user_activity()
+
+
+def list_menu_keyboard(list_id, page=0, has_next=False):
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                "➕ Добавить элементы", callback_data=ROUTER.encode("add_items", list_id)
+            )
+        ],
+        [
+            InlineKeyboardButton(
+                "🗑 Удалить элементы",
+                callback_data=ROUTER.encode("delete_items", list_id, 0),
+            )
+        ],
+        [
+            InlineKeyboardButton(
+                "🧨 Очистить список", callback_data=ROUTER.encode("clear_list", list_id)
+            )
+        ],
+        [
+            InlineKeyboardButton(
+                "👥 Пригласить пользователя",
+                callback_data=ROUTER.encode("invite_user", list_id),
+            )
+        ],
+        [
+            InlineKeyboardButton(
+                "🔄 Сменить список", callback_data=ROUTER.encode("change_list")
+            )
+        ],
+        [InlineKeyboardButton("❌ Закрыть", callback_data=ROUTER.encode("close"))],
+    ]
+
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(
+            InlineKeyboardButton(
+                "⬅️ Назад", callback_data=ROUTER.encode("view_list", list_id, page - 1)
+            )
+        )
+    if has_next:
+        nav_buttons.append(
+            InlineKeyboardButton(
+                "➡️ Далее", callback_data=ROUTER.encode("view_list", list_id, page + 1)
+            )
+        )
+    if nav_buttons:
+        keyboard.insert(0, nav_buttons)
+
+    return InlineKeyboardMarkup(keyboard)
+
+
+def lists_keyboard(lists, create_label):
+    keyboard = [
+        [InlineKeyboardButton(create_label, callback_data=ROUTER.encode("create_list"))]
+    ]
+
+    for lst in lists:
+        role_icon = "👑" if lst["user_role"] == "owner" else "👥"
+        keyboard.append(
+            [
+                InlineKeyboardButton(
+                    f"{role_icon} {lst['name']}",
+                    callback_data=ROUTER.encode("select_list", lst["id"]),
+                )
+            ]
+        )
+
+    keyboard.append(
+        [InlineKeyboardButton("❌ Закрыть", callback_data=ROUTER.encode("close"))]
+    )
+    return InlineKeyboardMarkup(keyboard)
+
+
+def exit_adding_keyboard(list_id):
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    "🚪 Выйти из режима добавления",
+                    callback_data=ROUTER.encode("exit_adding", list_id),
+                )
+            ]
+        ]
+    )
+
+
+async def _fetch_view_page(view, list_id, page):
+    # Строки страницы выбираются по ключу с начала страницы порциями по
+    # LIST_VIEW_FETCH_SIZE, пока страница не заполнится. Возвращает строки
+    # и курсор начала следующей страницы (None для последней)
+    cursor = view["cursors"][page]
+    lines, cursors = [], []
+    while True:
+        rows, has_more = await get_list_items_page(
+            list_id, cursor, limit=LIST_VIEW_FETCH_SIZE
+        )
+        for row in rows:
+            lines.append(format_item_line(row["name"], row["quantity"]))
+            cursors.append((row["created_ts"], row["id"]))
+        starts = paginate_lines(lines, view["max_chars"])
+        if len(starts) > 1:
+            return lines[: starts[1]], cursors[starts[1] - 1]
+        if not has_more or not rows:
+            return lines, None
+        cursor = cursors[-1]
+
+
+async def render_list_view(user_id, list_id, page=0):
+    # Отрисованный список переиспользуется, пока не изменится его версия.
+    # Страницы строятся по порядку при первом просмотре, каждая из своей
+    # выборки по ключу: для показа страницы читаются элементы только до ее
+    # конца, а не весь список. Права доступа проверяются один раз для
+    # каждого пользователя записи
+    version = get_list_version(list_id)
+    view = LIST_VIEW_CACHE.get(list_id)
+
+    if view is None or view["version"] != version:
+        list_details = await get_list_details(list_id, user_id)
+        if not list_details:
+            return None
+
+        title = format_list_title(list_details["name"])
+        view = {
+            "version": version,
+            "title": title,
+            "max_chars": page_char_limit(title, MESSAGE_ITEMS_CHAR_LIMIT),
+            # Курсоры начала построенных страниц и следующей за ними
+            "cursors": [None],
+            "pages": [],
+            "complete": False,
+            "viewers": {user_id},
+            "weight": 0,
+        }
+        LIST_VIEW_CACHE.put(list_id, view)
+
+    elif user_id not in view["viewers"]:
+        if not await get_list_details(list_id, user_id):
+            return None
+        view["viewers"].add(user_id)
+
+    page = max(page, 0)
+    while page >= len(view["pages"]) and not view["complete"]:
+        current = len(view["pages"])
+        lines, next_cursor = await _fetch_view_page(view, list_id, current)
+        if current != len(view["pages"]):
+            # Эту страницу уже построил другой обработчик
+            continue
+
+        has_next = next_cursor is not None
+        message_text = view["title"] + format_items_page(lines, current, has_next)
+        view["pages"].append(
+            (message_text, list_menu_keyboard(list_id, current, has_next))
+        )
+        if has_next:
+            view["cursors"].append(next_cursor)
+        else:
+            view["complete"] = True
+        view["weight"] += sys.getsizeof(message_text) + VIEW_MARKUP_WEIGHT
+        if view["version"] == get_list_version(list_id):
+            LIST_VIEW_CACHE.put(list_id, view, weight=view["weight"])
+
+    return view["pages"][min(page, len(view["pages"]) - 1)]
+
+
+async def purge_states_job(context: ContextTypes.DEFAULT_TYPE):
+    await STATE_STORE.purge_expired()
+
+
+async def purge_invites_job(context: ContextTypes.DEFAULT_TYPE):
+    await purge_invites(INVITE_PURGE_BATCH, INVITE_PURGE_MAX_BATCHES)
+
+
+async def purge_deleted_items_job(context: ContextTypes.DEFAULT_TYPE):
+    await purge_deleted_items(ITEM_PURGE_BATCH, ITEM_PURGE_MAX_BATCHES)
+
+
+async def vacuum_job(context: ContextTypes.DEFAULT_TYPE):
+    await reclaim_free_pages(VACUUM_PAGES_PER_STEP, VACUUM_MAX_STEPS)
+
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = create_user(update.effective_user.id)
-    update_user_activity(update.effective_user.id)
+    user_id = await create_user(update.effective_user.id)
+    await update_user_activity(update.effective_user.id)
 
     if context.args:
         token = context.args[0] if len(context.args) > 0 else None
         if token:
-            invite_data = get_invite_by_token(token)
+            invite_data = await get_invite_by_token(token)
             if invite_data:
                 list_id = invite_data["list_id"]
                 owner_id = invite_data["owner_id"]
 
-                success, message = invite_user_to_list_as_admin(
+                success, message = await invite_user_to_list_as_admin(
                     list_id, update.effective_user.id, owner_id
                 )
 
                 if success:
-                    USER_CURRENT_LISTS[update.effective_user.id] = list_id
+                    await STATE_STORE.set_current_list(user_id, list_id)
                     await update.message.reply_text(
                         f"🎉 Вы успешно присоединились к списку!\n\n"
                         f"Теперь вы являетесь администратором этого списка.\n"
@@ -79,6 +292,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• Добавить элементы (в любом формате)\n"
         "• Удалить элементы\n"
         "• Очистить список\n\n"
+        "*Подсказки:*\n"
+        "наберите в поле ввода @ с именем бота и начало названия -\n"
+        "бот предложит то, что вы уже добавляли\n\n"
         "*Формат добавления элементов:*\n"
         "Поддерживаются различные разделители:\n"
         "запятая, точка с запятой, вертикальная черта,\n"
@@ -93,30 +309,33 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(help_text, parse_mode="Markdown")
 
 
-async def lists_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = create_user(update.effective_user.id)
-    update_user_activity(update.effective_user.id)
+async def slowlog_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text(
+            "Не понимаю команду. Используйте /help для получения справки."
+        )
+        return
 
-    lists = get_user_lists(user_id)
+    limit = int(context.args[0]) if context.args and context.args[0].isdigit() else 10
+    slow_queries = STORAGE.slow_query_report(limit)
+    if slow_queries is None:
+        await update.message.reply_text(
+            "Журнал медленных запросов отключен (SLOW_QUERY_MS = 0 "
+            "или хранилище в памяти)"
+        )
+        return
 
-    keyboard = [
-        [InlineKeyboardButton("➕ Создать новый список", callback_data="create_list")],
-    ]
+    report = format_report(slow_queries)
+    await update.message.reply_text(report[:4000])
 
-    for lst in lists:
-        role_icon = "👑" if lst["user_role"] == "owner" else "👥"
-        keyboard.append(
-            [
-                InlineKeyboardButton(
-                    f"{role_icon} {lst['name']}",
-                    callback_data=f"select_list_{lst['id']}",
-                )
-            ]
-        )
 
-    keyboard.append([InlineKeyboardButton("❌ Закрыть", callback_data="close")])
+async def lists_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = await create_user(update.effective_user.id)
+    await update_user_activity(update.effective_user.id)
+
+    lists = await get_user_lists(user_id)
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = lists_keyboard(lists, "➕ Создать новый список")
 
     await update.message.reply_text(
         format_lists_menu(lists), reply_markup=reply_markup, parse_mode="Markdown"
@@ -124,61 +343,28 @@ async def lists_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def items_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = create_user(update.effective_user.id)
-    update_user_activity(update.effective_user.id)
+    user_id = await create_user(update.effective_user.id)
+    await update_user_activity(update.effective_user.id)
 
-    current_list_id = USER_CURRENT_LISTS.get(user_id)
+    current_list_id = await STATE_STORE.get_current_list(user_id)
 
     if not current_list_id:
-        lists = get_user_lists(user_id)
+        lists = await get_user_lists(user_id)
         if lists:
             current_list_id = lists[0]["id"]
-            USER_CURRENT_LISTS[user_id] = current_list_id
+            await STATE_STORE.set_current_list(user_id, current_list_id)
         else:
             await update.message.reply_text(
                 "У вас нет активных списков. Создайте новый с помощью /lists"
             )
             return
 
-    list_details = get_list_details(current_list_id, user_id)
-    if not list_details:
+    view = await render_list_view(user_id, current_list_id)
+    if not view:
         await update.message.reply_text("Список не найден или у вас нет к нему доступа")
         return
 
-    items = get_list_items(current_list_id)
-
-    message_text = f"*Список: {list_details['name']}*\n\n"
-    message_text += format_items_list(items)
-
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                "➕ Добавить элементы", callback_data=f"add_items_{current_list_id}"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "🗑 Удалить элементы",
-                callback_data=f"delete_items_{current_list_id}_page_0",
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "🧨 Очистить список", callback_data=f"clear_list_{current_list_id}"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "👥 Пригласить пользователя",
-                callback_data=f"invite_user_{current_list_id}",
-            )
-        ],
-        [InlineKeyboardButton("🔄 Сменить список", callback_data="change_list")],
-        [InlineKeyboardButton("❌ Закрыть", callback_data="close")],
-    ]
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
+    message_text, reply_markup = view
     await update.message.reply_text(
         message_text, reply_markup=reply_markup, parse_mode="Markdown"
     )
@@ -186,293 +372,254 @@ async def items_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+
+    # Кнопки старого формата и чужие данные отклоняются без обращения к базе
+    decoded = ROUTER.decode(query.data)
+    if decoded is None:
+        await query.answer("Кнопка устарела, откройте меню заново")
+        return
+
     await query.answer()
+    route, args = decoded
+    label_action(route.name)
 
-    user_id = create_user(query.from_user.id)
-    update_user_activity(query.from_user.id)
+    user_id = await create_user(query.from_user.id)
+    await update_user_activity(query.from_user.id)
 
-    data = query.data
+    await route.handler(query, user_id, *args)
 
-    if data == "create_list":
-        USER_STATES[user_id] = STATE_WAITING_FOR_LIST_NAME
-        await query.edit_message_text("Введите название нового списка:")
 
-    elif data.startswith("select_list_"):
-        list_id = int(data.split("_")[2])
-        USER_CURRENT_LISTS[user_id] = list_id
+@ROUTER.route("create_list", "c")
+async def create_list_action(query, user_id):
+    await STATE_STORE.set_state(user_id, STATE_WAITING_FOR_LIST_NAME)
+    await query.edit_message_text("Введите название нового списка:")
 
-        items = get_list_items(list_id)
-        list_details = get_list_details(list_id, user_id)
 
-        if list_details:
-            message_text = f"*Список: {list_details['name']}*\n\n"
-            message_text += format_items_list(items)
+@ROUTER.route("select_list", "s", int)
+async def select_list_action(query, user_id, list_id):
+    await STATE_STORE.set_current_list(user_id, list_id)
 
-            keyboard = [
-                [
-                    InlineKeyboardButton(
-                        "➕ Добавить элементы", callback_data=f"add_items_{list_id}"
-                    )
-                ],
-                [
-                    InlineKeyboardButton(
-                        "🗑 Удалить элементы",
-                        callback_data=f"delete_items_{list_id}_page_0",
-                    )
-                ],
-                [
-                    InlineKeyboardButton(
-                        "🧨 Очистить список", callback_data=f"clear_list_{list_id}"
-                    )
-                ],
-                [
-                    InlineKeyboardButton(
-                        "👥 Пригласить пользователя",
-                        callback_data=f"invite_user_{list_id}",
-                    )
-                ],
-                [
-                    InlineKeyboardButton(
-                        "🔄 Сменить список", callback_data="change_list"
-                    )
-                ],
-                [InlineKeyboardButton("❌ Закрыть", callback_data="close")],
-            ]
+    view = await render_list_view(user_id, list_id)
 
-            reply_markup = InlineKeyboardMarkup(keyboard)
+    if view:
+        message_text, reply_markup = view
+        await query.edit_message_text(
+            message_text, reply_markup=reply_markup, parse_mode="Markdown"
+        )
+    else:
+        await query.edit_message_text("Ошибка доступа к списку")
 
-            await query.edit_message_text(
-                message_text, reply_markup=reply_markup, parse_mode="Markdown"
-            )
-        else:
-            await query.edit_message_text("Ошибка доступа к списку")
 
-    elif data.startswith("add_items_"):
-        list_id = int(data.split("_")[2])
-        USER_CURRENT_LISTS[user_id] = list_id
-        USER_STATES[user_id] = STATE_CONTINUOUS_ADDING
+@ROUTER.route("view_list", "v", int, int)
+async def view_list_action(query, user_id, list_id, page):
+    await STATE_STORE.set_current_list(user_id, list_id)
+    await show_items_list(query, user_id, list_id, page)
 
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    "🚪 Выйти из режима добавления",
-                    callback_data=f"exit_adding_{list_id}",
-                )
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
 
-        await query.edit_message_text(
-            "Введите элементы для добавления (в любом формате).\n"
-            "Вы останетесь в режиме добавления до тех пор, пока не введете другую команду "
-            "или не нажмете кнопку 'Выйти из режима добавления'.",
-            reply_markup=reply_markup,
-        )
+@ROUTER.route("add_items", "a", int)
+async def add_items_action(query, user_id, list_id):
+    await STATE_STORE.set_current_list(user_id, list_id)
+    await STATE_STORE.set_state(user_id, STATE_CONTINUOUS_ADDING)
 
-    elif data.startswith("exit_adding_"):
-        list_id = int(data.split("_")[2])
-        USER_CURRENT_LISTS[user_id] = list_id
-        if user_id in USER_STATES:
-            del USER_STATES[user_id]
-        await show_items_list(query, user_id, list_id)
+    await query.edit_message_text(
+        "Введите элементы для добавления (в любом формате).\n"
+        "Вы останетесь в режиме добавления до тех пор, пока не введете другую команду "
+        "или не нажмете кнопку 'Выйти из режима добавления'.",
+        reply_markup=exit_adding_keyboard(list_id),
+    )
 
-    elif data.startswith("delete_items_"):
-        parts = data.split("_")
-        list_id = int(parts[2])
-        page = int(parts[4]) if len(parts) > 4 else 0
 
-        USER_CURRENT_LISTS[user_id] = list_id
+@ROUTER.route("exit_adding", "x", int)
+async def exit_adding_action(query, user_id, list_id):
+    # Отложенное "Добавлено элементов" отправляется до выхода из режима,
+    # а не приходит после показа списка
+    if query.message:
+        await REPLY_COALESCER.flush(query.message.chat.id)
+    await STATE_STORE.set_current_list(user_id, list_id)
+    await STATE_STORE.clear_state(user_id)
+    await show_items_list(query, user_id, list_id)
 
-        all_items = get_list_items(list_id)
-        total_items = len(all_items)
-        start_idx = page * ITEMS_PER_PAGE
-        end_idx = start_idx + ITEMS_PER_PAGE
-        items_page = all_items[start_idx:end_idx]
 
-        if not items_page:
-            await query.edit_message_text("Список пуст")
-            return
+# Курсор необязателен: направление ("n" - вперед, "p" - назад),
+# created_ts и id крайнего элемента показанной страницы
+@ROUTER.route("delete_items", "d", int, int, str, int, int, required=2)
+async def delete_items_action(
+    query, user_id, list_id, page, direction=None, created_ts=None, item_id=None
+):
+    cursor = None
+    backward = False
+    if direction is not None:
+        backward = direction == "p"
+        cursor = (created_ts, item_id)
 
-        keyboard = []
-        for item in items_page:
-            keyboard.append(
-                [
-                    InlineKeyboardButton(
-                        f"🗑 {item['name']}"
-                        + (f" x{item['quantity']}" if item["quantity"] > 1 else ""),
-                        callback_data=f"delete_single_item_{item['id']}",
-                    )
-                ]
-            )
+    await STATE_STORE.set_current_list(user_id, list_id)
 
-        nav_buttons = []
-        if page > 0:
-            nav_buttons.append(
-                InlineKeyboardButton(
-                    "⬅️ Назад", callback_data=f"delete_items_{list_id}_page_{page-1}"
-                )
-            )
-        if end_idx < total_items:
-            nav_buttons.append(
-                InlineKeyboardButton(
-                    "➡️ Далее", callback_data=f"delete_items_{list_id}_page_{page+1}"
-                )
-            )
+    items_page, has_more = await get_list_items_page(list_id, cursor, backward)
+
+    if not items_page:
+        await query.edit_message_text("Список пуст")
+        return
 
-        if nav_buttons:
-            keyboard.append(nav_buttons)
+    total_items = await get_list_item_count(list_id)
+    has_prev = has_more if backward else page > 0
+    has_next = True if backward else has_more
 
+    keyboard = []
+    for item in items_page:
         keyboard.append(
             [
                 InlineKeyboardButton(
-                    "🧨 Удалить всё", callback_data=f"delete_all_{list_id}"
+                    f"🗑 {item['name']}"
+                    + (f" x{item['quantity']}" if item["quantity"] > 1 else ""),
+                    callback_data=ROUTER.encode("delete_single_item", item["id"]),
                 )
             ]
         )
-        keyboard.append(
-            [InlineKeyboardButton("⬅️ Назад", callback_data=f"back_to_items_{list_id}")]
-        )
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            f"Выберите элементы для удаления (страница {page+1}):\n"
-            f"Показано {len(items_page)} из {total_items}",
-            reply_markup=reply_markup,
+    nav_buttons = []
+    if has_prev:
+        first = items_page[0]
+        nav_buttons.append(
+            InlineKeyboardButton(
+                "⬅️ Назад",
+                callback_data=ROUTER.encode(
+                    "delete_items",
+                    list_id,
+                    page - 1,
+                    "p",
+                    first["created_ts"],
+                    first["id"],
+                ),
+            )
+        )
+    if has_next:
+        last = items_page[-1]
+        nav_buttons.append(
+            InlineKeyboardButton(
+                "➡️ Далее",
+                callback_data=ROUTER.encode(
+                    "delete_items",
+                    list_id,
+                    page + 1,
+                    "n",
+                    last["created_ts"],
+                    last["id"],
+                ),
+            )
         )
 
-    elif data.startswith("delete_single_item_"):
-        item_id = int(data.split("_")[3])
-        delete_item(item_id)
+    if nav_buttons:
+        keyboard.append(nav_buttons)
 
-        list_id = USER_CURRENT_LISTS.get(user_id)
-        if list_id:
-            await show_items_list(query, user_id, list_id)
+    keyboard.append(
+        [
+            InlineKeyboardButton(
+                "🧨 Удалить всё", callback_data=ROUTER.encode("delete_all", list_id)
+            )
+        ]
+    )
+    keyboard.append(
+        [
+            InlineKeyboardButton(
+                "⬅️ Назад", callback_data=ROUTER.encode("back_to_items", list_id)
+            )
+        ]
+    )
 
-    elif data.startswith("delete_all_"):
-        list_id = int(data.split("_")[2])
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM items WHERE list_id = ?", (list_id,))
-            conn.commit()
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(
+        f"Выберите элементы для удаления (страница {page+1}):\n"
+        f"Показано {len(items_page)} из {total_items}",
+        reply_markup=reply_markup,
+    )
 
-        await show_items_list(query, user_id, list_id)
 
-    elif data.startswith("clear_list_"):
-        list_id = int(data.split("_")[2])
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM items WHERE list_id = ?", (list_id,))
-            conn.commit()
+@ROUTER.route("delete_single_item", "di", int)
+async def delete_single_item_action(query, user_id, item_id):
+    list_id = await STATE_STORE.get_current_list(user_id)
+    async with list_lock(list_id):
+        await delete_item(item_id)
 
+    if list_id:
         await show_items_list(query, user_id, list_id)
 
-    elif data.startswith("invite_user_"):
-        list_id = int(data.split("_")[2])
-        USER_CURRENT_LISTS[user_id] = list_id
 
-        token = generate_invite_token(list_id, user_id)
-        save_invite_token(token, list_id, user_id)
+@ROUTER.route("delete_all", "da", int)
+@ROUTER.route("clear_list", "cl", int)
+async def clear_list_action(query, user_id, list_id):
+    async with list_lock(list_id):
+        await clear_list_items(list_id)
 
-        invite_link = f"https://t.me/{BOT_USERNAME}?start={token}"
+    await show_items_list(query, user_id, list_id)
 
-        await query.edit_message_text(
-            f"🔗 Ссылка для приглашения в список:\n\n"
-            f"`{invite_link}`\n\n"
-            f"Отправьте эту ссылку тому, кого хотите пригласить.\n"
-            f"Приглашенный пользователь станет администратором списка!",
-            parse_mode="Markdown",
-        )
 
-    elif data.startswith("back_to_items_"):
-        list_id = int(data.split("_")[3])
-        USER_CURRENT_LISTS[user_id] = list_id
-        await show_items_list(query, user_id, list_id)
+@ROUTER.route("invite_user", "i", int)
+async def invite_user_action(query, user_id, list_id):
+    await STATE_STORE.set_current_list(user_id, list_id)
 
-    elif data == "change_list":
-        lists = get_user_lists(user_id)
-
-        keyboard = []
-        for lst in lists:
-            role_icon = "👑" if lst["user_role"] == "owner" else "👥"
-            keyboard.append(
-                [
-                    InlineKeyboardButton(
-                        f"{role_icon} {lst['name']}",
-                        callback_data=f"select_list_{lst['id']}",
-                    )
-                ]
-            )
+    token = await get_or_create_invite_token(
+        list_id, user_id, generate_invite_token(list_id, user_id)
+    )
 
-        keyboard.append(
-            [InlineKeyboardButton("➕ Создать новый", callback_data="create_list")]
-        )
-        keyboard.append([InlineKeyboardButton("❌ Закрыть", callback_data="close")])
+    invite_link = f"https://t.me/{BOT_USERNAME}?start={token}"
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(
+        f"🔗 Ссылка для приглашения в список:\n\n"
+        f"`{invite_link}`\n\n"
+        f"Отправьте эту ссылку тому, кого хотите пригласить.\n"
+        f"Приглашенный пользователь станет администратором списка!",
+        parse_mode="Markdown",
+    )
 
-        await query.edit_message_text(
-            format_lists_menu(lists), reply_markup=reply_markup, parse_mode="Markdown"
-        )
 
-    elif data == "close":
-        await query.delete_message()
+@ROUTER.route("back_to_items", "b", int)
+async def back_to_items_action(query, user_id, list_id):
+    await STATE_STORE.set_current_list(user_id, list_id)
+    await show_items_list(query, user_id, list_id)
 
-    else:
-        await query.edit_message_text("Неизвестная команда")
 
+@ROUTER.route("change_list", "ch")
+async def change_list_action(query, user_id):
+    lists = await get_user_lists(user_id)
 
-async def show_items_list(query, user_id, list_id):
-    items = get_list_items(list_id)
-    list_details = get_list_details(list_id, user_id)
+    await query.edit_message_text(
+        format_lists_menu(lists),
+        reply_markup=lists_keyboard(lists, "➕ Создать новый"),
+        parse_mode="Markdown",
+    )
 
-    message_text = f"*Список: {list_details['name']}*\n\n"
-    message_text += format_items_list(items)
 
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                "➕ Добавить элементы", callback_data=f"add_items_{list_id}"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "🗑 Удалить элементы", callback_data=f"delete_items_{list_id}_page_0"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "🧨 Очистить список", callback_data=f"clear_list_{list_id}"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "👥 Пригласить пользователя", callback_data=f"invite_user_{list_id}"
-            )
-        ],
-        [InlineKeyboardButton("🔄 Сменить список", callback_data="change_list")],
-        [InlineKeyboardButton("❌ Закрыть", callback_data="close")],
-    ]
+@ROUTER.route("close", "q")
+async def close_action(query, user_id):
+    await query.delete_message()
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
 
+async def show_items_list(query, user_id, list_id, page=0):
+    view = await render_list_view(user_id, list_id, page)
+    if not view:
+        await query.edit_message_text("Список не найден или у вас нет к нему доступа")
+        return
+
+    message_text, reply_markup = view
     await query.edit_message_text(
         message_text, reply_markup=reply_markup, parse_mode="Markdown"
     )
 
 
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = create_user(update.effective_user.id)
-    update_user_activity(update.effective_user.id)
+    user_id = await create_user(update.effective_user.id)
+    await update_user_activity(update.effective_user.id)
 
-    user_state = USER_STATES.get(user_id)
+    user_state = await STATE_STORE.get_state(user_id)
+    label_action(user_state or "idle")
 
     if update.message.text.startswith("/"):
         if user_state == STATE_CONTINUOUS_ADDING:
-            del USER_STATES[user_id]
+            await STATE_STORE.clear_state(user_id)
 
     if user_state == STATE_WAITING_FOR_LIST_NAME:
         if update.message.text.lower() in ["отмена", "cancel", "/cancel"]:
-            del USER_STATES[user_id]
+            await STATE_STORE.clear_state(user_id)
             await update.message.reply_text("Создание списка отменено.")
             return
 
@@ -483,73 +630,53 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        list_id = create_list(list_name, user_id)
-        USER_CURRENT_LISTS[user_id] = list_id
-        del USER_STATES[user_id]
+        list_id = await create_list(list_name, user_id)
+        await STATE_STORE.set_current_list(user_id, list_id)
+        await STATE_STORE.clear_state(user_id)
 
         await update.message.reply_text(f"Список '{list_name}' успешно создан!")
 
         await show_current_list_menu(update, user_id, list_id)
 
     elif user_state == STATE_CONTINUOUS_ADDING:
-        current_list_id = USER_CURRENT_LISTS.get(user_id)
+        current_list_id = await STATE_STORE.get_current_list(user_id)
         if not current_list_id:
-            keyboard = [
-                [
-                    InlineKeyboardButton(
-                        "🚪 Выйти из режима добавления",
-                        callback_data=f"exit_adding_{current_list_id or 0}",
-                    )
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = exit_adding_keyboard(current_list_id or 0)
 
             await update.message.reply_text(
                 "Ошибка: не выбран список", reply_markup=reply_markup
             )
-            del USER_STATES[user_id]
+            await STATE_STORE.clear_state(user_id)
             return
 
         items_to_add = parse_items(update.message.text)
 
         if not items_to_add:
-            keyboard = [
-                [
-                    InlineKeyboardButton(
-                        "🚪 Выйти из режима добавления",
-                        callback_data=f"exit_adding_{current_list_id}",
-                    )
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = exit_adding_keyboard(current_list_id)
 
             await update.message.reply_text(
                 "Не удалось распознать элементы.", reply_markup=reply_markup
             )
             return
 
-        for item_name, quantity in items_to_add:
-            add_item_to_list(current_list_id, item_name, quantity, user_id)
+        async with list_lock(current_list_id):
+            await add_items_to_list(current_list_id, items_to_add, user_id)
 
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    "🚪 Выйти из режима добавления",
-                    callback_data=f"exit_adding_{current_list_id}",
-                )
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = exit_adding_keyboard(current_list_id)
 
-        await update.message.reply_text(
-            f"Добавлено элементов: {len(items_to_add)}", reply_markup=reply_markup
+        await REPLY_COALESCER.add(
+            context.bot,
+            update.effective_chat.id,
+            len(items_to_add),
+            "Добавлено элементов: {count}",
+            reply_markup,
         )
 
     elif user_state == STATE_WAITING_FOR_ITEMS:
-        current_list_id = USER_CURRENT_LISTS.get(user_id)
+        current_list_id = await STATE_STORE.get_current_list(user_id)
         if not current_list_id:
             await update.message.reply_text("Ошибка: не выбран список")
-            del USER_STATES[user_id]
+            await STATE_STORE.clear_state(user_id)
             return
 
         items_to_add = parse_items(update.message.text)
@@ -560,18 +687,18 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        for item_name, quantity in items_to_add:
-            add_item_to_list(current_list_id, item_name, quantity, user_id)
+        async with list_lock(current_list_id):
+            await add_items_to_list(current_list_id, items_to_add, user_id)
 
-        del USER_STATES[user_id]
+        await STATE_STORE.clear_state(user_id)
 
         await show_current_list_menu(update, user_id, current_list_id)
 
     elif user_state == STATE_WAITING_FOR_INVITE:
-        current_list_id = USER_CURRENT_LISTS.get(user_id)
+        current_list_id = await STATE_STORE.get_current_list(user_id)
         if not current_list_id:
             await update.message.reply_text("Ошибка: не выбран список")
-            del USER_STATES[user_id]
+            await STATE_STORE.clear_state(user_id)
             return
 
         try:
@@ -582,14 +709,14 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        success, message = invite_user_to_list(
+        success, message = await invite_user_to_list(
             current_list_id, invited_telegram_id, user_id
         )
 
-        del USER_STATES[user_id]
+        await STATE_STORE.clear_state(user_id)
 
         if success:
-            owner_telegram_id = get_list_owner(current_list_id)
+            owner_telegram_id = await get_list_owner(current_list_id)
             await update.message.reply_text(
                 f"Пользователь успешно приглашен!\n"
                 f"Отправьте ему эту ссылку для доступа к списку:\n"
@@ -619,38 +746,12 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def show_current_list_menu(update, user_id, list_id):
-    items = get_list_items(list_id)
-    list_details = get_list_details(list_id, user_id)
-
-    message_text = f"*Список: {list_details['name']}*\n\n"
-    message_text += format_items_list(items)
-
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                "➕ Добавить элементы", callback_data=f"add_items_{list_id}"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "🗑 Удалить элементы", callback_data=f"delete_items_{list_id}_page_0"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "🧨 Очистить список", callback_data=f"clear_list_{list_id}"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "👥 Пригласить пользователя", callback_data=f"invite_user_{list_id}"
-            )
-        ],
-        [InlineKeyboardButton("🔄 Сменить список", callback_data="change_list")],
-        [InlineKeyboardButton("❌ Закрыть", callback_data="close")],
-    ]
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    view = await render_list_view(user_id, list_id)
+    if not view:
+        message_text = "Список не найден или у вас нет к нему доступа"
+        reply_markup = None
+    else:
+        message_text, reply_markup = view
 
     if hasattr(update, "callback_query") and update.callback_query:
         await update.callback_query.edit_message_text(
@@ -660,3 +761,22 @@ async def show_current_list_menu(update, user_id, list_id):
         await update.message.reply_text(
             message_text, reply_markup=reply_markup, parse_mode="Markdown"
         )
+
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Подсказки из истории добавленных пользователем названий. Выбранный
+    # вариант отправляется в чат обычным сообщением и в режиме добавления
+    # попадает в список как набранный вручную
+    query = update.inline_query
+    user_id = await create_user(query.from_user.id)
+    names = await suggest_items(user_id, query.query, SUGGEST_LIMIT)
+
+    results = [
+        InlineQueryResultArticle(
+            id=str(index),
+            title=name,
+            input_message_content=InputTextMessageContent(name),
+        )
+        for index, name in enumerate(names)
+    ]
+    await query.answer(results, cache_time=SUGGEST_CACHE_TTL, is_personal=True)
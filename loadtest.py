@@ -0,0 +1,745 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from urllib.parse import parse_qsl, urlsplit
+
+# Нагрузочный тест: бот из bot.py запускается против локального поддельного
+# Bot API, а N виртуальных пользователей проходят сценарий (создание списка,
+# режим добавления, постраничное удаление, приглашения). Сеть не нужна:
+#
+#   python loadtest.py --users 200 --rounds 3
+#   python loadtest.py --users 50 --webhook
+#   python loadtest.py --users 50 --paste 500
+
+BOT_ID = 100000
+BOT_USERNAME = "loadtest_bot"
+TOKEN = "100000:loadtest"
+
+# Методы, результат которых пользователь видит как ответ бота
+REPLY_METHODS = {"sendMessage", "editMessageText", "deleteMessage"}
+# Параметры, которые python-telegram-bot передает в виде JSON
+JSON_PARAMS = {"reply_markup", "allowed_updates", "entities", "link_preview_options"}
+INT_PARAMS = {"chat_id", "message_id", "offset", "limit", "timeout"}
+
+_ADDED_RE = re.compile(r"Добавлено элементов: (\d+)")
+_INVITE_RE = re.compile(r"\?start=(\w+)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота списков")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=1, help="сессий на пользователя")
+    parser.add_argument("--items", type=int, default=30, help="элементов за сессию")
+    parser.add_argument(
+        "--ramp", type=float, default=5.0, help="время подключения всех пользователей"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=15.0, help="ожидание ответа на шаг, с"
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--webhook", action="store_true", help="доставка через webhook")
+    parser.add_argument("--webhook-port", type=int, default=8443)
+    parser.add_argument(
+        "--no-rate-limit",
+        action="store_true",
+        help="отключить ограничение частоты запросов к Bot API",
+    )
+    parser.add_argument(
+        "--storage", choices=("sqlite", "memory"), default="sqlite", help="хранилище"
+    )
+    parser.add_argument(
+        "--paste",
+        type=int,
+        default=0,
+        metavar="ITEMS",
+        help="еще один пользователь все время вставляет списки из ITEMS элементов",
+    )
+    parser.add_argument("--report", metavar="PATH", help="сохранить отчет в JSON")
+    return parser.parse_args()
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+class StepFailed(Exception):
+    pass
+
+
+class FakeBotAPI:
+    # Минимальная реализация Bot API поверх asyncio: хранит отправленные
+    # ботом сообщения, отдает обновления через getUpdates или доставляет
+    # их на webhook и передает ответы бота виртуальным пользователям.
+    # При strict=False (replay.py) правка и удаление неизвестных сообщений
+    # считаются успешными
+    def __init__(self, strict=True):
+        self.strict = strict
+        self.port = None
+        self.webhook = None
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+        self._server = None
+        self._updates = []
+        self._new_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+        self._messages = {}
+        self._callbacks = {}
+        self._inboxes = defaultdict(asyncio.Queue)
+        self._deliveries = set()
+        self._connections = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        tasks = self._deliveries | self._connections
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._server.close()
+        await self._server.wait_closed()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def inbox(self, chat_id):
+        return self._inboxes[chat_id]
+
+    def message(self, chat_id, message_id):
+        return self._messages.get((chat_id, message_id))
+
+    # Обновления от виртуальных пользователей
+
+    def push_message(self, user_id, text):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(command)}
+            ]
+        self._push({"message": message})
+
+    def push_callback(self, user_id, message_id, data):
+        callback_id = str(next(self._callback_ids))
+        self._callbacks[callback_id] = user_id
+        self._push(
+            {
+                "callback_query": {
+                    "id": callback_id,
+                    "from": {
+                        "id": user_id,
+                        "is_bot": False,
+                        "first_name": f"User {user_id}",
+                    },
+                    "chat_instance": str(user_id),
+                    "data": data,
+                    "message": self._messages[(user_id, message_id)],
+                }
+            }
+        )
+
+    def _push(self, update):
+        update["update_id"] = next(self._update_ids)
+        if self.webhook:
+            task = asyncio.create_task(self._deliver(update))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+        else:
+            self._updates.append(update)
+            self._new_updates.set()
+
+    async def _deliver(self, update):
+        url = urlsplit(self.webhook["url"])
+        body = json.dumps(update).encode()
+        headers = [
+            f"POST {url.path or '/'} HTTP/1.1",
+            f"Host: {url.netloc}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            "Connection: close",
+        ]
+        if self.webhook.get("secret_token"):
+            headers.append(
+                f"X-Telegram-Bot-Api-Secret-Token: {self.webhook['secret_token']}"
+            )
+        try:
+            reader, writer = await asyncio.open_connection(url.hostname, url.port)
+            writer.write(("\r\n".join(headers) + "\r\n\r\n").encode() + body)
+            await writer.drain()
+            status = await reader.readline()
+            writer.close()
+            if b" 200 " not in status:
+                self.errors["webhook"] += 1
+        except OSError:
+            self.errors["webhook"] += 1
+
+    # HTTP
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                path = urlsplit(request_line.split()[1].decode()).path
+                method = path.rsplit("/", 1)[-1]
+                params = self._parse_params(headers.get("content-type", ""), body)
+                status, payload = await self._call(method, params)
+
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode()
+                    + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Незавершенный long polling при остановке теста
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    @staticmethod
+    def _parse_params(content_type, body):
+        if not body:
+            return {}
+        if content_type.startswith("application/json"):
+            return json.loads(body)
+
+        params = dict(parse_qsl(body.decode(), keep_blank_values=True))
+        for name, value in params.items():
+            if name in JSON_PARAMS:
+                params[name] = json.loads(value)
+            elif name in INT_PARAMS:
+                params[name] = int(float(value))
+        return params
+
+    async def _call(self, method, params):
+        self.calls[method] += 1
+        handler = getattr(self, f"_api_{method}", None)
+        if handler is None:
+            self.errors[method] += 1
+            return "404 Not Found", {
+                "ok": False,
+                "error_code": 404,
+                "description": "Not Found",
+            }
+
+        try:
+            result = handler(params)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except (KeyError, ValueError) as error:
+            self.errors[method] += 1
+            return "400 Bad Request", {
+                "ok": False,
+                "error_code": 400,
+                "description": f"Bad Request: {error}",
+            }
+        return "200 OK", {"ok": True, "result": result}
+
+    def _notify(self, chat_id, event):
+        # Без виртуальных пользователей (replay.py) ответы никто не читает
+        if self.strict:
+            self._inboxes[chat_id].put_nowait(event)
+
+    # Методы Bot API
+
+    def _api_getMe(self, params):
+        return {
+            "id": BOT_ID,
+            "is_bot": True,
+            "first_name": "Load test",
+            "username": BOT_USERNAME,
+            "can_join_groups": False,
+            "can_read_all_group_messages": False,
+            "supports_inline_queries": True,
+        }
+
+    def _api_deleteWebhook(self, params):
+        self.webhook = None
+        return True
+
+    def _api_setWebhook(self, params):
+        self.webhook = params
+        return True
+
+    async def _api_getUpdates(self, params):
+        offset = params.get("offset", 0)
+        self._updates = [
+            update for update in self._updates if update["update_id"] >= offset
+        ]
+        if not self._updates and params.get("timeout"):
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), params["timeout"])
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[: params.get("limit", 100)]
+
+    def _api_sendMessage(self, params):
+        chat_id = params["chat_id"]
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Load test"},
+            "text": params["text"],
+        }
+        if params.get("reply_markup"):
+            message["reply_markup"] = params["reply_markup"]
+        self._messages[(chat_id, message["message_id"])] = message
+        self._notify(chat_id, ("sendMessage", message))
+        return message
+
+    def _api_editMessageText(self, params):
+        chat_id = params["chat_id"]
+        message = self._messages.get((chat_id, params["message_id"]))
+        if message is None:
+            if self.strict:
+                raise KeyError("message to edit not found")
+            message = {
+                "message_id": params["message_id"],
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+            }
+        message = dict(message, text=params["text"], edit_date=int(time.time()))
+        message.pop("reply_markup", None)
+        if params.get("reply_markup"):
+            message["reply_markup"] = params["reply_markup"]
+        self._messages[(chat_id, message["message_id"])] = message
+        self._notify(chat_id, ("editMessageText", message))
+        return message
+
+    def _api_deleteMessage(self, params):
+        chat_id = params["chat_id"]
+        message = self._messages.pop((chat_id, params["message_id"]), None)
+        if message is None:
+            if self.strict:
+                raise KeyError("message to delete not found")
+            message = {"message_id": params["message_id"]}
+        self._notify(chat_id, ("deleteMessage", message))
+        return True
+
+    def _api_answerCallbackQuery(self, params):
+        chat_id = self._callbacks.pop(params["callback_query_id"], None)
+        if chat_id is None and self.strict:
+            raise KeyError("query is too old or query ID is invalid")
+        if chat_id is not None and params.get("text"):
+            self._notify(chat_id, ("answerCallbackQuery", params))
+        return True
+
+    def _api_answerInlineQuery(self, params):
+        # Подсказки приходят только в записях replay.py, результат не нужен
+        return True
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self.updates = 0
+
+    def record(self, action, seconds):
+        self.latencies[action].append(seconds)
+
+    def error(self, action, reason):
+        self.errors[action][reason] += 1
+
+
+def is_reply(method, message):
+    return method in REPLY_METHODS
+
+
+def has_keyboard(method, message):
+    return method in REPLY_METHODS and "reply_markup" in message
+
+
+def is_join_reply(method, message):
+    # После успешного присоединения бот отправляет поздравление и меню
+    # списка, шаг заканчивается на меню
+    return method in REPLY_METHODS and not message["text"].startswith("🎉")
+
+
+class VirtualUser:
+    def __init__(self, api, stats, user_id, args, rng, invites):
+        self.api = api
+        self.stats = stats
+        self.user_id = user_id
+        self.args = args
+        self.rng = rng
+        self.invites = invites
+        self.inbox = api.inbox(user_id)
+        self.screen = None
+
+    async def run(self, delay):
+        await asyncio.sleep(delay)
+        for round_number in range(self.args.rounds):
+            try:
+                await self.session(round_number)
+            except StepFailed:
+                pass
+
+    async def session(self, round_number):
+        await self.send("start", "/start")
+        await self.send("lists", "/lists", has_keyboard)
+        await self.press("create_list_button", "➕ Создать")
+        await self.send(
+            "create_list", f"Список {self.user_id}-{round_number}", has_keyboard
+        )
+
+        await self.press("add_mode", "➕ Добавить")
+        await self.add_items()
+        await self.press("exit_adding", "🚪")
+
+        await self.press("delete_page", "🗑 Удалить", has_keyboard)
+        for _ in range(3):
+            if not self.find_button("➡️"):
+                break
+            await self.press("delete_next", "➡️", has_keyboard)
+        await self.press("delete_item", "🗑 ", has_keyboard)
+
+        # Пользователь присоединяется к чужому списку по ранее выданной ссылке
+        others = list(self.invites)
+        method, message = await self.press("invite", "👥")
+        token = _INVITE_RE.search(message["text"])
+        if token:
+            self.invites.append(token.group(1))
+        if others:
+            await self.send("join", f"/start {self.rng.choice(others)}", is_join_reply)
+
+        await self.send("items", "/items", has_keyboard)
+
+    async def send(self, action, text, predicate=is_reply):
+        started = time.perf_counter()
+        self.api.push_message(self.user_id, text)
+        self.stats.updates += 1
+        return await self.wait(action, started, predicate)
+
+    async def press(self, action, label, predicate=is_reply):
+        button = self.find_button(label)
+        if button is None:
+            self.stats.error(action, "нет кнопки")
+            raise StepFailed(action)
+
+        started = time.perf_counter()
+        self.api.push_callback(self.user_id, self.screen, button["callback_data"])
+        self.stats.updates += 1
+        return await self.wait(action, started, predicate)
+
+    def find_button(self, label):
+        message = self.api.message(self.user_id, self.screen)
+        if not message or "reply_markup" not in message:
+            return None
+        for row in message["reply_markup"]["inline_keyboard"]:
+            for button in row:
+                if button["text"].startswith(label):
+                    return button
+        return None
+
+    async def wait(self, action, started, predicate, record=True):
+        deadline = started + self.args.timeout
+        while True:
+            try:
+                method, message = await asyncio.wait_for(
+                    self.inbox.get(), deadline - time.perf_counter()
+                )
+            except asyncio.TimeoutError:
+                self.stats.error(action, "таймаут")
+                raise StepFailed(action)
+
+            if method == "answerCallbackQuery":
+                self.stats.error(action, message.get("text", "answerCallbackQuery"))
+                raise StepFailed(action)
+            if predicate(method, message):
+                break
+
+        if record:
+            self.stats.record(action, time.perf_counter() - started)
+        if method != "deleteMessage" and "reply_markup" in message:
+            self.screen = message["message_id"]
+        return method, message
+
+    async def add_items(self):
+        # Несколько сообщений подряд: подтверждения объединяются ботом,
+        # поэтому шаг заканчивается, когда подтверждено все отправленное
+        expected = 0
+        started = time.perf_counter()
+        remaining = self.args.items
+        while remaining > 0:
+            count = min(remaining, self.rng.randint(1, 10))
+            remaining -= count
+            names = (
+                f"товар {self.rng.randrange(1000)} x{self.rng.randint(1, 3)}"
+                for _ in range(count)
+            )
+            self.api.push_message(self.user_id, ", ".join(names))
+            self.stats.updates += 1
+            expected += count
+
+        confirmed = 0
+        while confirmed < expected:
+            method, message = await self.wait(
+                "add_items",
+                started,
+                lambda method, message: method == "sendMessage"
+                and _ADDED_RE.match(message["text"]),
+                record=False,
+            )
+            confirmed += int(_ADDED_RE.match(message["text"]).group(1))
+        self.stats.record("add_items", time.perf_counter() - started)
+
+    async def paste_until(self, done):
+        # Помеха для остальных пользователей: большие вставки одна за другой,
+        # пока остальные не закончат сценарий
+        try:
+            await self.send("start", "/start")
+            await self.send("lists", "/lists", has_keyboard)
+            await self.press("create_list_button", "➕ Создать")
+            await self.send("create_list", f"Список {self.user_id}", has_keyboard)
+            await self.press("add_mode", "➕ Добавить")
+            while not done.is_set():
+                names = ", ".join(
+                    f"товар {self.rng.randrange(1000)} x{self.rng.randint(1, 3)}"
+                    for _ in range(self.args.paste)
+                )
+                started = time.perf_counter()
+                self.api.push_message(self.user_id, names)
+                self.stats.updates += 1
+                await self.wait(
+                    "paste",
+                    started,
+                    lambda method, message: method == "sendMessage"
+                    and _ADDED_RE.match(message["text"]),
+                )
+        except StepFailed:
+            pass
+
+
+def overall_p99(stats):
+    # add_items состоит из нескольких сообщений и включает задержку
+    # объединения подтверждений, поэтому в общую оценку не входит
+    latencies = sorted(
+        itertools.chain.from_iterable(
+            values
+            for action, values in stats.latencies.items()
+            if action != "add_items"
+        )
+    )
+    return percentile(latencies, 0.99) * 1000 if latencies else 0.0
+
+
+def format_report(stats, api, elapsed, handler_errors, paste_stats=None):
+    lines = [
+        f"Обновлений: {stats.updates} за {elapsed:.1f} с "
+        f"({stats.updates / elapsed:.1f} обн/с)",
+        "",
+        f"{'действие':<20}{'число':>8}{'p50, мс':>10}{'p95, мс':>10}"
+        f"{'p99, мс':>10}{'макс, мс':>10}{'ошибки':>8}",
+    ]
+    actions = sorted(set(stats.latencies) | set(stats.errors))
+    for action in actions:
+        latencies = sorted(stats.latencies.get(action, []))
+        errors = sum(stats.errors.get(action, {}).values())
+        if latencies:
+            p50, p95, p99 = (percentile(latencies, p) * 1000 for p in (0.5, 0.95, 0.99))
+            lines.append(
+                f"{action:<20}{len(latencies):>8}{p50:>10.1f}{p95:>10.1f}"
+                f"{p99:>10.1f}{latencies[-1] * 1000:>10.1f}{errors:>8}"
+            )
+        else:
+            lines.append(f"{action:<20}{0:>8}{'':>40}{errors:>8}")
+
+    lines.append("")
+    lines.append(f"p99 ответов на одиночные обновления: {overall_p99(stats):.1f} мс")
+    if paste_stats is not None:
+        # Сравнивается с p99 запуска без --paste
+        pastes = sorted(paste_stats.latencies.get("paste", []))
+        if pastes:
+            lines.append(
+                f"Вставки: {len(pastes)}, p50 {percentile(pastes, 0.5) * 1000:.1f} мс,"
+                f" p99 {percentile(pastes, 0.99) * 1000:.1f} мс"
+            )
+        for action, reasons in paste_stats.errors.items():
+            for reason, count in reasons.items():
+                lines.append(f"Ошибка вставки {action}: {reason} - {count}")
+
+    for action in actions:
+        for reason, count in stats.errors.get(action, {}).items():
+            lines.append(f"Ошибка {action}: {reason} - {count}")
+    for method, count in api.errors.items():
+        lines.append(f"Ошибки Bot API {method}: {count}")
+    for name, count in handler_errors.items():
+        lines.append(f"Исключения в обработчиках {name}: {count}")
+    return "\n".join(lines)
+
+
+def build_report(stats, api, elapsed, handler_errors, paste_stats=None):
+    actions = {}
+    for action, latencies in stats.latencies.items():
+        latencies = sorted(latencies)
+        actions[action] = {
+            "count": len(latencies),
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": latencies[-1] * 1000,
+        }
+    pastes = sorted(paste_stats.latencies.get("paste", [])) if paste_stats else []
+    return {
+        "updates": stats.updates,
+        "elapsed": elapsed,
+        "updates_per_sec": stats.updates / elapsed,
+        "p99_ms": overall_p99(stats),
+        "paste": {
+            "count": len(pastes),
+            "p99_ms": percentile(pastes, 0.99) * 1000 if pastes else None,
+        },
+        "actions": actions,
+        "errors": {action: dict(reasons) for action, reasons in stats.errors.items()},
+        "api_calls": dict(api.calls),
+        "api_errors": dict(api.errors),
+        "handler_errors": dict(handler_errors),
+    }
+
+
+async def run(args, bot):
+    api = FakeBotAPI()
+    await api.start()
+
+    bot.STORAGE.initialize()
+    application = bot.build_application(
+        TOKEN, base_url=api.base_url, rate_limit=not args.no_rate_limit
+    )
+
+    handler_errors = defaultdict(int)
+
+    async def on_error(update, context):
+        handler_errors[type(context.error).__name__] += 1
+
+    application.add_error_handler(on_error)
+
+    await application.initialize()
+    await application.post_init(application)
+    if args.webhook:
+        await application.updater.start_webhook(
+            listen="127.0.0.1",
+            port=args.webhook_port,
+            url_path="telegram",
+            webhook_url=f"http://127.0.0.1:{args.webhook_port}/telegram",
+            secret_token="loadtest",
+        )
+    else:
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+    await application.start()
+
+    stats = Stats()
+    rng = random.Random(args.seed)
+    invites = []
+    users = [
+        VirtualUser(api, stats, 1000000 + n, args, random.Random(rng.random()), invites)
+        for n in range(args.users)
+    ]
+
+    # Отдельный генератор, чтобы сценарий остальных пользователей совпадал
+    # с запуском без --paste
+    paste_stats = None
+    if args.paste:
+        paste_stats = Stats()
+        paster = VirtualUser(
+            api, paste_stats, 999999, args, random.Random(args.seed + 1), []
+        )
+        done = asyncio.Event()
+        paste_task = asyncio.create_task(paster.paste_until(done))
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(
+            user.run(args.ramp * n / max(args.users, 1))
+            for n, user in enumerate(users)
+        )
+    )
+    elapsed = time.perf_counter() - started
+
+    if args.paste:
+        done.set()
+        await paste_task
+
+    await application.updater.stop()
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await api.stop()
+
+    return stats, api, elapsed, handler_errors, paste_stats
+
+
+def main():
+    args = parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="shopping-loadtest-")
+    os.environ["DATABASE_PATH"] = os.path.join(workdir, "loadtest.db")
+    os.environ["BOT_TOKEN"] = TOKEN
+    os.environ["BOT_USERNAME"] = BOT_USERNAME
+    os.environ["STORAGE_BACKEND"] = args.storage
+
+    import bot
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    stats, api, elapsed, handler_errors, paste_stats = asyncio.run(run(args, bot))
+    print(format_report(stats, api, elapsed, handler_errors, paste_stats))
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(
+                build_report(stats, api, elapsed, handler_errors, paste_stats),
+                f,
+                indent=2,
+                ensure_ascii=False,
+            )
+        print(f"Отчет сохранен в {args.report}")
+
+    if paste_stats and paste_stats.errors:
+        sys.exit(1)
+    if stats.errors or api.errors or handler_errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import logging
+import time
+
+from config import METRICS_PORT, METRICS_HOST, METRICS_COLLECT
+
+logger = logging.getLogger(__name__)
+
+# При METRICS_PORT = 0 инструментирование отключено, и обертки
+# возвращают исходные функции без изменений. METRICS_COLLECT включает
+# сбор без HTTP-сервера
+ENABLED = METRICS_PORT > 0 or METRICS_COLLECT
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+_REGISTRY = []
+
+
+def _register(metric):
+    # Метрика с уже зарегистрированным именем заменяет прежнюю: иначе
+    # повторная регистрация (например, при каждом build_application)
+    # дублирует серии в выводе /metrics
+    for index, registered in enumerate(_REGISTRY):
+        if registered.name == metric.name:
+            _REGISTRY[index] = metric
+            return
+    _REGISTRY.append(metric)
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        _register(self)
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for label_values, value in self._values.items():
+            lines.append(
+                f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+            )
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}
+        _register(self)
+
+    def observe(self, value, *label_values):
+        series = self._values.get(label_values)
+        if series is None:
+            series = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for label_values, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Gauge:
+    # Значение вычисляется функцией в момент чтения метрик
+    def __init__(self, name, documentation, func):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        _register(self)
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.func()}",
+        ]
+
+
+def render():
+    lines = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_duration_seconds",
+    "Время обработки обновления",
+    ("handler", "action"),
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Ошибки при обработке обновлений", ("handler",)
+)
+DB_CALL_LATENCY = Histogram(
+    "bot_db_call_duration_seconds", "Время выполнения запроса к базе", ("function",)
+)
+DB_CALLS_PER_UPDATE = Histogram(
+    "bot_db_calls_per_update",
+    "Число запросов к базе на одно обновление",
+    ("handler",),
+    buckets=(0, 1, 2, 3, 4, 5, 8, 13, 21),
+)
+DB_TIME_PER_UPDATE = Histogram(
+    "bot_db_time_per_update_seconds",
+    "Суммарное время запросов к базе на одно обновление",
+    ("handler",),
+)
+
+_update_stats = contextvars.ContextVar("update_stats", default=None)
+
+# Функции, получающие каждое измерение обработчика:
+# observer(handler, action, seconds, db_calls, db_time)
+_observers = []
+
+
+def add_observer(observer):
+    _observers.append(observer)
+
+
+def _callback_action(update):
+    # Код действия до первого разделителя: "d:5:1" -> "d". Обработчик
+    # кнопок затем уточняет его полным именем через label_action
+    query = getattr(update, "callback_query", None)
+    if not query or not query.data:
+        return ""
+    return query.data.partition(":")[0]
+
+
+def label_action(action):
+    stats = _update_stats.get()
+    if stats is not None:
+        stats["action"] = action
+
+
+def instrument_handler(func):
+    if not ENABLED:
+        return func
+
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        stats = {"action": _callback_action(update), "db_calls": 0, "db_time": 0.0}
+        token = _update_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            return await func(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            _update_stats.reset(token)
+            elapsed = time.perf_counter() - started
+            HANDLER_LATENCY.observe(elapsed, name, stats["action"])
+            DB_CALLS_PER_UPDATE.observe(stats["db_calls"], name)
+            DB_TIME_PER_UPDATE.observe(stats["db_time"], name)
+            for observer in _observers:
+                observer(
+                    name, stats["action"], elapsed, stats["db_calls"], stats["db_time"]
+                )
+
+    return wrapper
+
+
+def record_db_call(function, seconds):
+    DB_CALL_LATENCY.observe(seconds, function)
+    stats = _update_stats.get()
+    if stats is not None:
+        stats["db_calls"] += 1
+        stats["db_time"] += seconds
+
+
+async def _handle_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request_line.split()
+        if len(parts) > 1 and parts[1] == b"/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+_server = None
+
+
+async def start_server():
+    global _server
+    if METRICS_PORT <= 0 or _server is not None:
+        return
+    _server = await asyncio.start_server(_handle_request, METRICS_HOST, METRICS_PORT)
+    logger.info(
+        "Метрики доступны на http://%s:%d/metrics", METRICS_HOST, METRICS_PORT
+    )
+
+
+async def stop_server():
+    global _server
+    if _server is None:
+        return
+    _server.close()
+    await _server.wait_closed()
+    _server = None
@@ -0,0 +1,513 @@
+import logging
+
+from utils import normalize_item_name
+
+logger = logging.getLogger(__name__)
+
+# Размер пачки при заполнении name_key и схлопывании дубликатов. Миграция
+# выполняется одной транзакцией, пачки ограничивают только объем одного
+# запроса и выборки дубликатов в памяти
+_BATCH_SIZE = 1000
+
+
+def _fill_name_keys(conn):
+    conn.create_function(
+        "normalize_item_name", 1, normalize_item_name, deterministic=True
+    )
+    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM items").fetchone()[0]
+    for start in range(0, last_id, _BATCH_SIZE):
+        conn.execute(
+            """
+            UPDATE items SET name_key = normalize_item_name(name)
+            WHERE id > ? AND id <= ?
+            """,
+            (start, start + _BATCH_SIZE),
+        )
+
+
+def _fold_name_key_duplicates(conn):
+    # Остается самый ранний элемент с суммарным количеством, остальные
+    # удаляются (счетчик item_count уменьшают триггеры). Списки читаются
+    # пачками по id внутри общей транзакции миграции: при ошибке
+    # откатывается вся миграция, и она повторяется с начала
+    last_list_id = 0
+    while True:
+        list_ids = [
+            row[0]
+            for row in conn.execute(
+                "SELECT id FROM shopping_lists WHERE id > ? ORDER BY id LIMIT ?",
+                (last_list_id, _BATCH_SIZE),
+            )
+        ]
+        if not list_ids:
+            break
+        last_list_id = list_ids[-1]
+
+        duplicates = conn.execute(
+            """
+            SELECT list_id, name_key, MIN(id), SUM(quantity) FROM items
+            WHERE deleted = 0 AND list_id BETWEEN ? AND ?
+            GROUP BY list_id, name_key
+            HAVING COUNT(*) > 1
+            """,
+            (list_ids[0], last_list_id),
+        ).fetchall()
+        for list_id, name_key, keep_id, quantity in duplicates:
+            conn.execute(
+                "UPDATE items SET quantity = ? WHERE id = ?", (quantity, keep_id)
+            )
+            conn.execute(
+                """
+                DELETE FROM items
+                WHERE list_id = ? AND name_key = ? AND deleted = 0 AND id != ?
+                """,
+                (list_id, name_key, keep_id),
+            )
+        if duplicates:
+            logger.info("Схлопнуто дубликатов названий: %d", len(duplicates))
+
+
+def _fold_item_history(conn):
+    # Записи истории с одинаковым ключом объединяются: использования
+    # суммируются, остается написание, которое использовали чаще всего
+    conn.create_function(
+        "normalize_item_name", 1, normalize_item_name, deterministic=True
+    )
+    conn.execute(
+        """
+        INSERT INTO item_history_new (user_id, name, name_key, uses, last_used)
+        SELECT user_id, name, name_key, total_uses, max_last_used FROM (
+            SELECT
+                user_id,
+                name,
+                name_key,
+                SUM(uses) OVER key_group AS total_uses,
+                MAX(last_used) OVER key_group AS max_last_used,
+                ROW_NUMBER() OVER (
+                    key_group ORDER BY uses DESC, last_used DESC, id
+                ) AS position
+            FROM (
+                SELECT *, normalize_item_name(name) AS name_key
+                FROM item_history
+            )
+            WINDOW key_group AS (PARTITION BY user_id, name_key)
+        )
+        WHERE position = 1
+        """
+    )
+
+
+# Миграции применяются по порядку, номер последней примененной
+# хранится в PRAGMA user_version. Шаг миграции - SQL-строка
+# или функция, принимающая соединение.
+MIGRATIONS = [
+    (
+        1,
+        [
+            """
+            CREATE INDEX IF NOT EXISTS idx_items_list_created
+            ON items (list_id, created_at, id, name, quantity)
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_items_list_name ON items (list_id, name)",
+            """
+            CREATE INDEX IF NOT EXISTS idx_shopping_lists_owner
+            ON shopping_lists (owner_id)
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_list_access_list ON list_access (list_id)",
+            "CREATE INDEX IF NOT EXISTS idx_invites_expires ON invites (expires_at)",
+            """
+            CREATE INDEX IF NOT EXISTS idx_invites_list_owner
+            ON invites (list_id, owner_id)
+            """,
+        ],
+    ),
+    (
+        2,
+        [
+            # Схлопывание дубликатов перед созданием уникального индекса
+            """
+            UPDATE items SET quantity = (
+                SELECT SUM(dup.quantity) FROM items dup
+                WHERE dup.list_id = items.list_id AND dup.name = items.name
+            )
+            WHERE id IN (
+                SELECT MIN(id) FROM items
+                GROUP BY list_id, name
+                HAVING COUNT(*) > 1
+            )
+            """,
+            """
+            DELETE FROM items WHERE id NOT IN (
+                SELECT MIN(id) FROM items GROUP BY list_id, name
+            )
+            """,
+            "DROP INDEX IF EXISTS idx_items_list_name",
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS ux_items_list_name
+            ON items (list_id, name)
+            """,
+        ],
+    ),
+    (
+        3,
+        [
+            # Счетчик элементов списка поддерживается триггерами,
+            # чтобы не считать COUNT(*) при каждом перелистывании
+            """
+            ALTER TABLE shopping_lists
+            ADD COLUMN item_count INTEGER NOT NULL DEFAULT 0
+            """,
+            """
+            UPDATE shopping_lists SET item_count = (
+                SELECT COUNT(*) FROM items WHERE items.list_id = shopping_lists.id
+            )
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_items_count_insert
+            AFTER INSERT ON items
+            BEGIN
+                UPDATE shopping_lists SET item_count = item_count + 1
+                WHERE id = NEW.list_id;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_items_count_delete
+            AFTER DELETE ON items
+            BEGIN
+                UPDATE shopping_lists SET item_count = item_count - 1
+                WHERE id = OLD.list_id;
+            END
+            """,
+        ],
+    ),
+    (
+        4,
+        [
+            """
+            CREATE TABLE IF NOT EXISTS user_states (
+                user_id INTEGER PRIMARY KEY,
+                state TEXT,
+                list_id INTEGER,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_user_states_updated
+            ON user_states (updated_at)
+            """,
+        ],
+    ),
+    (
+        5,
+        [
+            # Использованных приглашений немного, частичный индекс позволяет
+            # удалять их без просмотра всей таблицы
+            """
+            CREATE INDEX IF NOT EXISTS idx_invites_used
+            ON invites (id) WHERE used = 1
+            """,
+        ],
+    ),
+    (
+        6,
+        [
+            # Пересоздание таблиц с ON DELETE CASCADE: список удаляется одним
+            # запросом вместе с элементами, доступами и приглашениями. Строки,
+            # ссылающиеся на уже удаленные списки, не переносятся.
+            # Удаленные очисткой элементы помечаются deleted = 1 и физически
+            # удаляются фоновой задачей, индексы строятся только по живым
+            """
+            CREATE TABLE items_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                list_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                quantity INTEGER DEFAULT 1,
+                added_by INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                FOREIGN KEY (list_id) REFERENCES shopping_lists (id) ON DELETE CASCADE,
+                FOREIGN KEY (added_by) REFERENCES users (id)
+            )
+            """,
+            """
+            INSERT INTO items_new (id, list_id, name, quantity, added_by, created_at)
+            SELECT id, list_id, name, quantity, added_by, created_at FROM items
+            WHERE list_id IN (SELECT id FROM shopping_lists)
+            """,
+            "DROP TABLE items",
+            "ALTER TABLE items_new RENAME TO items",
+            """
+            CREATE INDEX idx_items_list_created
+            ON items (list_id, created_at, id, name, quantity) WHERE deleted = 0
+            """,
+            """
+            CREATE UNIQUE INDEX ux_items_list_name
+            ON items (list_id, name) WHERE deleted = 0
+            """,
+            "CREATE INDEX idx_items_deleted ON items (id) WHERE deleted = 1",
+            # Каскадное удаление ищет элементы списка без условия deleted = 0,
+            # частичные индексы для этого не подходят
+            "CREATE INDEX idx_items_list ON items (list_id)",
+            """
+            CREATE TRIGGER trg_items_count_insert
+            AFTER INSERT ON items
+            BEGIN
+                UPDATE shopping_lists SET item_count = item_count + 1
+                WHERE id = NEW.list_id;
+            END
+            """,
+            # Помеченные элементы уже не учтены в item_count
+            """
+            CREATE TRIGGER trg_items_count_delete
+            AFTER DELETE ON items
+            WHEN OLD.deleted = 0
+            BEGIN
+                UPDATE shopping_lists SET item_count = item_count - 1
+                WHERE id = OLD.list_id;
+            END
+            """,
+            """
+            CREATE TABLE list_access_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                list_id INTEGER NOT NULL,
+                role TEXT NOT NULL DEFAULT 'editor',
+                invited_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(user_id, list_id),
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                FOREIGN KEY (list_id) REFERENCES shopping_lists (id) ON DELETE CASCADE
+            )
+            """,
+            """
+            INSERT INTO list_access_new (id, user_id, list_id, role, invited_at)
+            SELECT id, user_id, list_id, role, invited_at FROM list_access
+            WHERE list_id IN (SELECT id FROM shopping_lists)
+            """,
+            "DROP TABLE list_access",
+            "ALTER TABLE list_access_new RENAME TO list_access",
+            "CREATE INDEX idx_list_access_list ON list_access (list_id)",
+            """
+            CREATE TABLE invites_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                token TEXT UNIQUE NOT NULL,
+                list_id INTEGER NOT NULL,
+                owner_id INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                used BOOLEAN DEFAULT FALSE,
+                expires_at TIMESTAMP DEFAULT (datetime('now', '+7 days')),
+                FOREIGN KEY (list_id) REFERENCES shopping_lists (id) ON DELETE CASCADE,
+                FOREIGN KEY (owner_id) REFERENCES users (id)
+            )
+            """,
+            """
+            INSERT INTO invites_new
+                (id, token, list_id, owner_id, created_at, used, expires_at)
+            SELECT id, token, list_id, owner_id, created_at, used, expires_at
+            FROM invites
+            WHERE list_id IN (SELECT id FROM shopping_lists)
+            """,
+            "DROP TABLE invites",
+            "ALTER TABLE invites_new RENAME TO invites",
+            "CREATE INDEX idx_invites_expires ON invites (expires_at)",
+            "CREATE INDEX idx_invites_list_owner ON invites (list_id, owner_id)",
+            "CREATE INDEX idx_invites_used ON invites (id) WHERE used = 1",
+        ],
+    ),
+    (
+        7,
+        [
+            # История названий, которые добавлял каждый пользователь, для
+            # подсказок в inline-режиме. Полнотекстовый индекс без хранения
+            # текста: пользователь - это токен u<id> в столбце owner, поэтому
+            # поиск по префиксу затрагивает только его историю. Индекс и
+            # история обновляются триггерами при добавлении элементов
+            """
+            CREATE TABLE item_history (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                uses INTEGER NOT NULL DEFAULT 1,
+                last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(user_id, name),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+            """,
+            """
+            CREATE VIRTUAL TABLE item_history_fts
+            USING fts5(owner, name, content='', prefix='2 3')
+            """,
+            """
+            CREATE TRIGGER trg_item_history_fts_insert
+            AFTER INSERT ON item_history
+            BEGIN
+                INSERT INTO item_history_fts (rowid, owner, name)
+                VALUES (NEW.id, 'u' || NEW.user_id, NEW.name);
+            END
+            """,
+            """
+            CREATE TRIGGER trg_item_history_fts_delete
+            AFTER DELETE ON item_history
+            BEGIN
+                INSERT INTO item_history_fts (item_history_fts, rowid, owner, name)
+                VALUES ('delete', OLD.id, 'u' || OLD.user_id, OLD.name);
+            END
+            """,
+            """
+            INSERT INTO item_history (user_id, name, uses, last_used)
+            SELECT added_by, name, COUNT(*), MAX(created_at) FROM items
+            GROUP BY added_by, name
+            """,
+            """
+            CREATE TRIGGER trg_items_history
+            AFTER INSERT ON items
+            BEGIN
+                INSERT INTO item_history (user_id, name)
+                VALUES (NEW.added_by, NEW.name)
+                ON CONFLICT (user_id, name)
+                DO UPDATE SET uses = uses + 1, last_used = CURRENT_TIMESTAMP;
+            END
+            """,
+        ],
+    ),
+    (
+        8,
+        [
+            # Нормализованное название (utils.normalize_item_name): элементы,
+            # отличающиеся регистром, пробелами или формой Unicode,
+            # объединяются по уникальному индексу. Ключ вычисляется в Python,
+            # поэтому заполняется функцией, зарегистрированной на время миграции
+            "ALTER TABLE items ADD COLUMN name_key TEXT",
+            _fill_name_keys,
+            _fold_name_key_duplicates,
+            "DROP INDEX ux_items_list_name",
+            """
+            CREATE UNIQUE INDEX ux_items_list_name_key
+            ON items (list_id, name_key) WHERE deleted = 0
+            """,
+            # История тоже ведется по нормализованному названию, иначе
+            # "Молоко" и "молоко " подсказываются отдельно. Таблица
+            # пересоздается с новым уникальным ключом, а полнотекстовый
+            # индекс заполняется заново под новые rowid. Историю теперь
+            # обновляет database.add_items_to_list: триггер на вставку не
+            # видел добавлений, объединенных с уже существующим элементом,
+            # и не знал, кто из участников списка их добавил
+            "DROP TRIGGER trg_items_history",
+            """
+            CREATE TABLE item_history_new (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                name_key TEXT NOT NULL,
+                uses INTEGER NOT NULL DEFAULT 1,
+                last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(user_id, name_key),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+            """,
+            _fold_item_history,
+            "DROP TABLE item_history",
+            "ALTER TABLE item_history_new RENAME TO item_history",
+            "INSERT INTO item_history_fts (item_history_fts) VALUES ('delete-all')",
+            """
+            INSERT INTO item_history_fts (rowid, owner, name)
+            SELECT id, 'u' || user_id, name FROM item_history
+            """,
+            """
+            CREATE TRIGGER trg_item_history_fts_insert
+            AFTER INSERT ON item_history
+            BEGIN
+                INSERT INTO item_history_fts (rowid, owner, name)
+                VALUES (NEW.id, 'u' || NEW.user_id, NEW.name);
+            END
+            """,
+            """
+            CREATE TRIGGER trg_item_history_fts_delete
+            AFTER DELETE ON item_history
+            BEGIN
+                INSERT INTO item_history_fts (item_history_fts, rowid, owner, name)
+                VALUES ('delete', OLD.id, 'u' || OLD.user_id, OLD.name);
+            END
+            """,
+        ],
+    ),
+]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migrations(conn):
+    current = get_schema_version(conn)
+    if current >= MIGRATIONS[-1][0]:
+        return current
+
+    # Пересоздание таблиц со ссылками возможно только с отключенной
+    # проверкой внешних ключей, PRAGMA не действует внутри транзакции
+    conn.execute("PRAGMA foreign_keys = OFF")
+    try:
+        current = _apply_pending(conn, current)
+        violations = conn.execute("PRAGMA foreign_key_check").fetchall()
+        if violations:
+            logger.warning("Нарушения внешних ключей: %d", len(violations))
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON")
+
+    return current
+
+
+def _apply_pending(conn, current):
+    for version, steps in MIGRATIONS:
+        if version <= current:
+            continue
+
+        logger.info("Применение миграции %d", version)
+        conn.execute("BEGIN")
+        try:
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        current = version
+
+    return current
+
+
+def _cascade_queries(conn):
+    # При удалении строки SQLite ищет ссылающиеся на нее строки запросом
+    # такого же вида, в плане самого DELETE этот поиск не виден
+    queries = {}
+    tables = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"
+    ).fetchall()
+    for (table,) in tables:
+        for row in conn.execute(f"PRAGMA foreign_key_list({table})"):
+            column, on_delete = row[3], row[6]
+            if on_delete == "CASCADE":
+                queries[f"cascade {table}.{column}"] = (
+                    f"SELECT 1 FROM {table} WHERE {column} = ?",
+                    (0,),
+                )
+    return queries
+
+
+def find_unindexed_plans(conn, queries):
+    problems = {}
+    queries = {**queries, **_cascade_queries(conn)}
+    for name, (sql, params) in queries.items():
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        # Полнотекстовый поиск в плане тоже выглядит как SCAN ... VIRTUAL TABLE
+        scans = [
+            row[3]
+            for row in plan
+            if row[3].startswith("SCAN") and "VIRTUAL TABLE" not in row[3]
+        ]
+        if scans:
+            problems[name] = scans
+    return problems
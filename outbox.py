@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def _retry_after_seconds(error):
+    delay = error.retry_after
+    if isinstance(delay, timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    # Общий лимит на все запросы к Bot API и отдельный лимит на каждый чат.
+    # При RetryAfter запрос повторяется после паузы, увеличивающейся
+    # с каждой попыткой
+    def __init__(self, global_rate, chat_rate, chat_burst, max_retries):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats = LRUCache(10000)
+        self._max_retries = max_retries
+        self.queue_depth = 0
+        self.requests = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self._chat_rate, self._chat_burst)
+            self._chats.put(chat_id, bucket)
+        return bucket
+
+    async def process_request(
+        self, callback, args, kwargs, endpoint, data, rate_limit_args
+    ):
+        started = time.monotonic()
+        chat_id = data.get("chat_id") if data else None
+
+        self.queue_depth += 1
+        try:
+            for attempt in range(self._max_retries + 1):
+                if chat_id is not None:
+                    await self._chat_bucket(chat_id).acquire()
+                await self._global.acquire()
+                try:
+                    return await callback(*args, **kwargs)
+                except RetryAfter as error:
+                    if attempt == self._max_retries:
+                        raise
+                    self.retries += 1
+                    delay = _retry_after_seconds(error) * (attempt + 1)
+                    logger.warning(
+                        "Превышен лимит запросов (%s), повтор через %.1f с",
+                        endpoint,
+                        delay,
+                    )
+                    await asyncio.sleep(delay)
+        finally:
+            self.queue_depth -= 1
+            latency = time.monotonic() - started
+            self.requests += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "requests": self.requests,
+            "retries": self.retries,
+            "avg_latency": self.total_latency / self.requests if self.requests else 0.0,
+            "max_latency": self.max_latency,
+        }
+
+
+class ReplyCoalescer:
+    # Подтверждения, отправленные в один чат в течение window секунд,
+    # объединяются в одно сообщение с суммарным количеством
+    def __init__(self, window):
+        self.window = window
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def add(self, bot, chat_id, count, text_template, reply_markup=None):
+        if self.window <= 0:
+            await bot.send_message(
+                chat_id, text_template.format(count=count), reply_markup=reply_markup
+            )
+            return
+
+        pending = self._pending.get(chat_id)
+        if pending:
+            pending["count"] += count
+            pending["reply_markup"] = reply_markup
+            return
+
+        self._pending[chat_id] = {
+            "bot": bot,
+            "count": count,
+            "text_template": text_template,
+            "reply_markup": reply_markup,
+            "task": asyncio.create_task(self._flush_later(chat_id)),
+        }
+
+    async def _flush_later(self, chat_id):
+        await asyncio.sleep(self.window)
+        await self._flush(chat_id)
+
+    async def _flush(self, chat_id):
+        pending = self._pending.pop(chat_id, None)
+        if not pending:
+            return
+        try:
+            await pending["bot"].send_message(
+                chat_id,
+                pending["text_template"].format(count=pending["count"]),
+                reply_markup=pending["reply_markup"],
+            )
+        except Exception:
+            logger.exception("Не удалось отправить подтверждение в чат %s", chat_id)
+
+    async def flush(self, chat_id):
+        # Отправляет подтверждение чата сразу, не дожидаясь конца окна
+        pending = self._pending.get(chat_id)
+        if pending:
+            pending["task"].cancel()
+            await self._flush(chat_id)
+
+    async def drain(self):
+        for chat_id in list(self._pending):
+            await self.flush(chat_id)
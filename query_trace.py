@@ -0,0 +1,196 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def normalize_sql(sql):
+    return _LITERAL_RE.sub("?", _WHITESPACE_RE.sub(" ", sql).strip())
+
+
+def params_shape(params):
+    if isinstance(params, dict):
+        types = (f"{key}: {type(value).__name__}" for key, value in params.items())
+        return "{" + ", ".join(types) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in params) + ")"
+
+
+class SlowQueryLog:
+    # Статистика по медленным запросам, сгруппированным по нормализованному
+    # тексту. При первом появлении запроса сохраняется его план выполнения
+    def __init__(self, threshold_ms, max_shapes=500):
+        self.threshold = threshold_ms / 1000
+        self.max_shapes = max_shapes
+        self._shapes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, conn, sql, params, elapsed, many=0):
+        if elapsed < self.threshold or sql.lstrip()[:7].upper() == "EXPLAIN":
+            return
+
+        normalized = normalize_sql(sql)
+        shape = params_shape(params)
+        if many:
+            shape = f"{many} x {shape}"
+
+        with self._lock:
+            entry = self._shapes.get(normalized)
+            is_new = entry is None
+            if is_new:
+                entry = {
+                    "sql": normalized,
+                    "count": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                    "params": shape,
+                    "plan": None,
+                }
+                self._shapes[normalized] = entry
+                while len(self._shapes) > self.max_shapes:
+                    self._shapes.popitem(last=False)
+            entry["count"] += 1
+            entry["total"] += elapsed
+            entry["max"] = max(entry["max"], elapsed)
+            entry["params"] = shape
+            self._shapes.move_to_end(normalized)
+
+        if is_new:
+            entry["plan"] = explain(conn, sql, params)
+
+        logger.warning(
+            "Медленный запрос (%.1f мс): %s %s", elapsed * 1000, normalized, shape
+        )
+
+    def report(self, limit=10):
+        with self._lock:
+            entries = sorted(
+                self._shapes.values(), key=lambda entry: entry["total"], reverse=True
+            )[:limit]
+            return [dict(entry) for entry in entries]
+
+    def reset(self):
+        with self._lock:
+            self._shapes.clear()
+
+
+def explain(conn, sql, params):
+    try:
+        rows = sqlite3.Connection.execute(conn, f"EXPLAIN QUERY PLAN {sql}", params)
+        return [row[3] for row in rows.fetchall()]
+    except sqlite3.Error:
+        return None
+
+
+class TracingCursor(sqlite3.Cursor):
+    # Время запроса складывается из execute и чтения строк: SQLite выполняет
+    # SELECT по мере выборки. Запрос записывается в журнал, когда строки
+    # закончились, курсор закрыт или удален либо выполняется следующий запрос
+    _pending = None
+
+    def _start(self, sql, params, many=0):
+        self._finish()
+        self._pending = [sql, params, 0.0, many]
+
+    def _finish(self):
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            sql, params, elapsed, many = pending
+            self.connection.slow_log.record(
+                self.connection, sql, params, elapsed, many=many
+            )
+
+    def _timed(self, method, args, finished):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = method(*args)
+            failed = False
+            return result
+        finally:
+            if self._pending is not None:
+                self._pending[2] += time.perf_counter() - started
+                if failed or finished(result):
+                    self._finish()
+
+    def execute(self, sql, params=()):
+        self._start(sql, params)
+        return self._timed(
+            super().execute, (sql, params), lambda _: self.description is None
+        )
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        self._start(
+            sql, seq_of_params[0] if seq_of_params else (), many=len(seq_of_params)
+        )
+        return self._timed(
+            super().executemany,
+            (sql, seq_of_params),
+            lambda _: self.description is None,
+        )
+
+    def fetchone(self):
+        return self._timed(super().fetchone, (), lambda row: row is None)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        return self._timed(super().fetchmany, (size,), lambda rows: not rows)
+
+    def fetchall(self):
+        return self._timed(super().fetchall, (), lambda _: True)
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+
+class TracingConnection(sqlite3.Connection):
+    # Соединение, замеряющее время каждого запроса. Подключается через
+    # параметр factory в sqlite3.connect
+    slow_log = None
+
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+def tracing_connection_factory(slow_log):
+    return type("TracingConnection", (TracingConnection,), {"slow_log": slow_log})
+
+
+def format_report(entries):
+    if not entries:
+        return "Медленных запросов не обнаружено"
+
+    lines = []
+    for index, entry in enumerate(entries, 1):
+        lines.append(
+            f"{index}. {entry['count']} раз, всего {entry['total'] * 1000:.0f} мс, "
+            f"макс. {entry['max'] * 1000:.0f} мс\n"
+            f"{entry['sql']}\nПараметры: {entry['params']}"
+        )
+        if entry["plan"]:
+            lines.append("План: " + "; ".join(entry["plan"]))
+    return "\n\n".join(lines)
@@ -0,0 +1,174 @@
+import gzip
+import hashlib
+import json
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+# Поля с пользователями и чатами: от них остается только обезличенный id.
+# Пользователи в других полях (forward_origin.sender_user,
+# new_chat_members, via_bot, ...) распознаются по набору ключей
+_IDENTITY_FIELDS = {"from", "chat", "user", "sender_chat"}
+# Текстовые поля, в которых слова заменяются псевдословами той же длины
+_TEXT_FIELDS = {"text", "caption", "query"}
+# Строки, которые заменяются хешем целиком
+_HASHED_FIELDS = {"chat_instance", "sender_user_name", "author_signature"}
+# Вложения и контакты боту не нужны и в запись не попадают
+_DROPPED_FIELDS = {
+    "contact",
+    "location",
+    "venue",
+    "photo",
+    "document",
+    "voice",
+    "video",
+    "video_note",
+    "audio",
+    "animation",
+    "sticker",
+}
+
+# Токены приглашений после start= и длинные последовательности с цифрами
+# (токены, номера телефонов) хешируются целиком, остальные слова
+# заменяются псевдословами
+_TEXT_RE = re.compile(
+    r"(?P<secret>(?<=start=)[\w-]+|\b(?=[\w-]*\d)[\w-]{8,}\b)"
+    r"|(?P<word>[^\W\d_]{2,})"
+)
+_LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def _key(salt):
+    return hashlib.sha256(salt.encode()).digest()
+
+
+def anonymize_id(salt, value):
+    # Одинаковые id в записи и в снимке базы (replay.py) отображаются
+    # в одинаковые значения, поэтому пользователи остаются связанными
+    digest = hashlib.blake2b(str(value).encode(), key=_key(salt), digest_size=6)
+    return int.from_bytes(digest.digest(), "big")
+
+
+def anonymize_token(salt, token):
+    return hashlib.blake2b(token.encode(), key=_key(salt), digest_size=8).hexdigest()
+
+
+def _pseudo_word(key, word):
+    digest = hashlib.blake2b(word.casefold().encode(), key=key).digest()
+    letters = "".join(_LETTERS[byte % len(_LETTERS)] for byte in digest)
+    return (letters * (len(word) // len(letters) + 1))[: len(word)]
+
+
+def anonymize_text(salt, text):
+    # Разделители, цифры и одиночные буквы (x3, х2) сохраняются, чтобы
+    # разбор элементов при воспроизведении шел по тем же веткам
+    command, separator = "", ""
+    if text.startswith("/"):
+        command, separator, text = text.partition(" ")
+        # Ссылка-приглашение /start <token>: токен обезличивается целиком
+        if command.split("@")[0] == "/start" and text.strip():
+            return f"{command} {anonymize_token(salt, text.strip())}"
+    key = _key(salt)
+
+    def replace(match):
+        if match.group("secret"):
+            return anonymize_token(salt, match.group())
+        return _pseudo_word(key, match.group())
+
+    return command + separator + _TEXT_RE.sub(replace, text)
+
+
+def _is_user(value):
+    return "id" in value and ("first_name" in value or "is_bot" in value)
+
+
+def _anonymize_entity(salt, value):
+    entity = {"id": anonymize_id(salt, value["id"])}
+    if "type" in value:
+        entity["type"] = value["type"]
+    else:
+        entity["is_bot"] = value.get("is_bot", False)
+        entity["first_name"] = "User"
+    return entity
+
+
+def anonymize_update(salt, data):
+    if isinstance(data, list):
+        return [anonymize_update(salt, value) for value in data]
+    if not isinstance(data, dict):
+        return data
+
+    if _is_user(data):
+        return _anonymize_entity(salt, data)
+
+    result = {}
+    for field, value in data.items():
+        if field in _DROPPED_FIELDS:
+            continue
+        if field in _IDENTITY_FIELDS and isinstance(value, dict) and "id" in value:
+            result[field] = _anonymize_entity(salt, value)
+        elif field in _TEXT_FIELDS and isinstance(value, str):
+            result[field] = anonymize_text(salt, value)
+        elif field in _HASHED_FIELDS and isinstance(value, str):
+            result[field] = anonymize_token(salt, value)
+        elif field == "url" and isinstance(value, str):
+            result[field] = f"https://example.invalid/{anonymize_token(salt, value)}"
+        else:
+            result[field] = anonymize_update(salt, value)
+    return result
+
+
+class UpdateRecorder:
+    # Запись входящих обновлений в обезличенный сжатый JSONL для replay.py.
+    # Подключается обработчиком TypeHandler в группе -1, до основных.
+    # Не реже чем раз в flush_interval секунд текущий gzip-member
+    # закрывается и начинается новый, поэтому при аварийном завершении
+    # теряются только последние секунды записи
+    def __init__(self, path, salt, flush_interval):
+        self.path = path
+        self.salt = salt
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self._pending = 0
+        self._open()
+        logger.info("Запись обновлений в %s", path)
+
+    def _open(self):
+        self._file = gzip.open(self.path, "at", encoding="utf-8")
+        self._opened = time.monotonic()
+
+    async def record(self, update, context):
+        line = {
+            "ts": time.time(),
+            "update": anonymize_update(self.salt, update.to_dict()),
+        }
+        self._file.write(json.dumps(line, ensure_ascii=False) + "\n")
+        self.recorded += 1
+        self._pending += 1
+        if time.monotonic() - self._opened >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        self._file.close()
+        self._pending = 0
+        self._open()
+
+    def close(self):
+        self._file.close()
+        logger.info("Записано обновлений: %d", self.recorded)
+
+
+def read_recording(path):
+    # Последний member после аварийного завершения может быть оборван,
+    # все предыдущие читаются полностью
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile):
+            logger.warning("Запись %s оборвана, прочитана до обрыва", path)
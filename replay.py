@@ -0,0 +1,255 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from loadtest import FakeBotAPI, TOKEN
+from recorder import anonymize_id, anonymize_token, read_recording
+
+# Воспроизведение записанных обновлений (RECORD_UPDATES_PATH) через
+# обработчики bot.py на копии снимка базы. Запросы к Bot API уходят на
+# поддельный сервер из loadtest.py, сеть не нужна:
+#
+#   python replay.py updates.jsonl.gz --db snapshot.db --salt ... --report a.json
+#   python replay.py updates.jsonl.gz --db snapshot.db --salt ... --speed 1
+#   python replay.py --compare a.json b.json --threshold 0.2
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Воспроизведение записи обновлений")
+    parser.add_argument("recording", nargs="?", help="файл записи .jsonl.gz")
+    parser.add_argument("--db", metavar="PATH", help="снимок базы (копируется)")
+    parser.add_argument("--salt", default="", help="соль, с которой сделана запись")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=0.0,
+        help="1 - исходный темп, 2 - вдвое быстрее, 0 - без пауз",
+    )
+    parser.add_argument("--report", metavar="PATH", help="сохранить отчет в JSON")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BASE", "NEW"), help="сравнить два отчета"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        help="допустимый рост p95 (0.2 = 20%%), при превышении код выхода 1",
+    )
+    args = parser.parse_args()
+    if not args.compare and not args.recording:
+        parser.error("нужен файл записи или --compare")
+    return args
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def prepare_snapshot(source, target, salt):
+    # Копия снимка с теми же обезличенными telegram_id и токенами
+    # приглашений, что и в записи
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    src.backup(dst)
+    src.close()
+
+    dst.create_function("anonymize_id", 1, lambda value: anonymize_id(salt, value))
+    dst.create_function(
+        "anonymize_token", 1, lambda value: anonymize_token(salt, value)
+    )
+    dst.execute("UPDATE users SET telegram_id = anonymize_id(telegram_id)")
+    dst.execute("UPDATE invites SET token = anonymize_token(token)")
+    dst.commit()
+    dst.close()
+
+
+class Samples:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.db_calls = defaultdict(int)
+        self.db_time = defaultdict(float)
+
+    def observe(self, handler, action, seconds, db_calls, db_time):
+        key = f"{handler}:{action}" if action else handler
+        self.latencies[key].append(seconds)
+        self.db_calls[key] += db_calls
+        self.db_time[key] += db_time
+
+    def report(self, updates, elapsed, api):
+        handlers = {}
+        for key, latencies in sorted(self.latencies.items()):
+            count = len(latencies)
+            latencies = sorted(latencies)
+            handlers[key] = {
+                "count": count,
+                "mean_ms": sum(latencies) / count * 1000,
+                "p50_ms": percentile(latencies, 0.5) * 1000,
+                "p95_ms": percentile(latencies, 0.95) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "db_calls": self.db_calls[key] / count,
+                "db_ms": self.db_time[key] / count * 1000,
+            }
+        return {
+            "updates": updates,
+            "elapsed": elapsed,
+            "updates_per_sec": updates / elapsed if elapsed else 0.0,
+            "handlers": handlers,
+            "api_calls": dict(api.calls),
+            "api_errors": dict(api.errors),
+        }
+
+
+async def replay(args, bot, records):
+    import metrics
+    from telegram import Update
+
+    samples = Samples()
+    metrics.add_observer(samples.observe)
+
+    api = FakeBotAPI(strict=False)
+    await api.start()
+
+    application = bot.build_application(TOKEN, base_url=api.base_url, rate_limit=False)
+
+    errors = defaultdict(int)
+
+    async def on_error(update, context):
+        errors[type(context.error).__name__] += 1
+
+    application.add_error_handler(on_error)
+
+    await application.initialize()
+    await application.start()
+
+    first_ts = records[0]["ts"] if records else 0
+    started = time.perf_counter()
+    for record in records:
+        if args.speed > 0:
+            delay = (record["ts"] - first_ts) / args.speed
+            delay -= time.perf_counter() - started
+            if delay > 0:
+                await asyncio.sleep(delay)
+        update = Update.de_json(record["update"], application.bot)
+        await application.update_queue.put(update)
+
+    # Обновление уже взято из очереди, но еще не попало в обработчик,
+    # поэтому простой должен продержаться несколько проверок подряд
+    idle_checks = 0
+    while idle_checks < 3:
+        await asyncio.sleep(0.01)
+        busy = (
+            not application.update_queue.empty()
+            or application.update_processor.pending_updates
+        )
+        idle_checks = 0 if busy else idle_checks + 1
+    elapsed = time.perf_counter() - started
+
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await api.stop()
+
+    report = samples.report(len(records), elapsed, api)
+    report["handler_errors"] = dict(errors)
+    return report
+
+
+def format_report(report):
+    lines = [
+        f"Обновлений: {report['updates']} за {report['elapsed']:.1f} с "
+        f"({report['updates_per_sec']:.1f} обн/с)",
+        "",
+        f"{'обработчик':<36}{'число':>8}{'p50, мс':>10}{'p95, мс':>10}"
+        f"{'p99, мс':>10}{'запросов':>10}",
+    ]
+    for key, handler in report["handlers"].items():
+        lines.append(
+            f"{key:<36}{handler['count']:>8}{handler['p50_ms']:>10.2f}"
+            f"{handler['p95_ms']:>10.2f}{handler['p99_ms']:>10.2f}"
+            f"{handler['db_calls']:>10.2f}"
+        )
+    for name, count in report.get("handler_errors", {}).items():
+        lines.append(f"Исключения в обработчиках {name}: {count}")
+    return "\n".join(lines)
+
+
+def compare(base, new, threshold):
+    # Возвращает строки сравнения и список регрессий. Число запросов к базе
+    # детерминировано, поэтому любой его рост считается регрессией
+    lines = [
+        f"{'обработчик':<36}{'p95 было':>10}{'p95 стало':>10}{'Δ p95':>8}"
+        f"{'запросов было':>15}{'стало':>8}"
+    ]
+    regressions = []
+    for key in sorted(set(base["handlers"]) | set(new["handlers"])):
+        old, cur = base["handlers"].get(key), new["handlers"].get(key)
+        if not old or not cur:
+            lines.append(f"{key:<36} есть только в {'новом' if cur else 'базовом'}")
+            continue
+
+        ratio = cur["p95_ms"] / old["p95_ms"] - 1 if old["p95_ms"] else 0.0
+        lines.append(
+            f"{key:<36}{old['p95_ms']:>10.2f}{cur['p95_ms']:>10.2f}{ratio:>8.0%}"
+            f"{old['db_calls']:>15.2f}{cur['db_calls']:>8.2f}"
+        )
+        if threshold is not None and ratio > threshold:
+            regressions.append(f"{key}: p95 вырос на {ratio:.0%}")
+        if cur["db_calls"] > old["db_calls"] + 1e-9:
+            regressions.append(
+                f"{key}: запросов к базе {old['db_calls']:.2f} -> {cur['db_calls']:.2f}"
+            )
+    return lines, regressions
+
+
+def main():
+    args = parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        lines, regressions = compare(base, new, args.threshold)
+        print("\n".join(lines))
+        for regression in regressions:
+            print(f"Регрессия: {regression}")
+        if regressions:
+            sys.exit(1)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="shopping-replay-")
+    database_path = os.path.join(workdir, "replay.db")
+    if args.db:
+        prepare_snapshot(args.db, database_path, args.salt)
+
+    os.environ["DATABASE_PATH"] = database_path
+    os.environ["BOT_TOKEN"] = TOKEN
+    os.environ["METRICS_COLLECT"] = "1"
+    os.environ["METRICS_PORT"] = "0"
+    os.environ["RECORD_UPDATES_PATH"] = ""
+
+    import bot
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    records = list(read_recording(args.recording))
+    bot.STORAGE.initialize()
+
+    report = asyncio.run(replay(args, bot, records))
+    print(format_report(report))
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Отчет сохранен в {args.report}")
+
+
+if __name__ == "__main__":
+    main()
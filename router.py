@@ -0,0 +1,112 @@
+from collections import namedtuple
+
+# Формат callback_data: "<код>:<аргумент>:<аргумент>...". Коды действий
+# короткие, целые числа записываются в base36, поэтому даже курсоры
+# постраничного просмотра помещаются в ограничение Telegram в 64 байта
+MAX_CALLBACK_DATA = 64
+SEPARATOR = ":"
+
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def encode_int(value):
+    if value < 0:
+        return "-" + encode_int(-value)
+    if value < 36:
+        return _DIGITS[value]
+    digits = []
+    while value:
+        value, remainder = divmod(value, 36)
+        digits.append(_DIGITS[remainder])
+    return "".join(reversed(digits))
+
+
+def decode_int(text):
+    return int(text, 36)
+
+
+def encode_str(value):
+    if SEPARATOR in value:
+        raise ValueError(f"Недопустимый символ {SEPARATOR!r} в аргументе: {value}")
+    return value
+
+
+_CODECS = {
+    int: (encode_int, decode_int),
+    str: (encode_str, str),
+}
+
+Route = namedtuple("Route", "name code handler encoders decoders required")
+
+
+class CallbackRouter:
+    # Таблица действий для inline-кнопок. Разбор занимает один split и
+    # один поиск по словарю, устаревшие и чужие данные отбрасываются до
+    # вызова обработчика
+    def __init__(self):
+        self._by_code = {}
+        self._by_name = {}
+
+    def register(self, name, code, handler, arg_types=(), required=None):
+        if not code or SEPARATOR in code:
+            raise ValueError(f"Недопустимый код действия: {code!r}")
+        if code in self._by_code or name in self._by_name:
+            raise ValueError(f"Действие уже зарегистрировано: {name} ({code})")
+
+        route = Route(
+            name,
+            code,
+            handler,
+            tuple(_CODECS[arg_type][0] for arg_type in arg_types),
+            tuple(_CODECS[arg_type][1] for arg_type in arg_types),
+            len(arg_types) if required is None else required,
+        )
+        self._by_code[code] = route
+        self._by_name[name] = route
+        return route
+
+    def route(self, name, code, *arg_types, required=None):
+        def decorator(handler):
+            self.register(name, code, handler, arg_types, required)
+            return handler
+
+        return decorator
+
+    def encode(self, name, *args):
+        route = self._by_name[name]
+        # Необязательные аргументы передаются все вместе или не передаются
+        if len(args) not in (route.required, len(route.encoders)):
+            raise ValueError(f"Неверное число аргументов для {name}: {len(args)}")
+
+        data = SEPARATOR.join(
+            [route.code]
+            + [encode(arg) for encode, arg in zip(route.encoders, args)]
+        )
+        if len(data.encode()) > MAX_CALLBACK_DATA:
+            raise ValueError(f"callback_data длиннее {MAX_CALLBACK_DATA} байт: {data}")
+        return data
+
+    def decode(self, data):
+        # Возвращает (route, args) или None для неизвестных данных
+        if not data or len(data.encode()) > MAX_CALLBACK_DATA:
+            return None
+
+        code, *parts = data.split(SEPARATOR)
+        route = self._by_code.get(code)
+        if route is None or len(parts) not in (route.required, len(route.decoders)):
+            return None
+
+        try:
+            args = [decode(part) for decode, part in zip(route.decoders, parts)]
+        except ValueError:
+            return None
+        return route, args
+
+    def dispatch(self, data, *context):
+        # Вызывает обработчик и возвращает его результат (для асинхронных
+        # обработчиков - корутину). Для неизвестных данных возвращает None
+        decoded = self.decode(data)
+        if decoded is None:
+            return None
+        route, args = decoded
+        return route.handler(*context, *args)
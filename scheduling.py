@@ -0,0 +1,78 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class KeyedLocks:
+    # Блокировки по ключам вида ("user", id) и ("list", id). Ключи
+    # захватываются в отсортированном порядке, поэтому взаимных блокировок
+    # не возникает. Блокировка удаляется, когда ее никто не ждет
+    def __init__(self):
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        keys = sorted(set(keys))
+        entries = []
+        for key in keys:
+            entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            entries.append(entry)
+
+        acquired = []
+        try:
+            for entry in entries:
+                await entry[0].acquire()
+                acquired.append(entry)
+            yield
+        finally:
+            for entry in reversed(acquired):
+                entry[0].release()
+            for key, entry in zip(keys, entries):
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+UPDATE_LOCKS = KeyedLocks()
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    # Обновления разных пользователей обрабатываются параллельно,
+    # обновления одного пользователя - строго по очереди. Блокировка
+    # пользователя берется до слота семафора: обновления, ждущие своей
+    # очереди, не занимают слоты CONCURRENT_UPDATES других пользователей
+    def __init__(self, max_concurrent_updates, locks=UPDATE_LOCKS):
+        super().__init__(max_concurrent_updates)
+        self._locks = locks
+        self.pending_updates = 0
+
+    async def process_update(self, update, coroutine):
+        self.pending_updates += 1
+        try:
+            user = getattr(update, "effective_user", None)
+            if user is None:
+                await super().process_update(update, coroutine)
+                return
+
+            async with self._locks.hold(("user", user.id)):
+                await super().process_update(update, coroutine)
+        finally:
+            self.pending_updates -= 1
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def list_lock(list_id):
+    return UPDATE_LOCKS.hold(("list", list_id))
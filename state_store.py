@@ -0,0 +1,130 @@
+import time
+from collections import OrderedDict
+
+from config import (
+    STATE_BACKEND,
+    STATE_TTL,
+    STATE_MAX_ENTRIES,
+    STATE_TOUCH_INTERVAL,
+    STORAGE_BACKEND,
+)
+
+
+class MemoryStateStore:
+    # Состояние диалога и текущий список пользователя. Записи, к которым не
+    # обращались дольше ttl секунд, удаляются, а при превышении max_entries
+    # вытесняются самые давние
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self, now):
+        expired = 0
+        while self._entries:
+            user_id, entry = next(iter(self._entries.items()))
+            if now - entry[2] < self.ttl:
+                break
+            del self._entries[user_id]
+            expired += 1
+        return expired
+
+    async def _entry(self, user_id):
+        now = time.monotonic()
+        self._expire(now)
+
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry[2] = now
+            self._entries.move_to_end(user_id)
+            return entry
+
+        state, list_id, age = await self._load(user_id)
+        # Пока состояние загружалось, его могла загрузить другая задача
+        entry = self._entries.get(user_id)
+        if entry is None:
+            # Последний элемент - когда состояние в последний раз сохранялось
+            entry = [state, list_id, now, now - age]
+            self._entries[user_id] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    async def _load(self, user_id):
+        return None, None, 0
+
+    async def purge_expired(self):
+        return self._expire(time.monotonic())
+
+    async def _save(self, user_id, state, list_id):
+        pass
+
+    async def get_state(self, user_id):
+        return (await self._entry(user_id))[0]
+
+    async def get_current_list(self, user_id):
+        return (await self._entry(user_id))[1]
+
+    async def set_state(self, user_id, state):
+        entry = await self._entry(user_id)
+        if entry[0] == state:
+            return
+        entry[0] = state
+        await self._save(user_id, entry[0], entry[1])
+
+    async def clear_state(self, user_id):
+        await self.set_state(user_id, None)
+
+    async def set_current_list(self, user_id, list_id):
+        entry = await self._entry(user_id)
+        if entry[1] == list_id:
+            return
+        entry[1] = list_id
+        await self._save(user_id, entry[0], entry[1])
+
+
+class SQLiteStateStore(MemoryStateStore):
+    # Чтение идет из памяти, изменения сразу записываются в хранилище
+    # (таблица user_states), поэтому состояние переживает перезапуск.
+    # Обращения продлевают updated_at не чаще раза в touch_interval секунд,
+    # чтобы purge_user_states не удалил состояние активного пользователя
+    def __init__(self, storage, ttl, max_entries, touch_interval):
+        super().__init__(ttl, max_entries)
+        self.storage = storage
+        self.touch_interval = touch_interval
+
+    async def _entry(self, user_id):
+        entry = await super()._entry(user_id)
+        now = entry[2]
+        if now - entry[3] >= self.touch_interval and entry[:2] != [None, None]:
+            entry[3] = now
+            await self.storage.touch_user_state(user_id)
+        return entry
+
+    async def _load(self, user_id):
+        saved = await self.storage.load_user_state(user_id, self.ttl)
+        return saved if saved else (None, None, 0)
+
+    async def _save(self, user_id, state, list_id):
+        await self.storage.save_user_state(user_id, state, list_id)
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry[3] = time.monotonic()
+
+    async def purge_expired(self):
+        await super().purge_expired()
+        return await self.storage.purge_user_states(self.ttl)
+
+
+def create_state_store(storage):
+    # Без SQLite-хранилища сохранять состояния некуда
+    if STATE_BACKEND == "memory" or STORAGE_BACKEND == "memory":
+        return MemoryStateStore(STATE_TTL, STATE_MAX_ENTRIES)
+    if STATE_BACKEND == "sqlite":
+        return SQLiteStateStore(
+            storage, STATE_TTL, STATE_MAX_ENTRIES, STATE_TOUCH_INTERVAL
+        )
+    raise ValueError(f"Неизвестное хранилище состояний: {STATE_BACKEND}")
@@ -0,0 +1,633 @@
+import asyncio
+import bisect
+import functools
+import itertools
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import metrics
+from utils import normalize_item_name, suggest_key, suggest_words
+from config import (
+    DB_EXECUTOR_WORKERS,
+    STORAGE_BACKEND,
+    ITEMS_PER_PAGE,
+    INVITE_REUSE_MIN_TTL,
+)
+
+# Все обращения к SQLite выполняются в отдельных потоках,
+# чтобы медленный commit не блокировал цикл событий
+_executor = ThreadPoolExecutor(
+    max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db"
+)
+
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    if not metrics.ENABLED:
+        return await loop.run_in_executor(_executor, call)
+
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_executor, call)
+    finally:
+        metrics.record_db_call(func.__name__, time.perf_counter() - started)
+
+
+def shutdown_db_executor():
+    _executor.shutdown(wait=True)
+
+
+class Storage(ABC):
+    # Интерфейс хранилища, от которого зависят обработчики. Все методы,
+    # кроме initialize, close, get_list_version, pending_activity_count,
+    # user_cache_stats и slow_query_report, асинхронные. Хранилище, в котором
+    # реализованы не все методы, нельзя создать
+    @abstractmethod
+    def initialize(self):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+    @abstractmethod
+    def get_list_version(self, list_id):
+        pass
+
+    @abstractmethod
+    def pending_activity_count(self):
+        pass
+
+    @abstractmethod
+    def user_cache_stats(self):
+        # Словарь с ключами size, hits и misses для метрик
+        pass
+
+    @abstractmethod
+    def slow_query_report(self, limit):
+        # Самые медленные запросы или None, если журнал недоступен
+        pass
+
+    @abstractmethod
+    async def create_user(self, telegram_id):
+        pass
+
+    @abstractmethod
+    async def update_user_activity(self, telegram_id):
+        pass
+
+    @abstractmethod
+    async def flush_user_activity(self):
+        pass
+
+    @abstractmethod
+    async def get_user_lists(self, user_id):
+        pass
+
+    @abstractmethod
+    async def create_list(self, name, owner_id):
+        pass
+
+    @abstractmethod
+    async def delete_list(self, list_id, user_id):
+        pass
+
+    @abstractmethod
+    async def get_list_details(self, list_id, user_id):
+        pass
+
+    @abstractmethod
+    async def get_list_items(self, list_id):
+        pass
+
+    @abstractmethod
+    async def get_list_items_page(
+        self, list_id, cursor=None, backward=False, limit=ITEMS_PER_PAGE
+    ):
+        pass
+
+    @abstractmethod
+    async def get_list_item_count(self, list_id):
+        pass
+
+    @abstractmethod
+    async def add_item_to_list(self, list_id, item_name, quantity, user_id):
+        pass
+
+    @abstractmethod
+    async def add_items_to_list(self, list_id, items, user_id):
+        pass
+
+    @abstractmethod
+    async def delete_item(self, item_id):
+        pass
+
+    @abstractmethod
+    async def clear_list_items(self, list_id):
+        pass
+
+    @abstractmethod
+    async def invite_user_to_list(self, list_id, user_telegram_id, inviter_id):
+        pass
+
+    @abstractmethod
+    async def invite_user_to_list_as_admin(self, list_id, user_telegram_id, inviter_id):
+        pass
+
+    @abstractmethod
+    async def get_list_owner(self, list_id):
+        pass
+
+    @abstractmethod
+    async def save_invite_token(self, token, list_id, owner_id):
+        pass
+
+    @abstractmethod
+    async def get_or_create_invite_token(self, list_id, owner_id, new_token):
+        pass
+
+    @abstractmethod
+    async def get_invite_by_token(self, token):
+        pass
+
+    @abstractmethod
+    async def mark_invite_used(self, token):
+        pass
+
+    @abstractmethod
+    async def purge_invites(self, batch_size, max_batches):
+        pass
+
+    @abstractmethod
+    async def purge_deleted_items(self, batch_size, max_batches):
+        pass
+
+    @abstractmethod
+    async def suggest_items(self, user_id, text, limit):
+        pass
+
+    @abstractmethod
+    async def reclaim_free_pages(self, pages_per_step, max_steps):
+        pass
+
+    # Сохраненные состояния диалогов, см. state_store.py. load_user_state
+    # возвращает (state, list_id, возраст в секундах) или None
+    @abstractmethod
+    async def load_user_state(self, user_id, max_age):
+        pass
+
+    @abstractmethod
+    async def save_user_state(self, user_id, state, list_id):
+        pass
+
+    @abstractmethod
+    async def touch_user_state(self, user_id):
+        pass
+
+    @abstractmethod
+    async def purge_user_states(self, max_age):
+        pass
+
+
+def _in_executor(func):
+    @functools.wraps(func)
+    async def method(self, *args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+
+    return method
+
+
+class SQLiteStorage(Storage):
+    # Функции database.py, выполняемые в потоках _executor
+    def initialize(self):
+        database.init_db()
+        return database.warm_user_cache()
+
+    def close(self):
+        database.close_db_connections()
+
+    def get_list_version(self, list_id):
+        return database.get_list_version(list_id)
+
+    def pending_activity_count(self):
+        return database.pending_activity_count()
+
+    def user_cache_stats(self):
+        return database.USER_ID_CACHE.stats()
+
+    def slow_query_report(self, limit):
+        if database.SLOW_QUERY_LOG is None:
+            return None
+        return database.SLOW_QUERY_LOG.report(limit)
+
+    async def create_user(self, telegram_id):
+        # Известные пользователи обслуживаются из кэша без перехода в поток БД
+        user_id = database.USER_ID_CACHE.get(telegram_id)
+        if user_id is not None:
+            return user_id
+        return await run_db(database.register_user, telegram_id)
+
+    async def update_user_activity(self, telegram_id):
+        # Запись откладывается до flush_user_activity
+        database.update_user_activity(telegram_id)
+
+    async def get_invite_by_token(self, token):
+        invite = database.INVITE_CACHE.get(token)
+        if invite is not None:
+            return invite
+        return await run_db(database.get_invite_by_token, token)
+
+    async def suggest_items(self, user_id, text, limit):
+        names = database.SUGGEST_CACHE.get(suggest_key(user_id, text))
+        if names is not None:
+            return names[:limit]
+        return await run_db(database.suggest_items, user_id, text, limit)
+
+    flush_user_activity = _in_executor(database.flush_user_activity)
+    get_user_lists = _in_executor(database.get_user_lists)
+    create_list = _in_executor(database.create_list)
+    delete_list = _in_executor(database.delete_list)
+    get_list_details = _in_executor(database.get_list_details)
+    get_list_items = _in_executor(database.get_list_items)
+    get_list_items_page = _in_executor(database.get_list_items_page)
+    get_list_item_count = _in_executor(database.get_list_item_count)
+    add_item_to_list = _in_executor(database.add_item_to_list)
+    add_items_to_list = _in_executor(database.add_items_to_list)
+    delete_item = _in_executor(database.delete_item)
+    clear_list_items = _in_executor(database.clear_list_items)
+    invite_user_to_list = _in_executor(database.invite_user_to_list)
+    invite_user_to_list_as_admin = _in_executor(database.invite_user_to_list_as_admin)
+    get_list_owner = _in_executor(database.get_list_owner)
+    save_invite_token = _in_executor(database.save_invite_token)
+    get_or_create_invite_token = _in_executor(database.get_or_create_invite_token)
+    mark_invite_used = _in_executor(database.mark_invite_used)
+    purge_invites = _in_executor(database.purge_invites)
+    purge_deleted_items = _in_executor(database.purge_deleted_items)
+    reclaim_free_pages = _in_executor(database.reclaim_free_pages)
+    load_user_state = _in_executor(database.load_user_state)
+    save_user_state = _in_executor(database.save_user_state)
+    touch_user_state = _in_executor(database.touch_user_state)
+    purge_user_states = _in_executor(database.purge_user_states)
+
+
+# Срок действия приглашения, как в значении по умолчанию invites.expires_at
+INVITE_LIFETIME = 7 * 24 * 60 * 60
+
+
+class MemoryStorage(Storage):
+    # Все данные в словарях с индексами по пользователям, спискам и токенам,
+    # без потоков и без сохранения между запусками. Порядок элементов
+    # списка совпадает с порядком id, поэтому курсор страницы - это id
+    def __init__(self):
+        self._user_ids = itertools.count(1)
+        self._list_ids = itertools.count(1)
+        self._item_ids = itertools.count(1)
+
+        self._users = {}  # telegram_id -> id
+        self._telegram_ids = {}  # id -> telegram_id
+        self._last_active = {}
+        self._lists = {}  # id -> {"id", "name", "owner_id"}
+        self._access = defaultdict(dict)  # user_id -> {list_id: role}
+        self._members = defaultdict(set)  # list_id -> {user_id}
+        self._items = {}  # id -> элемент
+        self._items_by_key = defaultdict(dict)  # list_id -> {name_key: элемент}
+        self._item_order = defaultdict(list)  # list_id -> [id] по возрастанию
+        self._deleted_items = []  # id очищенных элементов до purge_deleted_items
+        # user_id -> {name_key: (uses, порядок, название)}
+        self._history = defaultdict(dict)
+        self._history_clock = itertools.count(1)
+        self._invites = {}  # token -> приглашение
+        self._list_invites = defaultdict(set)  # list_id -> {token}
+        self._versions = defaultdict(int)
+        self._user_states = {}  # user_id -> [state, list_id, время изменения]
+
+    def initialize(self):
+        return 0
+
+    def close(self):
+        pass
+
+    def get_list_version(self, list_id):
+        return self._versions.get(list_id, 0)
+
+    def pending_activity_count(self):
+        return 0
+
+    def user_cache_stats(self):
+        # Кэша нет, все пользователи и так в памяти
+        return {"size": len(self._users), "hits": 0, "misses": 0}
+
+    def slow_query_report(self, limit):
+        return None
+
+    def _register(self, telegram_id):
+        user_id = self._users.get(telegram_id)
+        if user_id is None:
+            user_id = next(self._user_ids)
+            self._users[telegram_id] = user_id
+            self._telegram_ids[user_id] = telegram_id
+        return user_id
+
+    def _has_access(self, list_id, user_id):
+        shopping_list = self._lists.get(list_id)
+        return shopping_list is not None and (
+            shopping_list["owner_id"] == user_id or user_id in self._members[list_id]
+        )
+
+    async def create_user(self, telegram_id):
+        return self._register(telegram_id)
+
+    async def update_user_activity(self, telegram_id):
+        self._last_active[telegram_id] = time.time()
+
+    async def flush_user_activity(self):
+        return 0
+
+    async def get_user_lists(self, user_id):
+        lists = []
+        for list_id in sorted(self._access.get(user_id, ()), reverse=True):
+            shopping_list = self._lists[list_id]
+            role = (
+                "owner"
+                if shopping_list["owner_id"] == user_id
+                else self._access[user_id][list_id]
+            )
+            lists.append(dict(shopping_list, user_role=role))
+        return lists
+
+    async def create_list(self, name, owner_id):
+        list_id = next(self._list_ids)
+        self._lists[list_id] = {"id": list_id, "name": name, "owner_id": owner_id}
+        self._access[owner_id][list_id] = "owner"
+        self._members[list_id].add(owner_id)
+        return list_id
+
+    async def delete_list(self, list_id, user_id):
+        shopping_list = self._lists.get(list_id)
+        if not shopping_list or shopping_list["owner_id"] != user_id:
+            return False
+
+        for item_id in self._item_order.pop(list_id, ()):
+            del self._items[item_id]
+        self._items_by_key.pop(list_id, None)
+        for member_id in self._members.pop(list_id, ()):
+            self._access[member_id].pop(list_id, None)
+        for token in self._list_invites.pop(list_id, ()):
+            del self._invites[token]
+        del self._lists[list_id]
+        self._versions[list_id] += 1
+        return True
+
+    async def get_list_details(self, list_id, user_id):
+        if not self._has_access(list_id, user_id):
+            return None
+        shopping_list = self._lists[list_id]
+        return dict(
+            shopping_list,
+            owner_telegram_id=self._telegram_ids.get(shopping_list["owner_id"]),
+        )
+
+    async def get_list_items(self, list_id):
+        return [
+            {"id": item["id"], "name": item["name"], "quantity": item["quantity"]}
+            for item in map(self._items.get, self._item_order.get(list_id, ()))
+        ]
+
+    async def get_list_items_page(
+        self, list_id, cursor=None, backward=False, limit=ITEMS_PER_PAGE
+    ):
+        order = self._item_order.get(list_id, [])
+        item_id = cursor[1] if cursor else 0
+        if backward:
+            end = bisect.bisect_left(order, item_id)
+            start = max(end - limit, 0)
+            has_more = start > 0
+        else:
+            start = bisect.bisect_right(order, item_id)
+            end = start + limit
+            has_more = end < len(order)
+        return [dict(self._items[item_id]) for item_id in order[start:end]], has_more
+
+    async def get_list_item_count(self, list_id):
+        return len(self._item_order.get(list_id, ()))
+
+    async def add_item_to_list(self, list_id, item_name, quantity, user_id):
+        await self.add_items_to_list(list_id, [(item_name, quantity)], user_id)
+
+    async def add_items_to_list(self, list_id, items, user_id):
+        merged = {}
+        for item_name, quantity in items:
+            name_key = normalize_item_name(item_name)
+            if name_key in merged:
+                item_name, total = merged[name_key]
+                quantity += total
+            merged[name_key] = (item_name, quantity)
+
+        if not merged:
+            return 0
+
+        by_key = self._items_by_key[list_id]
+        created_ts = int(time.time())
+        history = self._history[user_id]
+        for name_key, (item_name, quantity) in merged.items():
+            uses, _, name = history.get(name_key, (0, 0, item_name))
+            history[name_key] = (uses + 1, next(self._history_clock), name)
+
+            item = by_key.get(name_key)
+            if item is not None:
+                item["quantity"] += quantity
+                continue
+            item = {
+                "id": next(self._item_ids),
+                "name": item_name,
+                "quantity": quantity,
+                "created_ts": created_ts,
+                "list_id": list_id,
+                "added_by": user_id,
+            }
+            self._items[item["id"]] = item
+            by_key[name_key] = item
+            self._item_order[list_id].append(item["id"])
+        self._versions[list_id] += 1
+
+        return len(merged)
+
+    async def delete_item(self, item_id):
+        item = self._items.pop(item_id, None)
+        if item is None:
+            return
+        list_id = item["list_id"]
+        by_key = self._items_by_key[list_id]
+        name_key = normalize_item_name(item["name"])
+        if by_key.get(name_key) is not item:
+            # Элемент уже удален очисткой списка
+            return
+        del by_key[name_key]
+        order = self._item_order[list_id]
+        del order[bisect.bisect_left(order, item_id)]
+        self._versions[list_id] += 1
+
+    async def clear_list_items(self, list_id):
+        # Как и в SQLite, сами элементы удаляет purge_deleted_items
+        self._deleted_items.extend(self._item_order.pop(list_id, ()))
+        self._items_by_key.pop(list_id, None)
+        self._versions[list_id] += 1
+
+    async def purge_deleted_items(self, batch_size, max_batches):
+        purged = self._deleted_items[: batch_size * max_batches]
+        del self._deleted_items[: len(purged)]
+        for item_id in purged:
+            self._items.pop(item_id, None)
+        return len(purged)
+
+    async def reclaim_free_pages(self, pages_per_step, max_steps):
+        return 0
+
+    async def load_user_state(self, user_id, max_age):
+        saved = self._user_states.get(user_id)
+        if saved is None:
+            return None
+        age = int(time.time() - saved[2])
+        if age >= max_age:
+            return None
+        return saved[0], saved[1], age
+
+    async def save_user_state(self, user_id, state, list_id):
+        if state is None and list_id is None:
+            self._user_states.pop(user_id, None)
+        else:
+            self._user_states[user_id] = [state, list_id, time.time()]
+
+    async def touch_user_state(self, user_id):
+        saved = self._user_states.get(user_id)
+        if saved is not None:
+            saved[2] = time.time()
+
+    async def purge_user_states(self, max_age):
+        deadline = time.time() - max_age
+        expired = [
+            user_id
+            for user_id, saved in self._user_states.items()
+            if saved[2] <= deadline
+        ]
+        for user_id in expired:
+            del self._user_states[user_id]
+        return len(expired)
+
+    async def suggest_items(self, user_id, text, limit):
+        # Каждое слово запроса должно быть префиксом какого-либо слова
+        # названия, как в полнотекстовом поиске SQLite
+        _, prefix = suggest_key(user_id, text)
+        words = prefix.split()
+        entries = [
+            entry
+            for entry in self._history.get(user_id, {}).values()
+            if all(
+                any(token.startswith(word) for token in suggest_words(entry[2]))
+                for word in words
+            )
+        ]
+        entries.sort(reverse=True)
+        return [name for _, _, name in entries[:limit]]
+
+    def _grant(self, list_id, user_id, role):
+        if list_id in self._access[user_id]:
+            return False
+        self._access[user_id][list_id] = role
+        self._members[list_id].add(user_id)
+        return True
+
+    async def invite_user_to_list(self, list_id, user_telegram_id, inviter_id):
+        if not self._has_access(list_id, inviter_id):
+            return False, "У вас нет доступа к этому списку"
+
+        user_id = self._users.get(user_telegram_id)
+        if user_id is None:
+            return False, "Пользователь не найден"
+
+        if not self._grant(list_id, user_id, "editor"):
+            return False, "Пользователь уже имеет доступ к списку"
+        return True, "Пользователь успешно приглашен"
+
+    async def invite_user_to_list_as_admin(self, list_id, user_telegram_id, inviter_id):
+        user_id = self._register(user_telegram_id)
+        if not self._grant(list_id, user_id, "owner"):
+            return False, "Пользователь уже имеет доступ к списку"
+        return True, "Пользователь успешно приглашен как администратор"
+
+    async def get_list_owner(self, list_id):
+        shopping_list = self._lists.get(list_id)
+        if not shopping_list:
+            return None
+        return self._telegram_ids.get(shopping_list["owner_id"])
+
+    async def save_invite_token(self, token, list_id, owner_id):
+        if token in self._invites:
+            raise ValueError(f"Токен приглашения уже существует: {token}")
+        self._invites[token] = {
+            "token": token,
+            "list_id": list_id,
+            "owner_id": owner_id,
+            "used": False,
+            "expires_ts": int(time.time()) + INVITE_LIFETIME,
+        }
+        self._list_invites[list_id].add(token)
+
+    async def get_or_create_invite_token(self, list_id, owner_id, new_token):
+        # Действующее приглашение переиспользуется, если до его истечения
+        # осталось не меньше INVITE_REUSE_MIN_TTL секунд
+        reusable_after = time.time() + INVITE_REUSE_MIN_TTL
+        best = None
+        for token in self._list_invites.get(list_id, ()):
+            invite = self._invites[token]
+            if (
+                invite["owner_id"] == owner_id
+                and not invite["used"]
+                and invite["expires_ts"] > reusable_after
+                and (best is None or invite["expires_ts"] > best["expires_ts"])
+            ):
+                best = invite
+        if best is not None:
+            return best["token"]
+
+        await self.save_invite_token(new_token, list_id, owner_id)
+        return new_token
+
+    async def get_invite_by_token(self, token):
+        invite = self._invites.get(token)
+        if not invite or invite["used"] or invite["expires_ts"] <= time.time():
+            return None
+        return {
+            "list_id": invite["list_id"],
+            "owner_id": invite["owner_id"],
+            "expires_ts": invite["expires_ts"],
+        }
+
+    async def mark_invite_used(self, token):
+        invite = self._invites.get(token)
+        if invite:
+            invite["used"] = True
+
+    async def purge_invites(self, batch_size, max_batches):
+        now = time.time()
+        stale = [
+            token
+            for token, invite in self._invites.items()
+            if invite["used"] or invite["expires_ts"] <= now
+        ][: batch_size * max_batches]
+        for token in stale:
+            invite = self._invites.pop(token)
+            self._list_invites[invite["list_id"]].discard(token)
+        return len(stale)
+
+
+def create_storage():
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage()
+    if STORAGE_BACKEND == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Неизвестное хранилище данных: {STORAGE_BACKEND}")
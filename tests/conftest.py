@@ -0,0 +1,77 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Модули читают config.py при импорте, поэтому окружение задается до них.
+# Тесты работают с хранилищем в памяти и без сервера метрик
+_workdir = tempfile.mkdtemp(prefix="shopping-tests-")
+os.environ["BOT_TOKEN"] = "100000:loadtest"
+os.environ["BOT_USERNAME"] = "loadtest_bot"
+os.environ["DATABASE_PATH"] = os.path.join(_workdir, "tests.db")
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ["METRICS_PORT"] = "0"
+os.environ["RECORD_UPDATES_PATH"] = ""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _clear_caches(database):
+    database.USER_ID_CACHE.clear()
+    database.INVITE_CACHE.clear()
+    database.SUGGEST_CACHE.clear()
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    # Отдельная база на каждый тест: модуль database с новым пулом
+    # соединений, пустыми кэшами и буфером активности
+    import database
+
+    monkeypatch.setattr(database, "DATABASE_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(database, "_pool", database.ConnectionPool(2))
+    monkeypatch.setattr(database, "_list_versions", {})
+    monkeypatch.setattr(database, "_activity", database.ActivityBuffer())
+    _clear_caches(database)
+    database.init_db()
+    yield database
+    database.close_db_connections()
+    _clear_caches(database)
+
+
+@pytest.fixture
+def use_storage(monkeypatch):
+    # Подменяет хранилище, с которым работают обработчики бота: имена из
+    # async_database уже импортированы в handlers и bot
+    def install(storage, state_store):
+        import async_database
+        import bot
+        import handlers
+
+        for module in (async_database, handlers, bot):
+            for name in async_database.__all__:
+                if name == "STORAGE":
+                    monkeypatch.setattr(module, name, storage, raising=False)
+                elif hasattr(storage, name) and hasattr(module, name):
+                    monkeypatch.setattr(module, name, getattr(storage, name))
+        monkeypatch.setattr(handlers, "STATE_STORE", state_store)
+        monkeypatch.setattr(bot, "STATE_STORE", state_store, raising=False)
+        handlers.LIST_VIEW_CACHE.clear()
+        return storage
+
+    return install
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def engine(request, use_storage):
+    # Хранилище обработчиков: в памяти или SQLite на отдельной базе
+    from state_store import MemoryStateStore
+    from storage import MemoryStorage, SQLiteStorage
+
+    if request.param == "sqlite":
+        request.getfixturevalue("sqlite_db")
+        storage = SQLiteStorage()
+    else:
+        storage = MemoryStorage()
+    return use_storage(storage, MemoryStateStore(3600, 1000))
@@ -0,0 +1,357 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+from cache import LRUCache
+from config import CLEAR_SOFT_DELETE_MIN, INVITE_REUSE_MIN_TTL
+from migrations import MIGRATIONS, find_unindexed_plans, get_schema_version
+
+
+def _count(db, sql, params=()):
+    with db.get_db_connection(readonly=True) as conn:
+        return conn.execute(sql, params).fetchone()[0]
+
+
+def _list_with_items(db, count, telegram_id=1, name="товар"):
+    user_id = db.create_user(telegram_id)
+    list_id = db.create_list("покупки", user_id)
+    db.add_items_to_list(list_id, [(f"{name} {n}", 1) for n in range(count)], user_id)
+    return user_id, list_id
+
+
+def test_delete_list_cascades_through_an_index(sqlite_db):
+    db = sqlite_db
+    owner_id, list_id = _list_with_items(db, 30)
+    db.create_user(2)
+    db.invite_user_to_list(list_id, 2, owner_id)
+    db.save_invite_token("token", list_id, owner_id)
+    _, other_list_id = _list_with_items(db, 3, telegram_id=3)
+
+    assert db.delete_list(list_id, owner_id)
+    for table in ("items", "list_access", "invites"):
+        sql = f"SELECT COUNT(*) FROM {table} WHERE list_id = ?"
+        assert not _count(db, sql, (list_id,))
+    assert _count(db, "SELECT COUNT(*) FROM items") == 3
+    assert db.get_list_item_count(other_list_id) == 3
+
+    with db.get_db_connection(readonly=True) as conn:
+        assert find_unindexed_plans(conn, db._hot_queries()) == {}
+
+
+def test_soft_deleted_items_are_hidden_until_purged(sqlite_db):
+    db = sqlite_db
+    user_id, list_id = _list_with_items(db, CLEAR_SOFT_DELETE_MIN)
+
+    db.clear_list_items(list_id)
+    # Строки на месте, но список уже пуст
+    assert _count(db, "SELECT COUNT(*) FROM items") == CLEAR_SOFT_DELETE_MIN
+    assert db.get_list_items(list_id) == []
+    assert db.get_list_items_page(list_id) == ([], False)
+    assert db.get_list_item_count(list_id) == 0
+
+    # Помеченный элемент не мешает добавить то же название заново
+    db.add_items_to_list(list_id, [("товар 0", 2)], user_id)
+    items = db.get_list_items(list_id)
+    assert [(row["name"], row["quantity"]) for row in items] == [("товар 0", 2)]
+    assert db.get_list_item_count(list_id) == 1
+
+    assert db.purge_deleted_items(50, 100) == CLEAR_SOFT_DELETE_MIN
+    assert _count(db, "SELECT COUNT(*) FROM items") == 1
+    assert db.get_list_item_count(list_id) == 1
+
+
+def test_small_lists_are_cleared_at_once(sqlite_db):
+    db = sqlite_db
+    _, list_id = _list_with_items(db, CLEAR_SOFT_DELETE_MIN - 1)
+
+    db.clear_list_items(list_id)
+    assert _count(db, "SELECT COUNT(*) FROM items") == 0
+    assert db.get_list_item_count(list_id) == 0
+    assert db.purge_deleted_items(50, 100) == 0
+
+
+def test_purge_is_limited_by_batches(sqlite_db):
+    db = sqlite_db
+    _, list_id = _list_with_items(db, CLEAR_SOFT_DELETE_MIN)
+    db.clear_list_items(list_id)
+
+    assert db.purge_deleted_items(30, 2) == 60
+    assert db.purge_deleted_items(30, 100) == CLEAR_SOFT_DELETE_MIN - 60
+    assert db.purge_deleted_items(30, 100) == 0
+
+
+def test_free_pages_are_returned_to_the_file(sqlite_db):
+    db = sqlite_db
+    user_id, list_id = _list_with_items(db, 2000, name="x" * 100)
+    with db.get_db_connection() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    size = os.path.getsize(db.DATABASE_PATH)
+
+    db.delete_list(list_id, user_id)
+    free = _count(db, "PRAGMA freelist_count")
+    assert free > 0
+
+    assert db.reclaim_free_pages(free // 4, 2) == free // 4 * 2
+    assert db.reclaim_free_pages(free, 10) == free - free // 4 * 2
+    assert _count(db, "PRAGMA freelist_count") == 0
+    with db.get_db_connection() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    assert os.path.getsize(db.DATABASE_PATH) < size
+
+
+def _set_expiry(db, token, modifier):
+    with db.get_db_connection() as conn:
+        conn.execute(
+            "UPDATE invites SET expires_at = datetime('now', ?) WHERE token = ?",
+            (modifier, token),
+        )
+        conn.commit()
+
+
+def test_invite_is_reused_while_it_lives_long_enough(sqlite_db):
+    db = sqlite_db
+    owner_id, list_id = _list_with_items(db, 1)
+    other_id = db.create_user(2)
+
+    assert db.get_or_create_invite_token(list_id, owner_id, "a") == "a"
+    assert db.get_or_create_invite_token(list_id, owner_id, "b") == "a"
+    assert db.get_or_create_invite_token(list_id, other_id, "c") == "c"
+
+    # Приглашение, которое скоро истечет, заменяется новым
+    _set_expiry(db, "a", f"+{INVITE_REUSE_MIN_TTL - 60} seconds")
+    assert db.get_or_create_invite_token(list_id, owner_id, "d") == "d"
+    assert db.get_or_create_invite_token(list_id, owner_id, "e") == "d"
+    db.mark_invite_used("d")
+    assert db.get_or_create_invite_token(list_id, owner_id, "f") == "f"
+
+    # Старое приглашение продолжает действовать до истечения
+    assert db.get_invite_by_token("a")["list_id"] == list_id
+    assert _count(db, "SELECT COUNT(*) FROM invites") == 4
+
+
+def test_invite_cache_is_invalidated(sqlite_db):
+    db = sqlite_db
+    owner_id, list_id = _list_with_items(db, 1)
+    other_id, other_list_id = _list_with_items(db, 1, telegram_id=2)
+    db.get_or_create_invite_token(list_id, owner_id, "used")
+    db.get_or_create_invite_token(list_id, other_id, "deleted")
+    db.get_or_create_invite_token(other_list_id, other_id, "other")
+
+    hits = db.INVITE_CACHE.hits
+    for token in ("used", "deleted", "other"):
+        assert db.get_invite_by_token(token) is not None
+    assert db.INVITE_CACHE.hits == hits + 3
+
+    db.mark_invite_used("used")
+    assert db.get_invite_by_token("used") is None
+
+    db.delete_list(list_id, owner_id)
+    assert db.get_invite_by_token("deleted") is None
+    assert db.get_invite_by_token("other")["list_id"] == other_list_id
+
+
+def test_purge_invites_removes_expired_and_used_in_batches(sqlite_db):
+    db = sqlite_db
+    owner_id, list_id = _list_with_items(db, 1)
+    for n in range(12):
+        db.save_invite_token(f"t{n}", list_id, owner_id)
+    for n in range(5):
+        _set_expiry(db, f"t{n}", "-1 seconds")
+    for n in range(5, 9):
+        db.mark_invite_used(f"t{n}")
+
+    # За вызов не больше max_batches пачек каждого вида
+    assert db.purge_invites(2, 1) == 4
+    assert db.purge_invites(2, 10) == 5
+    assert db.purge_invites(2, 10) == 0
+    with db.get_db_connection(readonly=True) as conn:
+        tokens = [row[0] for row in conn.execute("SELECT token FROM invites")]
+    assert sorted(tokens) == ["t10", "t11", "t9"]
+
+
+def test_pool_reuses_connections_and_rolls_back(sqlite_db):
+    db = sqlite_db
+    pool = db.ConnectionPool(2)
+    try:
+        with pool.writer() as writer:
+            assert writer.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+            assert writer.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            writer.execute("INSERT INTO users (telegram_id) VALUES (1)")
+        # Незакоммиченная запись отменяется при возврате соединения
+        with pool.writer() as again:
+            assert again is writer and not again.in_transaction
+            assert again.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+
+        with pool.reader() as first:
+            first.execute("BEGIN")
+            first.execute("SELECT COUNT(*) FROM users").fetchone()
+            with pool.reader() as second:
+                assert second is not first
+        with pool.reader() as reused:
+            assert reused is first and not reused.in_transaction
+    finally:
+        pool.close()
+
+
+def test_pool_waits_for_a_free_reader(sqlite_db):
+    db = sqlite_db
+    pool = db.ConnectionPool(1)
+    taken = []
+
+    def read():
+        with pool.reader() as conn:
+            taken.append(conn)
+
+    try:
+        with pool.reader() as held:
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join(0.1)
+            # Пул не открывает соединений сверх read_pool_size
+            assert thread.is_alive() and not taken
+        thread.join(5)
+        assert taken == [held]
+    finally:
+        pool.close()
+
+
+def test_user_ids_are_cached_with_eviction(sqlite_db, monkeypatch):
+    db = sqlite_db
+    monkeypatch.setattr(db, "USER_ID_CACHE", LRUCache(2))
+    registered = []
+    register_user = db.register_user
+
+    def counting_register_user(telegram_id):
+        registered.append(telegram_id)
+        return register_user(telegram_id)
+
+    monkeypatch.setattr(db, "register_user", counting_register_user)
+
+    ids = {telegram_id: db.create_user(telegram_id) for telegram_id in (1, 2)}
+    assert [db.create_user(1), db.create_user(2)] == [ids[1], ids[2]]
+    assert registered == [1, 2]
+
+    # Третий пользователь вытесняет давнее всех использованного
+    ids[3] = db.create_user(3)
+    assert db.create_user(2) == ids[2]
+    assert db.create_user(1) == ids[1]
+    assert registered == [1, 2, 3, 1]
+    stats = db.USER_ID_CACHE.stats()
+    assert (stats["size"], stats["hits"], stats["misses"]) == (2, 3, 4)
+
+
+def test_user_cache_is_warmed_with_active_users(sqlite_db, monkeypatch):
+    db = sqlite_db
+    ids = {telegram_id: db.create_user(telegram_id) for telegram_id in range(1, 5)}
+    with db.get_db_connection() as conn:
+        conn.execute(
+            "UPDATE users SET last_active = datetime('now', -telegram_id || ' days')"
+        )
+        conn.commit()
+
+    monkeypatch.setattr(db, "USER_ID_CACHE", LRUCache(2))
+    assert db.warm_user_cache() == 2
+    hits = [db.USER_ID_CACHE.get(telegram_id) for telegram_id in range(1, 5)]
+    assert hits == [ids[1], ids[2], None, None]
+
+
+def test_failed_activity_flush_keeps_the_entries(sqlite_db, monkeypatch):
+    db = sqlite_db
+    for telegram_id in (1, 2):
+        db.create_user(telegram_id)
+    db._activity.touch(1, "2026-01-01 10:00:00")
+    db._activity.touch(2, "2026-01-01 10:00:00")
+    get_db_connection = db.get_db_connection
+
+    @contextmanager
+    def locked_db_connection(readonly=False):
+        # Пока запись не удалась, пользователь 2 успевает прислать новое
+        # обновление: оно новее восстановленного значения
+        db._activity.touch(2, "2026-01-01 11:00:00")
+        raise sqlite3.OperationalError("database is locked")
+        yield
+
+    monkeypatch.setattr(db, "get_db_connection", locked_db_connection)
+    with pytest.raises(sqlite3.OperationalError):
+        db.flush_user_activity()
+    assert db.pending_activity_count() == 2
+
+    monkeypatch.setattr(db, "get_db_connection", get_db_connection)
+    assert db.flush_user_activity() == 2
+    assert db.flush_user_activity() == 0
+    with db.get_db_connection(readonly=True) as conn:
+        rows = conn.execute(
+            "SELECT telegram_id, last_active FROM users ORDER BY telegram_id"
+        ).fetchall()
+    assert [tuple(row) for row in rows] == [
+        (1, "2026-01-01 10:00:00"),
+        (2, "2026-01-01 11:00:00"),
+    ]
+
+
+def test_hot_queries_do_not_scan(sqlite_db, caplog):
+    db = sqlite_db
+    _list_with_items(db, 50)
+    with db.get_db_connection(readonly=True) as conn:
+        assert get_schema_version(conn) == MIGRATIONS[-1][0]
+        assert find_unindexed_plans(conn, db._hot_queries()) == {}
+        # Проверка замечает запрос без подходящего индекса
+        sql = "SELECT id FROM users WHERE last_active > ?"
+        unindexed = find_unindexed_plans(conn, {"by_activity": (sql, (0,))})
+        assert list(unindexed) == ["by_activity"]
+
+    with caplog.at_level("WARNING", logger="database"):
+        db.init_db()
+    assert "не использует индекс" not in caplog.text
+
+
+def test_bulk_add_merges_quantities_in_one_transaction(sqlite_db):
+    db = sqlite_db
+    user_id, list_id = _list_with_items(db, 0)
+    db.add_items_to_list(list_id, [("Молоко", 2)], user_id)
+
+    statements = []
+    with db.get_db_connection() as conn:
+        conn.set_trace_callback(statements.append)
+    try:
+        added = db.add_items_to_list(
+            list_id, [("молоко", 1), ("хлеб", 2), ("МОЛОКО ", 3), ("Хлеб", 1)], user_id
+        )
+    finally:
+        with db.get_db_connection() as conn:
+            conn.set_trace_callback(None)
+
+    assert added == 2
+    items = db.get_list_items(list_id)
+    assert [(row["name"], row["quantity"]) for row in items] == [
+        ("Молоко", 6),
+        ("хлеб", 3),
+    ]
+    transaction = [sql.split()[0] for sql in statements if sql.split()[0].isupper()]
+    assert transaction.count("BEGIN") == 1
+    assert transaction[-1] == "COMMIT" and transaction.count("COMMIT") == 1
+
+
+def test_failed_bulk_add_changes_nothing(sqlite_db):
+    db = sqlite_db
+    user_id, list_id = _list_with_items(db, 0)
+    db.add_items_to_list(list_id, [("молоко", 1)], user_id)
+    version = db.get_list_version(list_id)
+    with db.get_db_connection() as conn:
+        conn.execute(
+            """
+            CREATE TRIGGER fail_history BEFORE INSERT ON item_history
+            WHEN NEW.name = 'сбой'
+            BEGIN SELECT RAISE(ABORT, 'сбой'); END
+            """
+        )
+        conn.commit()
+
+    with pytest.raises(sqlite3.IntegrityError):
+        db.add_items_to_list(list_id, [("молоко", 2), ("сбой", 1)], user_id)
+    items = db.get_list_items(list_id)
+    assert [(row["name"], row["quantity"]) for row in items] == [("молоко", 1)]
+    assert db.get_list_version(list_id) == version
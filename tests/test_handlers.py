@@ -0,0 +1,221 @@
+import asyncio
+from types import SimpleNamespace
+
+import handlers
+from config import LIST_VIEW_FETCH_SIZE
+from outbox import ReplyCoalescer
+from utils import MESSAGE_MAX_LENGTH
+
+
+def _lines(text):
+    return [line for line in text.split("\n") if line.startswith("• ")]
+
+
+def _has_next(markup):
+    return any(
+        button.text == "➡️ Далее" for row in markup.inline_keyboard for button in row
+    )
+
+
+def test_list_view_reads_only_the_viewed_pages(engine, monkeypatch):
+    fetched = []
+    get_page = handlers.get_list_items_page
+
+    async def counting_get_page(list_id, cursor=None, backward=False, limit=10):
+        rows, has_more = await get_page(list_id, cursor, backward, limit)
+        fetched.append(len(rows))
+        return rows, has_more
+
+    monkeypatch.setattr(handlers, "get_list_items_page", counting_get_page)
+    names = [f"товар {n:05}" for n in range(5000)]
+
+    async def scenario():
+        user_id = await engine.create_user(1)
+        list_id = await engine.create_list("покупки", user_id)
+        await engine.add_items_to_list(list_id, [(name, 1) for name in names], user_id)
+
+        pages = [await handlers.render_list_view(user_id, list_id)]
+        first_fetch = sum(fetched)
+        while _has_next(pages[-1][1]):
+            pages.append(
+                await handlers.render_list_view(user_id, list_id, len(pages))
+            )
+        beyond = await handlers.render_list_view(user_id, list_id, len(pages) + 5)
+        return pages, first_fetch, beyond
+
+    pages, first_fetch, beyond = asyncio.run(scenario())
+
+    assert len(pages) > 3
+    assert first_fetch <= len(_lines(pages[0][0])) + LIST_VIEW_FETCH_SIZE
+    assert [line for text, _ in pages for line in _lines(text)] == [
+        f"• товар {n:05}" for n in range(5000)
+    ]
+    for number, (text, _) in enumerate(pages, 1):
+        assert len(text) <= MESSAGE_MAX_LENGTH
+        assert text.endswith(f"_Страница {number}_")
+    assert beyond == pages[-1]
+
+
+class FakeQuery:
+    # Callback-запрос, запоминающий последнее отредактированное сообщение
+    def __init__(self, message=None):
+        self.text = None
+        self.markup = None
+        self.message = message
+
+    async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+        self.text = text
+        self.markup = reply_markup
+
+    def button(self, label, route=None):
+        for row in self.markup.inline_keyboard:
+            for button in row:
+                if button.text != label:
+                    continue
+                decoded = handlers.ROUTER.decode(button.callback_data)
+                if route is None or decoded[0].name == route:
+                    return button.callback_data
+        return None
+
+    def item_buttons(self):
+        return [
+            row[0].text
+            for row in self.markup.inline_keyboard
+            if row[0].text.startswith("🗑 ")
+        ]
+
+
+def test_delete_pages_walk_forward_and_back(engine):
+    names = [f"товар {n:02}" for n in range(23)]
+
+    async def press(query, user_id, data):
+        route, args = handlers.ROUTER.decode(data)
+        await route.handler(query, user_id, *args)
+        return query.item_buttons()
+
+    async def scenario():
+        user_id = await engine.create_user(1)
+        list_id = await engine.create_list("покупки", user_id)
+        await engine.add_items_to_list(list_id, [(name, 1) for name in names], user_id)
+
+        query = FakeQuery()
+        data = handlers.ROUTER.encode("delete_items", list_id, 0)
+        forward = [await press(query, user_id, data)]
+        while data := query.button("➡️ Далее", "delete_items"):
+            forward.append(await press(query, user_id, data))
+        backward = [forward[-1]]
+        while data := query.button("⬅️ Назад", "delete_items"):
+            backward.insert(0, await press(query, user_id, data))
+        return forward, backward, query.text
+
+    forward, backward, text = asyncio.run(scenario())
+    assert sum(forward, []) == [f"🗑 {name}" for name in names]
+    assert [len(page) for page in forward] == [10, 10, 3]
+    assert backward == forward
+    assert text.startswith("Выберите элементы для удаления (страница 1)")
+
+
+def test_list_view_cache_follows_mutations(engine):
+    async def scenario():
+        user_id = await engine.create_user(1)
+        list_id = await engine.create_list("покупки", user_id)
+        await engine.add_items_to_list(list_id, [("хлеб", 1)], user_id)
+
+        async def text():
+            view = await handlers.render_list_view(user_id, list_id)
+            return view and view[0]
+
+        texts = [await text()]
+        cached = await handlers.render_list_view(user_id, list_id)
+        await engine.add_items_to_list(list_id, [("молоко", 2)], user_id)
+        texts.append(await text())
+        bread = (await engine.get_list_items(list_id))[0]
+        await engine.delete_item(bread["id"])
+        texts.append(await text())
+        await engine.clear_list_items(list_id)
+        texts.append(await text())
+        await engine.delete_list(list_id, user_id)
+        texts.append(await text())
+        return texts, cached
+
+    texts, cached = asyncio.run(scenario())
+    assert _lines(texts[0]) == ["• хлеб"]
+    assert cached[0] is texts[0]
+    assert _lines(texts[1]) == ["• хлеб", "• молоко x2"]
+    assert _lines(texts[2]) == ["• молоко x2"]
+    assert texts[3].endswith("Список пуст")
+    assert texts[4] is None
+
+
+def test_cached_view_is_not_shown_without_access(engine, monkeypatch):
+    checks = []
+    get_details = handlers.get_list_details
+
+    async def counting_get_details(list_id, user_id):
+        checks.append(user_id)
+        return await get_details(list_id, user_id)
+
+    monkeypatch.setattr(handlers, "get_list_details", counting_get_details)
+
+    async def scenario():
+        owner_id = await engine.create_user(1)
+        stranger_id = await engine.create_user(2)
+        editor_id = await engine.create_user(3)
+        list_id = await engine.create_list("покупки", owner_id)
+        await engine.add_items_to_list(list_id, [("хлеб", 1)], owner_id)
+
+        owner_view = await handlers.render_list_view(owner_id, list_id)
+        await handlers.render_list_view(owner_id, list_id)
+        stranger_views = [
+            await handlers.render_list_view(stranger_id, list_id) for _ in range(2)
+        ]
+        await engine.invite_user_to_list(list_id, 3, owner_id)
+        editor_view = await handlers.render_list_view(editor_id, list_id)
+        await handlers.render_list_view(editor_id, list_id)
+        viewers = handlers.LIST_VIEW_CACHE.get(list_id)["viewers"]
+        return owner_view, stranger_views, editor_view, viewers, (
+            owner_id,
+            stranger_id,
+            editor_id,
+        )
+
+    owner_view, stranger_views, editor_view, viewers, ids = asyncio.run(scenario())
+    owner_id, stranger_id, editor_id = ids
+    assert stranger_views == [None, None]
+    assert editor_view is owner_view
+    assert viewers == {owner_id, editor_id}
+    # Права проверяются при каждом отказе и один раз для допущенного
+    assert checks == [owner_id, stranger_id, stranger_id, editor_id]
+
+
+def test_exit_adding_sends_the_pending_reply_first(engine, monkeypatch):
+    events = []
+
+    class Bot:
+        async def send_message(self, chat_id, text, reply_markup=None):
+            events.append(("send", chat_id, text))
+
+    class Query(FakeQuery):
+        async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+            events.append(("edit", text.split("\n")[0]))
+            await super().edit_message_text(text, reply_markup, parse_mode)
+
+    monkeypatch.setattr(handlers, "REPLY_COALESCER", ReplyCoalescer(60))
+
+    async def scenario():
+        user_id = await engine.create_user(7)
+        list_id = await engine.create_list("покупки", user_id)
+        await handlers.STATE_STORE.set_state(user_id, handlers.STATE_CONTINUOUS_ADDING)
+        await handlers.REPLY_COALESCER.add(Bot(), 7, 3, "Добавлено элементов: {count}")
+        message = SimpleNamespace(chat=SimpleNamespace(id=7))
+        await handlers.exit_adding_action(Query(message), user_id, list_id)
+        state = await handlers.STATE_STORE.get_state(user_id)
+        return len(handlers.REPLY_COALESCER), state
+
+    pending, state = asyncio.run(scenario())
+    assert events == [
+        ("send", 7, "Добавлено элементов: 3"),
+        ("edit", "*Список: покупки*"),
+    ]
+    assert pending == 0
+    assert state is None
@@ -0,0 +1,50 @@
+import asyncio
+import re
+
+import bot
+import metrics
+
+_SAMPLE_RE = re.compile(r"([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})? (\S+)")
+
+
+async def _fetch(path):
+    server = await asyncio.start_server(metrics._handle_request, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    response = await reader.read()
+    writer.close()
+    server.close()
+    await server.wait_closed()
+    head, _, body = response.decode().partition("\r\n\r\n")
+    return head.split("\r\n")[0], body
+
+
+def test_metrics_output_has_no_duplicates(monkeypatch):
+    monkeypatch.setattr(metrics, "_REGISTRY", list(metrics._REGISTRY))
+    monkeypatch.setattr(metrics, "ENABLED", True)
+    bot.build_application()
+    bot.build_application()
+    metrics.HANDLER_LATENCY.observe(0.01, "button_handler", "v")
+
+    status, body = asyncio.run(_fetch("/metrics"))
+    assert status == "HTTP/1.1 200 OK"
+    assert body.endswith("\n")
+
+    described, samples = set(), set()
+    for line in body.splitlines():
+        if line.startswith("# "):
+            kind, name = line.split()[1:3]
+            assert (kind, name) not in described, line
+            described.add((kind, name))
+            continue
+        match = _SAMPLE_RE.fullmatch(line)
+        assert match, line
+        float(match.group(3))
+        series = match.group(1, 2)
+        assert series not in samples, line
+        samples.add(series)
+
+    names = {name for kind, name in described if kind == "TYPE"}
+    assert {"bot_api_queue_depth", "bot_state_store_size"} <= names
+    assert ("bot_api_queue_depth", None) in samples
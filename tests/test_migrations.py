@@ -0,0 +1,103 @@
+import pytest
+
+import database
+import migrations
+
+
+def test_history_is_folded_by_normalized_name(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DATABASE_PATH", str(tmp_path / "v7.db"))
+    monkeypatch.setattr(database, "_pool", database.ConnectionPool(1))
+    monkeypatch.setattr(migrations, "MIGRATIONS", migrations.MIGRATIONS[:-1])
+    database.init_db()
+
+    with database.get_db_connection() as conn:
+        conn.execute("INSERT INTO users (id, telegram_id) VALUES (1, 1), (2, 2)")
+        conn.execute(
+            "INSERT INTO shopping_lists (id, name, owner_id) "
+            "VALUES (1, 'a', 1), (2, 'b', 1), (3, 'c', 2)"
+        )
+        # До миграции 8 элементы и история различают написание
+        conn.executemany(
+            "INSERT INTO items (list_id, name, quantity, added_by) "
+            "VALUES (?, ?, 1, ?)",
+            [
+                (1, "молоко", 1),
+                (2, "молоко", 1),
+                (1, "МОЛОКО", 1),
+                (1, "Молоко ", 1),
+                (1, "хлеб", 1),
+                (3, "Молоко", 2),
+            ],
+        )
+        conn.commit()
+
+        monkeypatch.undo()
+        migrations.apply_migrations(conn)
+        history = conn.execute(
+            "SELECT user_id, name, name_key, uses FROM item_history "
+            "ORDER BY user_id, name_key"
+        ).fetchall()
+
+    assert [tuple(row) for row in history] == [
+        (1, "молоко", "молоко", 4),
+        (1, "хлеб", "хлеб", 1),
+        (2, "Молоко", "молоко", 1),
+    ]
+
+    monkeypatch.setattr(database, "DATABASE_PATH", str(tmp_path / "v7.db"))
+    monkeypatch.setattr(database, "_pool", database.ConnectionPool(1))
+    database.SUGGEST_CACHE.clear()
+    database.add_items_to_list(1, [("Молоко", 1), ("кефир", 1)], 1)
+    assert database.suggest_items(1, "мол", 10) == ["молоко"]
+    assert database.suggest_items(1, "ке", 10) == ["кефир"]
+    assert database.suggest_items(1, "", 1) == ["молоко"]
+
+
+def test_failed_fold_rolls_back_the_whole_migration(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DATABASE_PATH", str(tmp_path / "v7.db"))
+    monkeypatch.setattr(database, "_pool", database.ConnectionPool(1))
+    monkeypatch.setattr(migrations, "MIGRATIONS", migrations.MIGRATIONS[:-1])
+    database.init_db()
+
+    with database.get_db_connection() as conn:
+        conn.execute("INSERT INTO users (id, telegram_id) VALUES (1, 1)")
+        conn.execute(
+            "INSERT INTO shopping_lists (id, name, owner_id) "
+            "VALUES (1, 'a', 1), (2, 'b', 1), (3, 'c', 1)"
+        )
+        conn.executemany(
+            "INSERT INTO items (list_id, name, quantity, added_by) "
+            "VALUES (?, ?, ?, 1)",
+            [(list_id, name, 1) for list_id in (1, 2, 3) for name in ("сыр", "Сыр")],
+        )
+        conn.commit()
+        monkeypatch.undo()
+
+        # Схлопывание идет пачками по одному списку, но в одной транзакции
+        # с остальными шагами: сбой после него откатывает все пачки
+        def fail(conn):
+            raise RuntimeError("сбой миграции")
+
+        version, steps = migrations.MIGRATIONS[-1]
+        fold = steps.index(migrations._fold_name_key_duplicates)
+        failing = steps[: fold + 1] + [fail]
+        monkeypatch.setattr(migrations, "_BATCH_SIZE", 1)
+        monkeypatch.setattr(
+            migrations, "MIGRATIONS", migrations.MIGRATIONS[:-1] + [(version, failing)]
+        )
+        with pytest.raises(RuntimeError):
+            migrations.apply_migrations(conn)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(items)")]
+        count = conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+        assert migrations.get_schema_version(conn) == version - 1
+        assert "name_key" not in columns and count == 6
+
+        # Повторный запуск выполняет миграцию с начала
+        monkeypatch.undo()
+        monkeypatch.setattr(migrations, "_BATCH_SIZE", 1)
+        migrations.apply_migrations(conn)
+        items = conn.execute(
+            "SELECT list_id, name_key, quantity FROM items ORDER BY list_id"
+        ).fetchall()
+
+    assert [tuple(row) for row in items] == [(n, "сыр", 2) for n in (1, 2, 3)]
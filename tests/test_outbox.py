@@ -0,0 +1,176 @@
+import asyncio
+import time
+from datetime import timedelta
+
+import pytest
+from telegram.error import RetryAfter
+
+from outbox import ReplyCoalescer, TokenBucketRateLimiter
+
+_TEMPLATE = "Добавлено элементов: {count}"
+
+
+class FakeBot:
+    def __init__(self, fail=False):
+        self.sent = []
+        self.fail = fail
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        if self.fail:
+            raise RuntimeError("сеть недоступна")
+        self.sent.append((chat_id, text, reply_markup))
+
+
+def test_replies_within_window_are_merged():
+    async def scenario():
+        bot = FakeBot()
+        coalescer = ReplyCoalescer(0.05)
+        await coalescer.add(bot, 1, 2, _TEMPLATE, "меню 1")
+        await coalescer.add(bot, 2, 1, _TEMPLATE)
+        await coalescer.add(bot, 1, 3, _TEMPLATE, "меню 2")
+        pending = len(coalescer), list(bot.sent)
+        await asyncio.sleep(0.1)
+        await coalescer.add(bot, 1, 4, _TEMPLATE)
+        await asyncio.sleep(0.1)
+        return pending, bot.sent, len(coalescer)
+
+    pending, sent, left = asyncio.run(scenario())
+    assert pending == (2, [])
+    # Клавиатура берется из последнего подтверждения
+    assert sent == [
+        (1, "Добавлено элементов: 5", "меню 2"),
+        (2, "Добавлено элементов: 1", None),
+        (1, "Добавлено элементов: 4", None),
+    ]
+    assert left == 0
+
+
+def test_zero_window_sends_at_once():
+    async def scenario():
+        bot = FakeBot()
+        coalescer = ReplyCoalescer(0)
+        await coalescer.add(bot, 1, 2, _TEMPLATE)
+        await coalescer.add(bot, 1, 3, _TEMPLATE)
+        return bot.sent, len(coalescer)
+
+    sent, left = asyncio.run(scenario())
+    assert [text for _, text, _ in sent] == [
+        "Добавлено элементов: 2",
+        "Добавлено элементов: 3",
+    ]
+    assert left == 0
+
+
+def test_flush_and_drain_send_without_waiting():
+    async def scenario():
+        bot = FakeBot()
+        coalescer = ReplyCoalescer(60)
+        for chat_id in (1, 2, 3):
+            await coalescer.add(bot, chat_id, chat_id, _TEMPLATE)
+        await coalescer.flush(2)
+        await coalescer.flush(2)
+        flushed = list(bot.sent), len(coalescer)
+        await coalescer.drain()
+        await asyncio.sleep(0)
+        return flushed, bot.sent, len(coalescer)
+
+    flushed, sent, left = asyncio.run(scenario())
+    assert flushed == ([(2, "Добавлено элементов: 2", None)], 2)
+    assert [chat_id for chat_id, _, _ in sent] == [2, 1, 3]
+    assert left == 0
+
+
+def test_failed_reply_does_not_break_drain():
+    async def scenario():
+        bot = FakeBot(fail=True)
+        coalescer = ReplyCoalescer(60)
+        await coalescer.add(bot, 1, 1, _TEMPLATE)
+        await coalescer.add(bot, 2, 1, _TEMPLATE)
+        await coalescer.drain()
+        return len(coalescer)
+
+    assert asyncio.run(scenario()) == 0
+
+
+async def _call_at(limiter, started, chat_id):
+    async def callback():
+        return time.monotonic() - started
+
+    data = {"chat_id": chat_id} if chat_id is not None else {}
+    return await limiter.process_request(callback, (), {}, "sendMessage", data, None)
+
+
+def test_chat_limit_does_not_delay_other_chats():
+    async def scenario():
+        limiter = TokenBucketRateLimiter(1000, 20, 2, 0)
+        started = time.monotonic()
+        busy = [_call_at(limiter, started, 1) for _ in range(6)]
+        other = [_call_at(limiter, started, 2) for _ in range(2)]
+        return await asyncio.gather(asyncio.gather(*busy), asyncio.gather(*other))
+
+    busy, other = asyncio.run(scenario())
+    # Два запроса проходят сразу, остальные по одному в 1/20 секунды
+    assert max(busy[:2]) < 0.04
+    assert max(busy) >= 0.18
+    assert max(other) < 0.04
+
+
+def test_global_limit_applies_across_chats():
+    async def scenario():
+        limiter = TokenBucketRateLimiter(10, 1000, 1000, 0)
+        started = time.monotonic()
+        calls = [_call_at(limiter, started, chat_id) for chat_id in range(15)]
+        calls.append(_call_at(limiter, started, None))
+        return await asyncio.gather(*calls), limiter.stats()
+
+    times, stats = asyncio.run(scenario())
+    assert sorted(times)[9] < 0.04
+    assert max(times) >= 0.55
+    assert stats["requests"] == 16
+    assert stats["queue_depth"] == 0
+
+
+def _flaky(failures, retry_after):
+    attempts = []
+
+    async def callback():
+        attempts.append(time.monotonic())
+        if len(attempts) <= failures:
+            raise RetryAfter(timedelta(seconds=retry_after))
+        return "ok"
+
+    return callback, attempts
+
+
+def test_retry_after_backs_off_with_each_attempt():
+    async def scenario():
+        limiter = TokenBucketRateLimiter(1000, 1000, 1000, 2)
+        callback, attempts = _flaky(2, 0.05)
+        result = await limiter.process_request(
+            callback, (), {}, "sendMessage", {"chat_id": 1}, None
+        )
+        return result, attempts, limiter.stats()
+
+    result, attempts, stats = asyncio.run(scenario())
+    assert result == "ok"
+    pauses = [later - earlier for earlier, later in zip(attempts, attempts[1:])]
+    # Пауза растет: retry_after, затем вдвое больше
+    assert 0.05 <= pauses[0] < 0.09
+    assert 0.1 <= pauses[1] < 0.14
+    assert stats["retries"] == 2
+
+
+def test_retry_after_is_raised_when_retries_run_out():
+    async def scenario():
+        limiter = TokenBucketRateLimiter(1000, 1000, 1000, 1)
+        callback, attempts = _flaky(5, 0.01)
+        with pytest.raises(RetryAfter):
+            await limiter.process_request(
+                callback, (), {}, "sendMessage", {"chat_id": 1}, None
+            )
+        return attempts, limiter.stats()
+
+    attempts, stats = asyncio.run(scenario())
+    assert len(attempts) == 2
+    assert stats["retries"] == 1
+    assert stats["queue_depth"] == 0
@@ -0,0 +1,52 @@
+import sqlite3
+import time
+
+from query_trace import SlowQueryLog, tracing_connection_factory
+
+
+def _connect(slow_log):
+    conn = sqlite3.connect(":memory:", factory=tracing_connection_factory(slow_log))
+    # SQLite вычисляет строки SELECT по мере выборки, поэтому почти все
+    # время запроса уходит на чтение результата
+    conn.create_function("slow", 1, lambda value: time.sleep(0.005) or value)
+    conn.execute("CREATE TABLE t (x INTEGER)")
+    conn.executemany("INSERT INTO t VALUES (?)", [(n,) for n in range(20)])
+    return conn
+
+
+def _entry(slow_log, sql):
+    return next(entry for entry in slow_log.report(100) if entry["sql"] == sql)
+
+
+def test_whole_statement_is_timed():
+    slow_log = SlowQueryLog(0)
+    conn = _connect(slow_log)
+
+    assert len(conn.execute("SELECT slow(x) FROM t").fetchall()) == 20
+    assert sum(row[0] for row in conn.execute("SELECT slow(x) AS y FROM t")) == 190
+    cursor = conn.cursor()
+    cursor.execute("SELECT slow(x) AS z FROM t")
+    assert len(cursor.fetchmany(5)) == 5
+    cursor.close()
+
+    for sql in ("SELECT slow(x) FROM t", "SELECT slow(x) AS y FROM t"):
+        entry = _entry(slow_log, sql)
+        assert entry["count"] == 1
+        assert entry["total"] >= 0.1
+    # Курсор закрыт после пяти строк, остальные не вычислялись
+    entry = _entry(slow_log, "SELECT slow(x) AS z FROM t")
+    assert entry["count"] == 1
+    assert 0.025 <= entry["total"] < 0.1
+
+
+def test_statement_is_recorded_when_cursor_is_dropped():
+    slow_log = SlowQueryLog(0)
+    conn = _connect(slow_log)
+
+    def first_row():
+        return conn.execute("SELECT slow(x) FROM t WHERE x > ?", (3,)).fetchone()
+
+    assert first_row()[0] == 4
+    entry = _entry(slow_log, "SELECT slow(x) FROM t WHERE x > ?")
+    assert entry["count"] == 1
+    assert entry["total"] >= 0.005
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import tempfile
+
+from recorder import UpdateRecorder, anonymize_update, read_recording
+
+SALT = "test-salt"
+
+
+def _strings(data):
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield str(key)
+            yield from _strings(value)
+    elif isinstance(data, list):
+        for value in data:
+            yield from _strings(value)
+    else:
+        yield str(data)
+
+
+def test_users_are_anonymized_wherever_they_appear():
+    bob = {
+        "id": 777,
+        "is_bot": False,
+        "first_name": "Bob",
+        "last_name": "Smith",
+        "username": "bobsmith",
+    }
+    update = {
+        "update_id": 1,
+        "message": {
+            "message_id": 5,
+            "date": 1,
+            "chat": {"id": 5, "type": "private", "first_name": "Alice"},
+            "from": {"id": 5, "is_bot": False, "first_name": "Alice"},
+            "forward_origin": {"type": "user", "date": 1, "sender_user": bob},
+            "new_chat_members": [bob],
+            "left_chat_member": bob,
+            "via_bot": {"id": 99, "is_bot": True, "first_name": "Helper"},
+            "text": "молоко x3",
+            "entities": [
+                {"type": "text_mention", "offset": 0, "length": 6, "user": bob}
+            ],
+        },
+    }
+    strings = set(_strings(anonymize_update(SALT, update)))
+    for secret in ("777", "Bob", "Smith", "bobsmith", "Alice", "Helper", "99"):
+        assert secret not in strings
+
+
+def test_tokens_and_urls_are_hashed():
+    token = "3f9a0c1e7b2d4a68"
+    update = {
+        "message": {
+            "text": f"заходи https://t.me/bot?start={token} x3",
+            "entities": [
+                {"type": "text_link", "offset": 0, "length": 6, "url": "https://a.b/c"}
+            ],
+        },
+        "callback_query": {"chat_instance": "-123456789"},
+    }
+    result = anonymize_update(SALT, update)
+    text = result["message"]["text"]
+    assert token not in text
+    assert text.endswith(" x3")
+    assert "a.b" not in result["message"]["entities"][0]["url"]
+    assert "123456789" not in result["callback_query"]["chat_instance"]
+
+    start = anonymize_update(SALT, {"text": f"/start {token}"})["text"]
+    assert start.startswith("/start ") and token not in start
+
+
+class _Update:
+    def __init__(self, update_id):
+        self.update_id = update_id
+
+    def to_dict(self):
+        return {"update_id": self.update_id}
+
+
+def test_recording_survives_unclean_exit():
+    path = os.path.join(tempfile.mkdtemp(), "updates.jsonl.gz")
+    recorder = UpdateRecorder(path, SALT, flush_interval=3600)
+
+    async def record(first, last):
+        for update_id in range(first, last):
+            await recorder.record(_Update(update_id), None)
+
+    asyncio.run(record(0, 2000))
+    recorder.flush()
+    # Процесс завершился без close: последний gzip-member не дописан
+    asyncio.run(record(2000, 2100))
+
+    records = list(read_recording(path))
+    assert [record["update"]["update_id"] for record in records] == list(range(2000))
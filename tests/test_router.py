@@ -0,0 +1,104 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from router import MAX_CALLBACK_DATA, CallbackRouter, decode_int, encode_int
+
+
+def _router():
+    router = CallbackRouter()
+    router.register("close", "q", None)
+    router.register("view", "v", None, (int, int))
+    router.register("page", "d", None, (int, int, str, int, int), required=2)
+    router.register("rename", "r", None, (int, str))
+    return router
+
+
+def test_ints_round_trip():
+    for value in (0, 1, 35, 36, 1295, 1296, -1, -36, 2**31, 2**63, 1700000000):
+        assert decode_int(encode_int(value)) == value
+    assert encode_int(35) == "z"
+    assert encode_int(36) == "10"
+
+
+def test_routes_round_trip():
+    router = _router()
+    cases = [
+        ("close", ()),
+        ("view", (1, 0)),
+        ("view", (2**40, 99)),
+        ("page", (7, 3)),
+        ("page", (7, 3, "n", 1700000000, 123456789)),
+        ("page", (2**31, 10**6, "p", 2**32, 2**40)),
+        ("rename", (1, "молоко")),
+    ]
+    for name, args in cases:
+        data = router.encode(name, *args)
+        assert len(data.encode()) <= MAX_CALLBACK_DATA
+        route, decoded = router.decode(data)
+        assert (route.name, tuple(decoded)) == (name, args)
+
+
+def test_real_keyboards_fit_the_limit():
+    from handlers import ROUTER
+
+    data = ROUTER.encode("delete_items", 2**40, 10**6, "p", 2**33, 2**40)
+    assert len(data.encode()) <= MAX_CALLBACK_DATA
+    route, args = ROUTER.decode(data)
+    assert route.name == "delete_items"
+    assert args == [2**40, 10**6, "p", 2**33, 2**40]
+
+
+def test_encode_rejects_invalid_arguments():
+    router = _router()
+    with pytest.raises(ValueError):
+        router.encode("rename", 1, "я" * 40)  # 80 байт
+    with pytest.raises(ValueError):
+        router.encode("rename", 1, "a:b")
+    with pytest.raises(ValueError):
+        router.encode("view", 1)
+    # Необязательные аргументы передаются все вместе
+    with pytest.raises(ValueError):
+        router.encode("page", 1, 0, "n")
+
+
+def test_decode_rejects_unknown_malformed_and_partial_data():
+    router = _router()
+    rejected = [
+        None,
+        "",
+        "zz",
+        "zz:1",
+        "v",
+        "v:1",
+        "v:1:2:3",
+        "v:1:",
+        "v:!:1",
+        "v:1.5:1",
+        "q:1",
+        "d:1",
+        "d:1:0:n",
+        "d:1:0:n:5",
+        "d:1:0:n:5:6:7",
+        "d:1:0:n:x!:6",
+        "r:1:" + "я" * 31,
+        "v:1:" + "0" * MAX_CALLBACK_DATA,
+    ]
+    for data in rejected:
+        assert router.decode(data) is None, data
+    assert router.dispatch("d:1:0:n", None) is None
+
+
+def test_partial_payload_is_answered_as_stale():
+    from handlers import button_handler
+
+    answers = []
+
+    async def answer(text=None):
+        answers.append(text)
+
+    query = SimpleNamespace(data="d:1:0:n", answer=answer)
+    update = SimpleNamespace(callback_query=query)
+    asyncio.run(button_handler(update, None))
+    assert answers == ["Кнопка устарела, откройте меню заново"]
@@ -0,0 +1,182 @@
+import asyncio
+import random
+import re
+import time
+from argparse import Namespace
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+
+from config import STATE_MAX_ENTRIES, STATE_TOUCH_INTERVAL, STATE_TTL
+from scheduling import KeyedLocks, KeyedUpdateProcessor
+from state_store import MemoryStateStore, SQLiteStateStore
+from storage import MemoryStorage, SQLiteStorage
+
+
+def _update(user_id):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+
+
+def test_waiting_updates_do_not_take_slots():
+    # Очередь одного пользователя не должна задерживать других
+    async def scenario():
+        processor = KeyedUpdateProcessor(4, locks=KeyedLocks())
+        finished = {}
+
+        async def work(name):
+            await asyncio.sleep(0.05)
+            finished[name] = time.perf_counter()
+
+        started = time.perf_counter()
+        tasks = [
+            asyncio.create_task(processor.process_update(_update(1), work(f"a{n}")))
+            for n in range(20)
+        ]
+        tasks.append(
+            asyncio.create_task(processor.process_update(_update(2), work("b")))
+        )
+        await asyncio.gather(*tasks)
+        return started, finished, processor
+
+    started, finished, processor = asyncio.run(scenario())
+    assert finished["b"] - started < 0.2
+    # Обновления одного пользователя выполнялись по очереди и по порядку
+    order = sorted(
+        (name for name in finished if name.startswith("a")), key=finished.get
+    )
+    assert order == [f"a{n}" for n in range(20)]
+    assert finished["a19"] - started >= 20 * 0.05
+    assert processor.pending_updates == 0
+
+
+_ADDED_RE = re.compile(r"Добавлено элементов: (\d+)")
+
+
+@pytest.mark.parametrize("engine", ["memory", "sqlite"])
+def test_concurrent_adding_keeps_quantities_and_states(engine, request, use_storage):
+    # Стресс-тест: бот из bot.py с поддельным Bot API, несколько
+    # пользователей одновременно добавляют элементы в общий список. Ни одно
+    # количество не должно потеряться, состояние каждого пользователя -
+    # остаться в режиме добавления этого списка. В SQLite запросы идут
+    # через пул потоков, как в рабочем режиме
+    if engine == "sqlite":
+        request.getfixturevalue("sqlite_db")
+        storage = SQLiteStorage()
+        use_storage(
+            storage,
+            SQLiteStateStore(
+                storage, STATE_TTL, STATE_MAX_ENTRIES, STATE_TOUCH_INTERVAL
+            ),
+        )
+    else:
+        storage = use_storage(
+            MemoryStorage(), MemoryStateStore(STATE_TTL, STATE_MAX_ENTRIES)
+        )
+
+    import bot
+    import handlers
+    from loadtest import TOKEN, FakeBotAPI, Stats, VirtualUser
+    from loadtest import has_keyboard, is_join_reply
+
+    # Цифры в названии парсер принял бы за количество
+    names = ["хлеб", "молоко", "сыр", "яблоки", "чай", "кофе", "рис", "соль"]
+    users_count, messages_per_user = 8, 25
+
+    async def scenario():
+        api = FakeBotAPI()
+        await api.start()
+        storage.initialize()
+        application = bot.build_application(
+            TOKEN, base_url=api.base_url, rate_limit=False
+        )
+        errors = []
+
+        async def on_error(update, context):
+            errors.append(context.error)
+
+        application.add_error_handler(on_error)
+        await application.initialize()
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+        await application.start()
+
+        args = Namespace(timeout=30.0)
+        stats = Stats()
+        users = [
+            VirtualUser(api, stats, 2000000 + n, args, random.Random(n), [])
+            for n in range(users_count)
+        ]
+        owner = users[0]
+        await owner.send("start", "/start")
+        await owner.send("lists", "/lists", has_keyboard)
+        await owner.press("create_list_button", "➕ Создать")
+        await owner.send("create_list", "Общий список", has_keyboard)
+        _, message = await owner.press("invite", "👥")
+        token = re.search(r"\?start=(\w+)", message["text"]).group(1)
+        await owner.send("items", "/items", has_keyboard)
+        await owner.press("add_mode", "➕ Добавить")
+        for user in users[1:]:
+            await user.send("join", f"/start {token}", is_join_reply)
+            await user.press("add_mode", "➕ Добавить")
+
+        expected = defaultdict(int)
+        sent = defaultdict(int)
+        rng = random.Random(42)
+        for _ in range(messages_per_user):
+            for user in users:
+                parts = []
+                for name in rng.sample(names, rng.randint(1, 4)):
+                    quantity = rng.randint(1, 5)
+                    expected[name] += quantity
+                    parts.append(f"{name} x{quantity}")
+                api.push_message(user.user_id, ", ".join(parts))
+                sent[user.user_id] += len(parts)
+
+        async def confirmed(user):
+            total = 0
+            while total < sent[user.user_id]:
+                _, message = await user.wait(
+                    "add_items",
+                    time.perf_counter(),
+                    lambda method, message: method == "sendMessage"
+                    and _ADDED_RE.match(message["text"]),
+                    record=False,
+                )
+                total += int(_ADDED_RE.match(message["text"]).group(1))
+            return total
+
+        await asyncio.gather(*(confirmed(user) for user in users))
+
+        owner_id = await storage.create_user(owner.user_id)
+        list_id = (await storage.get_user_lists(owner_id))[0]["id"]
+        items = await storage.get_list_items(list_id)
+        count = await storage.get_list_item_count(list_id)
+
+        states = []
+        for user in users:
+            user_id = await storage.create_user(user.user_id)
+            states.append(
+                (
+                    await handlers.STATE_STORE.get_state(user_id),
+                    await handlers.STATE_STORE.get_current_list(user_id),
+                )
+            )
+
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await api.stop()
+        return expected, list_id, items, count, states, errors, stats
+
+    expected, list_id, items, count, states, errors, stats = asyncio.run(scenario())
+
+    assert not errors
+    assert not stats.errors
+    assert {item["name"]: item["quantity"] for item in items} == dict(expected)
+    assert count == len(expected)
+    assert states == [(handlers.STATE_CONTINUOUS_ADDING, list_id)] * users_count
+    if engine == "sqlite":
+        database = request.getfixturevalue("sqlite_db")
+        with database.get_db_connection(readonly=True) as conn:
+            rows = conn.execute("SELECT name, quantity FROM items").fetchall()
+        assert dict(rows) == dict(expected)
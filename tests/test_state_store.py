@@ -0,0 +1,103 @@
+import asyncio
+from collections import Counter
+
+import pytest
+
+from state_store import SQLiteStateStore
+from storage import MemoryStorage, SQLiteStorage
+
+
+class CountingStorage:
+    # Считает обращения к хранилищу
+    def __init__(self, storage):
+        self.storage = storage
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        async def counted(*args):
+            self.calls[name] += 1
+            return await method(*args)
+
+        return counted
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def storage(request):
+    if request.param == "sqlite":
+        request.getfixturevalue("sqlite_db")
+        return SQLiteStorage()
+    return MemoryStorage()
+
+
+def test_state_is_cached_and_written_through(storage):
+    async def scenario():
+        counting = CountingStorage(storage)
+        store = SQLiteStateStore(counting, 3600, 100, 300)
+        await store.set_state(1, "adding")
+        await store.set_current_list(1, 42)
+        for _ in range(10):
+            assert await store.get_state(1) == "adding"
+            assert await store.get_current_list(1) == 42
+
+        # После перезапуска состояние читается одним запросом
+        restarted = CountingStorage(storage)
+        reloaded = SQLiteStateStore(restarted, 3600, 100, 300)
+        seen = await reloaded.get_current_list(1), await reloaded.get_state(1)
+
+        await reloaded.clear_state(1)
+        await reloaded.set_current_list(1, None)
+        cleared = SQLiteStateStore(storage, 3600, 100, 300)
+        return counting.calls, restarted.calls, seen, await cleared.get_state(1)
+
+    calls, restarted_calls, seen, cleared = asyncio.run(scenario())
+    assert calls == {"load_user_state": 1, "save_user_state": 2}
+    assert seen == (42, "adding")
+    assert restarted_calls["load_user_state"] == 1
+    assert cleared is None
+
+
+def test_store_is_bounded(storage):
+    async def scenario():
+        store = SQLiteStateStore(storage, 3600, 2, 300)
+        for user_id in (1, 2, 3):
+            await store.set_state(user_id, "adding")
+        return len(store), await storage.load_user_state(1, 3600)
+
+    size, saved = asyncio.run(scenario())
+    assert size == 2
+    # Вытесненное из памяти состояние остается в хранилище
+    assert saved[:2] == ("adding", None)
+
+
+def test_access_keeps_state_alive(sqlite_db):
+    storage = SQLiteStorage()
+
+    def age(user_id):
+        with sqlite_db.get_db_connection() as conn:
+            conn.execute(
+                "UPDATE user_states "
+                "SET updated_at = datetime('now', '-3000 seconds') "
+                "WHERE user_id = ?",
+                (user_id,),
+            )
+            conn.commit()
+
+    async def scenario():
+        store = SQLiteStateStore(storage, 3600, 100, 0.05)
+        # Пользователь 1 активен и обращается к состоянию из памяти,
+        # пользователь 2 вернулся после перезапуска, 3 неактивен
+        for user_id in (1, 2, 3):
+            await store.set_state(user_id, "adding")
+            age(user_id)
+        await asyncio.sleep(0.06)
+        await store.get_state(1)
+        await SQLiteStateStore(storage, 3600, 100, 300).get_state(2)
+        return await storage.purge_user_states(1800), [
+            await storage.load_user_state(user_id, 3600) for user_id in (1, 2, 3)
+        ]
+
+    purged, saved = asyncio.run(scenario())
+    assert purged == 1
+    assert [state and state[0] for state in saved] == ["adding", "adding", None]
@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+import database
+from config import CLEAR_SOFT_DELETE_MIN
+from storage import MemoryStorage, SQLiteStorage, Storage
+
+
+def test_incomplete_engine_cannot_be_created():
+    class PartialStorage(Storage):
+        def initialize(self):
+            return 0
+
+    with pytest.raises(TypeError):
+        PartialStorage()
+
+
+def test_engines_implement_the_whole_interface():
+    for engine in (MemoryStorage, SQLiteStorage):
+        assert not engine.__abstractmethods__
+        engine()
+
+
+def test_merged_additions_count_as_uses():
+    database.init_db()
+
+    async def scenario(engine):
+        user_id = await engine.create_user(777)
+        list_id = await engine.create_list("покупки", user_id)
+        await engine.add_items_to_list(list_id, [("хлеб", 1), ("кефир", 1)], user_id)
+        # Элемент уже в списке: количество растет, а подсказка поднимается
+        await engine.add_items_to_list(list_id, [("Кефир", 1)], user_id)
+        await engine.add_items_to_list(list_id, [("кефир ", 1)], user_id)
+        database.SUGGEST_CACHE.clear()
+        return await engine.suggest_items(user_id, "", 10)
+
+    for engine in (MemoryStorage(), SQLiteStorage()):
+        assert asyncio.run(scenario(engine)) == ["кефир", "хлеб"]
+
+
+
+def _cursor(row):
+    return row["created_ts"], row["id"]
+
+
+async def _pages(engine, list_id, limit):
+    # Проход по страницам вперед, а затем назад от последней страницы
+    forward, cursor = [], None
+    while True:
+        rows, has_more = await engine.get_list_items_page(list_id, cursor, limit=limit)
+        forward.append(rows)
+        if not has_more:
+            break
+        cursor = _cursor(rows[-1])
+
+    backward = [forward[-1]]
+    has_more = len(forward) > 1
+    while has_more:
+        rows, has_more = await engine.get_list_items_page(
+            list_id, _cursor(backward[0][0]), backward=True, limit=limit
+        )
+        backward.insert(0, rows)
+    return forward, backward
+
+
+def _ids(pages):
+    return [[row["id"] for row in rows] for rows in pages]
+
+
+def test_keyset_pages_forward_and_back(engine):
+    async def scenario():
+        user_id = await engine.create_user(1)
+        list_id = await engine.create_list("покупки", user_id)
+        await engine.add_items_to_list(
+            list_id, [(f"товар {n}", 1) for n in range(23)], user_id
+        )
+        return await engine.get_list_items(list_id), await _pages(engine, list_id, 5)
+
+    items, (forward, backward) = asyncio.run(scenario())
+    assert [len(rows) for rows in forward] == [5, 5, 5, 5, 3]
+    assert sum(_ids(forward), []) == [item["id"] for item in items]
+    assert _ids(backward) == _ids(forward)
+
+
+def test_keyset_pages_order_by_created_at_then_id(sqlite_db):
+    engine = SQLiteStorage()
+
+    async def scenario():
+        user_id = await engine.create_user(1)
+        list_id = await engine.create_list("покупки", user_id)
+        await engine.add_items_to_list(
+            list_id, [(f"товар {n}", 1) for n in range(12)], user_id
+        )
+        # Поздние элементы добавлены раньше, остальные - в одну секунду
+        with sqlite_db.get_db_connection() as conn:
+            conn.execute(
+                "UPDATE items SET created_at = CASE WHEN id > 8 "
+                "THEN '2024-01-01 00:00:00' ELSE '2024-01-02 00:00:00' END"
+            )
+            conn.commit()
+        return await _pages(engine, list_id, 4)
+
+    forward, backward = asyncio.run(scenario())
+    expected = [9, 10, 11, 12, 1, 2, 3, 4, 5, 6, 7, 8]
+    assert sum(_ids(forward), []) == expected
+    assert _ids(forward) == [expected[0:4], expected[4:8], expected[8:]]
+    assert _ids(backward) == _ids(forward)
+
+
+def test_item_count_follows_changes(engine):
+    async def scenario():
+        user_id = await engine.create_user(1)
+        list_id = await engine.create_list("покупки", user_id)
+        counts = []
+
+        async def record():
+            counts.append(await engine.get_list_item_count(list_id))
+
+        await engine.add_items_to_list(
+            list_id, [(f"товар {n}", 1) for n in range(25)], user_id
+        )
+        await record()
+        await engine.add_items_to_list(list_id, [("Товар 1", 2), ("новый", 1)], user_id)
+        await record()
+        items = await engine.get_list_items(list_id)
+        await engine.delete_item(items[0]["id"])
+        await engine.delete_item(items[0]["id"])
+        await record()
+        await engine.clear_list_items(list_id)
+        await record()
+
+        await engine.add_items_to_list(
+            list_id,
+            [(f"товар {n}", 1) for n in range(CLEAR_SOFT_DELETE_MIN)],
+            user_id,
+        )
+        await record()
+        await engine.clear_list_items(list_id)
+        await record()
+        await engine.add_items_to_list(list_id, [("товар 1", 1)], user_id)
+        await engine.purge_deleted_items(100, 100)
+        await record()
+        return counts, len(await engine.get_list_items(list_id))
+
+    counts, remaining = asyncio.run(scenario())
+    assert counts == [25, 26, 25, 0, CLEAR_SOFT_DELETE_MIN, 0, 1]
+    assert remaining == 1
@@ -0,0 +1,153 @@
+import random
+import re
+
+from config import MAX_ITEMS_PER_MESSAGE, MAX_NAME_LENGTH
+from utils import (
+    MESSAGE_MAX_LENGTH,
+    format_items_page,
+    format_list_title,
+    iter_items,
+    page_char_limit,
+    paginate_lines,
+    parse_items,
+)
+
+
+def baseline_parse_items(text):
+    # Исходная реализация parse_items, с которой сравнивается текущая
+    items_raw = re.split(r"[,;|\n\r\t]+", text.strip())
+
+    items = []
+    for item in items_raw:
+        item = item.strip()
+        if not item:
+            continue
+
+        quantity_match = re.search(
+            r"(?:\s+x?(\d+))|(?:\s+(\d+)\s*$)", item, re.IGNORECASE
+        )
+        quantity = 1
+
+        if quantity_match:
+            quantity_str = quantity_match.group(1) or quantity_match.group(2)
+            if quantity_str:
+                try:
+                    quantity = int(quantity_str)
+                except ValueError:
+                    pass
+            item = re.sub(r"\s+x?\d+\s*$", "", item, flags=re.IGNORECASE).strip()
+
+        if item:
+            items.append((item, quantity))
+
+    return items
+
+
+def expected_items(text):
+    # Новая реализация дополнительно ограничивает длину названия
+    # и число элементов
+    return [
+        (name[:MAX_NAME_LENGTH].rstrip(), quantity)
+        for name, quantity in baseline_parse_items(text)
+    ][:MAX_ITEMS_PER_MESSAGE]
+
+
+_WORDS = ["молоко", "хлеб", "bananas", "йогурт", "x", "X", "х", "литра", "Café"]
+_PIECES = [" ", "  ", " ", "x", "X", ",", ";", "|", "\n", "\r\n", "\t", ", "]
+
+
+def random_text(rng):
+    parts = []
+    for _ in range(rng.randint(0, 12)):
+        choice = rng.random()
+        if choice < 0.05:
+            # Длинные названия проверяют ограничение MAX_NAME_LENGTH
+            parts.append(rng.choice(_WORDS) * rng.randint(10, 40))
+        elif choice < 0.4:
+            parts.append(rng.choice(_WORDS))
+        elif choice < 0.7:
+            parts.append(str(rng.randint(0, 120)))
+        else:
+            parts.append(rng.choice(_PIECES))
+    return "".join(parts)
+
+
+def test_matches_baseline_on_random_inputs():
+    rng = random.Random(20240613)
+    for _ in range(20000):
+        text = random_text(rng)
+        assert parse_items(text) == expected_items(text), repr(text)
+
+
+def test_existing_formats():
+    assert parse_items("бананы x3; йогурт x2") == [("бананы", 3), ("йогурт", 2)]
+    assert parse_items("яблоки, молоко, хлеб") == [
+        ("яблоки", 1),
+        ("молоко", 1),
+        ("хлеб", 1),
+    ]
+    assert parse_items("картошка\nморковь x5") == [("картошка", 1), ("морковь", 5)]
+    assert parse_items("молоко 2 литра") == [("молоко 2 литра", 2)]
+
+
+def test_name_length_is_capped():
+    # Второе название обрезается на пробеле, который затем отбрасывается
+    text = f"{'а' * MAX_NAME_LENGTH * 2} x4, {'б' * (MAX_NAME_LENGTH - 1)} {'в' * 10}"
+    items = parse_items(text)
+    assert items == expected_items(text)
+    assert [len(item_name) for item_name, _ in items] == [
+        MAX_NAME_LENGTH,
+        MAX_NAME_LENGTH - 1,
+    ]
+    assert items[0][1] == 4
+
+
+def test_item_count_is_capped():
+    text = "\n".join(f"товар x{n % 9 + 1}" for n in range(MAX_ITEMS_PER_MESSAGE * 3))
+    items = parse_items(text)
+    assert len(items) == MAX_ITEMS_PER_MESSAGE
+    assert items == expected_items(text)
+    # Потоковый вариант без ограничения отдает все элементы по одному
+    assert sum(1 for _ in iter_items(text)) == MAX_ITEMS_PER_MESSAGE * 3
+
+
+def test_paginate_lines_boundaries():
+    # Строка занимает свою длину и перевод строки
+    assert paginate_lines([], 10) == [0]
+    assert paginate_lines(["abcd", "efgh"], 10) == [0]
+    assert paginate_lines(["abcd", "efghi"], 10) == [0, 1]
+    assert paginate_lines(["abcd"] * 5, 10) == [0, 2, 4]
+    # Слишком длинная строка занимает страницу целиком
+    assert paginate_lines(["a" * 50, "b", "c" * 50], 10) == [0, 1, 2]
+    assert paginate_lines(["a" * 9], 10) == [0]
+    assert paginate_lines(["a" * 9, "b"], 10) == [0, 1]
+
+
+def test_pages_fit_the_limit():
+    rng = random.Random(3)
+    lines = ["x" * rng.randint(1, 150) for _ in range(5000)]
+    starts = paginate_lines(lines, 3500) + [len(lines)]
+    for start, end in zip(starts, starts[1:]):
+        assert len("\n".join(lines[start:end])) <= 3500
+        # Следующая строка на страницу уже не поместилась бы
+        if end < len(lines):
+            assert len("\n".join(lines[start : end + 1])) > 3500
+
+
+def test_format_items_page():
+    assert format_items_page([], 0, False) == "Список пуст"
+    assert format_items_page(["• a", "• b"], 0, False) == "*Элементы:*\n• a\n• b"
+    assert format_items_page(["• a"], 0, True).endswith("\n\n_Страница 1_")
+    assert format_items_page(["• a"], 4, False).endswith("\n\n_Страница 5_")
+
+
+def test_long_list_name_still_fits_a_message():
+    name = "*_[`" * 1000
+    title = format_list_title(name)
+    assert title.count("*") < 2 * MAX_NAME_LENGTH
+    limit = page_char_limit(title, 10**6)
+    lines = ["\\_" * 40] * 1000
+    starts = paginate_lines(lines, limit)
+    text = title + format_items_page(lines[: starts[1]], 99999, True)
+    assert len(text) <= MESSAGE_MAX_LENGTH
+    assert page_char_limit(format_list_title("молоко"), 3500) == 3500
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import socket
+import time
+
+import bot
+from loadtest import TOKEN, FakeBotAPI
+from state_store import MemoryStateStore
+from storage import MemoryStorage
+
+_SECRET = "webhook-secret"
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_update(user_id):
+    return {
+        "update_id": 10**6 + user_id,
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+async def _post(port, update, secret):
+    body = json.dumps(update).encode()
+    headers = [
+        "POST /telegram HTTP/1.1",
+        f"Host: 127.0.0.1:{port}",
+        "Content-Type: application/json",
+        f"Content-Length: {len(body)}",
+        "Connection: close",
+    ]
+    if secret is not None:
+        headers.append(f"X-Telegram-Bot-Api-Secret-Token: {secret}")
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(("\r\n".join(headers) + "\r\n\r\n").encode() + body)
+    await writer.drain()
+    status = await reader.readline()
+    writer.close()
+    return int(status.split()[1])
+
+
+def test_webhook_round_trip_rejects_foreign_requests(use_storage):
+    use_storage(MemoryStorage(), MemoryStateStore(3600, 1000))
+
+    async def scenario():
+        api = FakeBotAPI()
+        await api.start()
+        application = bot.build_application(
+            TOKEN, base_url=api.base_url, rate_limit=False
+        )
+        port = _free_port()
+        await application.initialize()
+        await application.updater.start_webhook(
+            listen="127.0.0.1",
+            port=port,
+            url_path="telegram",
+            webhook_url=f"http://127.0.0.1:{port}/telegram",
+            secret_token=_SECRET,
+        )
+        await application.start()
+        try:
+            # Обновление от поддельного API доходит до бота и получает ответ
+            api.push_message(1, "/start")
+            method, reply = await asyncio.wait_for(api.inbox(1).get(), 10)
+
+            # Запросы без заголовка или с чужим секретом не обрабатываются
+            statuses = [
+                await _post(port, _start_update(2), secret)
+                for secret in (None, "", "wrong")
+            ]
+            await asyncio.sleep(0.2)
+            accepted = await _post(port, _start_update(3), _SECRET)
+            await asyncio.wait_for(api.inbox(3).get(), 10)
+        finally:
+            await application.updater.stop()
+            await application.stop()
+            await application.shutdown()
+            await api.stop()
+        return {
+            "webhook": api.webhook,
+            "reply": (method, reply["chat"]["id"]),
+            "statuses": statuses,
+            "accepted": accepted,
+            "rejected_replies": api.inbox(2).qsize(),
+            "errors": dict(api.errors),
+        }
+
+    result = asyncio.run(scenario())
+    assert result["webhook"]["secret_token"] == _SECRET
+    assert result["reply"] == ("sendMessage", 1)
+    assert result["statuses"] == [403, 403, 403]
+    assert result["accepted"] == 200
+    assert result["rejected_replies"] == 0
+    assert result["errors"] == {}
@@ -1,34 +1,70 @@
 import re
-from typing import List, Tuple
+import unicodedata
+from functools import lru_cache
+from itertools import islice
+from typing import Iterator, List, Tuple
 
+from telegram.helpers import escape_markdown
 
-def parse_items(text: str) -> List[Tuple[str, int]]:
-    items_raw = re.split(r"[,;|\n\r\t]+", text.strip())
+from config import MAX_NAME_LENGTH, MAX_ITEMS_PER_MESSAGE, ITEM_LINE_CACHE_SIZE
+
+# Элементы разделяются запятой, точкой с запятой, вертикальной чертой,
+# переводом строки или табуляцией
+_SEGMENT_RE = re.compile(r"[^,;|\n\r\t]+")
+# Название и количество в конце элемента: "бананы x3", "морковь 5"
+_ITEM_RE = re.compile(
+    r"(?P<name>.*?)(?:\s+x?(?P<quantity>\d+))?", re.IGNORECASE | re.DOTALL
+)
+# Количество, указанное в середине названия: "молоко 2 литра"
+_QUANTITY_RE = re.compile(r"\s+x?(\d+)", re.IGNORECASE)
 
-    items = []
-    for item in items_raw:
-        item = item.strip()
+
+def iter_items(text: str) -> Iterator[Tuple[str, int]]:
+    for segment in _SEGMENT_RE.finditer(text):
+        item = segment.group().strip()
         if not item:
             continue
 
-        quantity_match = re.search(
-            r"(?:\s+x?(\d+))|(?:\s+(\d+)\s*$)", item, re.IGNORECASE
-        )
-        quantity = 1
+        match = _ITEM_RE.fullmatch(item)
+        name = match.group("name")
 
+        quantity_match = _QUANTITY_RE.search(name)
         if quantity_match:
-            quantity_str = quantity_match.group(1) or quantity_match.group(2)
-            if quantity_str:
-                try:
-                    quantity = int(quantity_str)
-                except ValueError:
-                    pass
-            item = re.sub(r"\s+x?\d+\s*$", "", item, flags=re.IGNORECASE).strip()
+            quantity = int(quantity_match.group(1))
+        elif match.group("quantity"):
+            quantity = int(match.group("quantity"))
+        else:
+            quantity = 1
+
+        yield name[:MAX_NAME_LENGTH].rstrip(), quantity
+
+
+def normalize_item_name(name: str) -> str:
+    # Ключ для сравнения названий: "Молоко", "молоко " и "МОЛОКО"
+    # считаются одним элементом списка
+    return " ".join(unicodedata.normalize("NFKC", name).casefold().split())
+
+
+# Подсказки ищут не больше пяти слов запроса, каждое как префикс
+_SUGGEST_WORDS = 5
+_WORD_RE = re.compile(r"\w+")
+
+
+def suggest_words(text: str) -> List[str]:
+    return _WORD_RE.findall(text.casefold())
+
+
+def suggest_key(user_id: int, text: str) -> Tuple[int, str]:
+    return user_id, " ".join(suggest_words(text)[:_SUGGEST_WORDS])
+
+
+def parse_items(text: str) -> List[Tuple[str, int]]:
+    return list(islice(iter_items(text), MAX_ITEMS_PER_MESSAGE))
 
-        if item:
-            items.append((item, quantity))
 
-    return items
+@lru_cache(maxsize=ITEM_LINE_CACHE_SIZE)
+def format_item_line(name: str, quantity: int) -> str:
+    return f"• {escape_markdown(name)}" + (f" x{quantity}" if quantity > 1 else "")
 
 
 def format_items_list(items):
@@ -37,12 +73,50 @@ def format_items_list(items):
 
     formatted = ["*Элементы:*"]
     for item in items:
-        formatted.append(
-            f"• {item['name']}"
-            + (f" x{item['quantity']}" if item["quantity"] > 1 else "")
-        )
+        formatted.append(format_item_line(item["name"], item["quantity"]))
+
+    return "\n".join(formatted)
+
+
+# Ограничение Telegram на длину текста сообщения
+MESSAGE_MAX_LENGTH = 4096
+_PAGE_HEADER = "*Элементы:*\n"
+_PAGE_FOOTER = "\n\n_Страница {}_"
+
+
+def format_list_title(name: str) -> str:
+    if len(name) > MAX_NAME_LENGTH:
+        name = name[: MAX_NAME_LENGTH - 1] + "…"
+    return f"*Список: {escape_markdown(name)}*\n\n"
+
+
+def page_char_limit(title: str, max_chars: int) -> int:
+    # Заголовок, строки и подпись страницы должны поместиться в одно сообщение
+    reserve = len(title) + len(_PAGE_HEADER) + len(_PAGE_FOOTER.format(10**6))
+    return min(max_chars, MESSAGE_MAX_LENGTH - reserve)
+
+
+def paginate_lines(lines: List[str], max_chars: int) -> List[int]:
+    # Индексы строк, с которых начинаются страницы не длиннее max_chars
+    starts = [0]
+    size = 0
+    for index, line in enumerate(lines):
+        length = len(line) + 1
+        if size and size + length > max_chars:
+            starts.append(index)
+            size = 0
+        size += length
+    return starts
+
+
+def format_items_page(lines: List[str], page: int, has_next: bool) -> str:
+    if not lines:
+        return "Список пуст"
 
-    return "\n".join(formatted) if formatted else "Список пуст"
+    text = _PAGE_HEADER + "\n".join(lines)
+    if page or has_next:
+        text += _PAGE_FOOTER.format(page + 1)
+    return text
 
 
 def format_lists_menu(lists):